@@ -3,166 +3,349 @@ import base64
 import copy
 import croniter
 import datetime
-from email.message import EmailMessage
 from enum import Enum
+import heapq
 import json
 import logging
 import os
-import requests
 import signal
-import smtplib
-import subprocess
 import threading
 import time
 import traceback
 import uuid
 from SimpleMessageQueue.SMQ_Client import SMQ_Client
 try:
+    import FlowController.FlowController_metrics as FlowController_metrics
+    import FlowController.FlowController_notify as FlowController_notify
+    import FlowController.FlowController_pools as FlowController_pools
+    import FlowController.FlowController_profile as FlowController_profile
+    import FlowController.FlowController_supervisor as FlowController_supervisor
     import FlowController.FlowController_util as FlowController_util
 except:
+    import FlowController_metrics
+    import FlowController_notify
+    import FlowController_pools
+    import FlowController_profile
+    import FlowController_supervisor
     import FlowController_util
 
 
 JobState = Enum('JobState', 'IDLE PENDING RUNNING SUCCESS FAILURE')
 
+# longest time the main loop will sleep without being woken, guards against wall clock jumps
+MAX_IDLE_WAIT = 60
+
+# most bytes of a job log returned by one request_log_tail or request_log_range
+MAX_LOG_CHUNK_SIZE = 256 * 1024
+
+
+def _trim_partial_utf8(data):
+    """ return data without an incomplete UTF-8 sequence at its end.  Job output is written in raw chunks so a read
+        can end in the middle of a character, the rest of it is returned by the next read """
+    # find the lead byte of the last sequence among the last 4 bytes
+    for i in range(1, min(4, len(data)) + 1):
+        b = data[-i]
+        if b & 0xC0 != 0x80:
+            expected = 4 if b >= 0xF0 else 3 if b >= 0xE0 else 2 if b >= 0xC0 else 1
+            return data[:-i] if expected > i else data
+    return data
+
+
+# metrics of the scheduler hot paths, see FlowController_metrics
+JOB_RUN_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_job_run_seconds', 'seconds from starting a job until it finished', ('result', ),
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400, 43200, 86400))
+LEDGER_APPEND_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_ledger_append_seconds', 'seconds to append one job state change to the ledger')
+MESSAGE_HANDLER_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_message_handler_seconds', 'seconds to handle one SMQ message', ('action', ))
+PROCESS_JOBS_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_process_jobs_seconds', 'seconds one pass of the scheduler loop takes')
+SMQ_SEND_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_smq_send_seconds', 'seconds to post one SMQ message to the server', ('action', ))
+
 
 class JobManager():
+    # config keys which can change without resetting the job graph on reload
+    LIVE_CFG_KEYS = ('email_sender', 'logo_filename', 'log_changed_interval', 'max_concurrent_jobs',
+                     'notification_digest_interval', 'pools', 'profile_dir', 'smtp_server', 'title')
+    # seconds shutdown waits for queued notifications to be sent
+    NOTIFIER_SHUTDOWN_TIMEOUT = 10
+
     def __init__(self, config_filename, config_overrides={}):
         self._cfg = None
+        self._cfg_signature = None
+        self._children = {}
         self._config_filename = config_filename
+        self._config_version = 0
+        self._config_version_prefix = uuid.uuid4().hex[:8]
+        self._cron_heap = []
         self._current_date = datetime.datetime.now().strftime('%Y%m%d')
-        self._last_cron_check = datetime.datetime.now() - datetime.timedelta(seconds=60)
+        self._job_definitions = {}
+        self._ledger = None
+        self._ledger_key = None
         self._ledger_lock = threading.Lock()
+        self._pending_resets = {}
+        self._pools = FlowController_pools.ExecutionPools()
+        self._ready_candidates = {}
+        self._scheduler_lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_jobs = {}
+        self._snapshot_serialized = None
+        self._notifier = FlowController_notify.NotificationDispatcher()
+        self._supervisor = FlowController_supervisor.JobSupervisor()
+        self._wakeup_event = threading.Event()
         self._config_override = config_overrides
+        self._unsatisfied_parents = {}
         self.reload_config(None)
 
-    def _run_job_in_separate_process(self, smqc, FC_target_id, job_name, cwd, run_cmd, log_filename,
-                                     success_email_recipients, failure_email_recipients,
-                                     success_slack_webhook, failure_slack_webhook):
-        # TODO: Change to process and track PIDs in self._job_pids
-        def threadworker_run_job():
-            logger = logging.getLogger(f"{job_name}.{datetime.datetime.now().strftime('%Y%m%d')}")
-            logger.setLevel(logging.INFO)
+    def _add_job_to_index(self, job_name):
+        """ add a job which was just put into the config to the parent to children index.  The readiness counters
+            are left to _recount_unsatisfied_parents once all of the new jobs are in the config.  Must hold the
+            scheduler lock """
+        for djn in self._cfg['jobs'][job_name].get('depends', []):
+            self._children.setdefault(djn, []).append(job_name)
+
+    def _count_unsatisfied_parents(self, job_name):
+        """ return the number of parents of a job which are not SUCCESS.  Must hold the scheduler lock """
+        jobs = self._cfg['jobs']
+        # parents missing from the config are never satisfied
+        return sum(1 for djn in jobs[job_name].get('depends', [])
+                   if djn not in jobs or jobs[djn]['state'] != JobState.SUCCESS)
 
-            file_handler = logging.FileHandler(filename=log_filename)
-            file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
-            logger.addHandler(file_handler)
+    def _build_dependency_index(self):
+        """ build the parent to children adjacency index and the per job count of parents which are not SUCCESS,
+            then queue every job for evaluation by the next process_jobs pass.  Must hold the scheduler lock """
+        jobs = self._cfg['jobs']
+        self._children = {jn: [] for jn in jobs}
+        self._unsatisfied_parents = {}
+        self._pending_resets = {}
+        self._ready_candidates = {}
+        self._pools.clear_queue()
+        for jn, j in jobs.items():
+            # parents missing from the config are kept in the index in case they are added
+            for djn in j.get('depends', []):
+                self._children.setdefault(djn, []).append(jn)
+            self._unsatisfied_parents[jn] = self._count_unsatisfied_parents(jn)
+            self._update_work_queues(jn, j['state'])
+
+    def _recount_unsatisfied_parents(self, job_names):
+        """ recompute the unsatisfied parent counters of jobs and of their children from the current graph, and
+            queue the ones with no unsatisfied parents for evaluation.  Used after a reload changed several jobs at
+            once, where incremental updates would depend on the order the jobs are applied in.  Must hold the
+            scheduler lock """
+        jobs = self._cfg['jobs']
+        affected = set()
+        for jn in job_names:
+            affected.add(jn)
+            affected.update(self._children.get(jn, []))
+        for jn in affected:
+            if jn not in jobs:
+                continue
+            self._unsatisfied_parents[jn] = self._count_unsatisfied_parents(jn)
+            if self._unsatisfied_parents[jn] == 0 and jobs[jn].get('depends', []):
+                self._ready_candidates[jn] = None
+
+    def _remove_job_from_index(self, job_name):
+        """ remove a job which is about to be taken out of the config from the dependency index and the work queues.
+            Must hold the scheduler lock """
+        j = self._cfg['jobs'][job_name]
+        for djn in j.get('depends', []):
+            children = self._children.get(djn, [])
+            if job_name in children:
+                children.remove(job_name)
+
+        # children count a missing parent as unsatisfied
+        if j['state'] == JobState.SUCCESS:
+            self._update_children_readiness(job_name, 1)
+        self._unsatisfied_parents.pop(job_name, None)
+        self._pending_resets.pop(job_name, None)
+        self._ready_candidates.pop(job_name, None)
+        self._pools.dequeue(job_name)
+
+    def _update_children_readiness(self, job_name, delta):
+        """ add delta to the unsatisfied parent counters of the children of a job.  Must hold the scheduler lock """
+        for cjn in self._children.get(job_name, []):
+            self._unsatisfied_parents[cjn] += delta
+            if self._unsatisfied_parents[cjn] == 0:
+                self._ready_candidates[cjn] = None
+
+    def _update_dependency_index(self, job_name, old_state, new_state):
+        """ incrementally update the readiness counters of the children of a job which changed state.  Must hold
+            the scheduler lock """
+        if (old_state == JobState.SUCCESS) != (new_state == JobState.SUCCESS):
+            self._update_children_readiness(job_name, -1 if new_state == JobState.SUCCESS else 1)
+        self._update_work_queues(job_name, new_state)
+
+    def _update_work_queues(self, job_name, state):
+        """ queue a job for the process_jobs pass based on its state.  Must hold the scheduler lock """
+        if state == JobState.IDLE and self._unsatisfied_parents.get(job_name, 0) == 0:
+            if self._cfg['jobs'][job_name].get('depends', []):
+                self._ready_candidates[job_name] = None
+        if state == JobState.PENDING:
+            j = self._cfg['jobs'][job_name]
+            self._pending_resets[job_name] = None
+            self._pools.enqueue(job_name, j.get('pool', None), j.get('priority', 0))
+        else:
+            self._pools.dequeue(job_name)
+
+    def _mark_config_changed(self, job_names=None):
+        """ bump the config version and drop the cached snapshots of changed jobs, all jobs if job_names is None.
+            Must hold the scheduler lock """
+        self._config_version += 1
+        if job_names is None:
+            self._snapshot_jobs = {}
+        for jn in job_names or []:
+            self._snapshot_jobs.pop(jn, None)
+
+    def _pop_work_queue(self, name):
+        """ atomically take the contents of one of the work queues """
+        with self._scheduler_lock:
+            queue = getattr(self, name)
+            setattr(self, name, {})
+        return list(queue)
+
+    def _pop_due_cron_jobs(self, now):
+        """ pop the names of all cron jobs whose fire time is at or before now off the cron heap """
+        due = []
+        with self._scheduler_lock:
+            while self._cron_heap and self._cron_heap[0][0] <= now:
+                fire_time, jn = heapq.heappop(self._cron_heap)
+                # skip stale entries left behind when a fire time was recomputed or the config reloaded
+                j = self._cfg['jobs'].get(jn, None)
+                if j is not None and j.get('next_cron_fire_time', None) == fire_time:
+                    due.append(jn)
+        return due
+
+    def _run_job_in_separate_process(self, smqc, FC_target_id, job_name, pool, cwd, run_cmd, log_filename,
+                                     success_email_recipients, failure_email_recipients,
+                                     success_slack_webhook, failure_slack_webhook,
+                                     timeout=None, max_memory_mb=None, max_cpu_seconds=None):
+        """ start a job process under the supervisor.  The output of the job is written to the job log through a
+            buffered writer and the job state is changed to SUCCESS or FAILURE when the process exits """
+        log_writer = FlowController_supervisor.JobLogWriter(log_filename)
+        log_notified_size = [log_writer.get_size()]
+        start_time = time.time()
+
+        def notify_log_changed():
+            # one coalesced notification for all of the output written since the last one
+            size = log_writer.get_size()
+            if size > log_notified_size[0]:
+                self._send_message(smqc, 'job_log_changed', '*', {'job_name': job_name,
+                                                                  'offset': log_notified_size[0],
+                                                                  'length': size - log_notified_size[0]})
+                log_notified_size[0] = size
+
+        def finish_job(new_state, reason, body):
+            # make the complete log visible before the state change is announced
+            try:
+                log_writer.close()
+                notify_log_changed()
+            except Exception as e:
+                logging.exception(e)
 
+            JOB_RUN_SECONDS.observe(time.time() - start_time, new_state)
             try:
-                logger.info('')
-                logger.info('')
-                logger.info('FlowController Starting Job')
-                logger.info('')
-                logger.info('')
-
-                if run_cmd is None:
-                    smqc.send_message(smqc.construct_msg('change_job_state', FC_target_id,
-                                                         {'job_name': job_name, 'new_state': 'FAILURE',
-                                                          'reason': 'missing run_cmd'}))
-                    self._send_email(subject=f'FAILED {job_name}', body='Missing run_cmd',
-                                     recipients=failure_email_recipients)
-                    self._send_slack(text=f'FAILED {job_name}', webhook_url=failure_slack_webhook)
-                    return
-                try:
-                    # set the current working directory to the directory of the cfg file
-                    proc = subprocess.Popen(run_cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-
-                    job_output = b''
-                    while True:
-                        output = proc.stdout.readline()
-                        if len(output) == 0 and proc.poll() is not None:
-                            break
-                        if output:
-                            job_output += output + b'\n'
-                            logger.info(output.strip().decode())
-                            logger.handlers[0].flush()
-                            smqc.send_message(smqc.construct_msg('job_log_changed', '*', {'job_name': job_name}))
-                    job_output = job_output.decode()
-
-                    rc = proc.poll()
-                    if rc == 0:
-                        smqc.send_message(smqc.construct_msg('change_job_state', FC_target_id,
-                                                             {'job_name': job_name, 'new_state': 'SUCCESS', 'reason': 'Job Completed'}))
-
-                        # update cron time
-                        j = self._cfg['jobs'][job_name]
-                        if 'cron' in j:
-                            self._update_next_cron_fire_time(job_name, datetime.datetime.now())
-
-                        self._send_email(subject=f'SUCCEEDED {job_name}', body=job_output,
-                                         recipients=success_email_recipients)
-                        self._send_slack(text=f'SUCCEEDED {job_name}', webhook_url=success_slack_webhook)
-                    else:
-                        smqc.send_message(smqc.construct_msg('change_job_state', FC_target_id,
-                                                             {'job_name': job_name, 'new_state': 'FAILURE', 'reason': 'Job Completed'}))
-                        self._send_email(subject=f'FAILED {job_name}', body=job_output,
-                                         recipients=failure_email_recipients)
-                        self._send_slack(text=f'FAILED {job_name}', webhook_url=failure_slack_webhook)
-                except Exception as _:
-                    logger.error(traceback.format_exc())
-                    smqc.send_message(smqc.construct_msg('change_job_state', FC_target_id,
-                                                         {'job_name': job_name, 'new_state': 'FAILURE', 'reason': 'Job Error'}))
-                    self._send_email(subject=f'FAILED {job_name}', body=job_output,
-                                     recipients=failure_email_recipients)
-                    self._send_slack(text=f'FAILED {job_name}', webhook_url=failure_slack_webhook)
+                self._send_message(smqc, 'change_job_state', FC_target_id,
+                                   {'job_name': job_name, 'new_state': new_state, 'reason': reason})
+                if new_state == 'SUCCESS':
+                    # update cron time
+                    if 'cron' in self._cfg['jobs'].get(job_name, {}):
+                        self._update_next_cron_fire_time(job_name, datetime.datetime.now())
+                    self._send_notifications(f'SUCCEEDED {job_name}', body, success_email_recipients,
+                                             success_slack_webhook)
+                else:
+                    self._send_notifications(f'FAILED {job_name}', body, failure_email_recipients,
+                                             failure_slack_webhook)
             finally:
-                file_handler.close()
-                logger.removeHandler(file_handler)
+                # free the slot in the execution pool so queued jobs can start
+                self._pools.release(pool)
+                self.wakeup()
+
+        def on_flush():
+            log_writer.flush()
+            notify_log_changed()
+
+        def on_exit(rc, reason):
+            if reason == 'timeout':
+                log_writer.write_line('FlowController Job Timed Out')
+                finish_job('FAILURE', 'Job Timed Out', log_writer.get_tail())
+            elif reason == 'killed':
+                log_writer.write_line('FlowController Job Killed')
+                finish_job('FAILURE', 'Job Killed', log_writer.get_tail())
+            elif rc == 0:
+                finish_job('SUCCESS', 'Job Completed', log_writer.get_tail())
+            else:
+                finish_job('FAILURE', 'Job Completed', log_writer.get_tail())
+
+        log_writer.write_line('')
+        log_writer.write_line('')
+        log_writer.write_line('FlowController Starting Job')
+        log_writer.write_line('')
+        log_writer.write_line('')
+        log_writer.flush()
+        notify_log_changed()
+
+        if run_cmd is None:
+            finish_job('FAILURE', 'missing run_cmd', 'Missing run_cmd')
+            return
 
-        t = threading.Thread(target=threadworker_run_job, args=())
-        t.start()
-
-    def _send_email(self, subject, body, recipients):
-        try:
-            smtp_server = self._cfg.get('smtp_server', 'localhost')
-            logging.info(f'SENDING EMAIL! {smtp_server} {subject} {recipients} {body}')
-            if recipients is None or recipients.strip() == '':
-                logging.info('NOT SEND SENDING EMAIL!')
-                return
-            msg = EmailMessage()
-            msg.set_content(body)
-
-            msg['Subject'] = subject
-            msg['From'] = self._cfg.get('email_sender', '')
-            msg['To'] = recipients
-            s = smtplib.SMTP(smtp_server)
-            s.send_message(msg)
-            s.quit()
-        except Exception as e:
-            logging.exception(e)
-
-    def _send_slack(self, text, webhook_url):
         try:
-            if webhook_url is None:
-                logging.info('NOT SENDING SLACK because webhook_url is not set')
-                return
-            slack_data = {'text': text}
-
-            response = requests.post(
-                webhook_url, data=json.dumps(slack_data),
-                headers={'Content-Type': 'application/json'}
-            )
-            if response.status_code != 200:
-                logging.error(response.status_code)
-                logging.error(response.text)
-        except Exception as e:
-            logging.exception(e)
+            # set the current working directory to the directory of the cfg file
+            self._supervisor.start_job(job_name, run_cmd, cwd, log_writer.write, on_flush, on_exit, timeout=timeout,
+                                       max_memory_mb=max_memory_mb, max_cpu_seconds=max_cpu_seconds)
+        except Exception as _:
+            log_writer.write_line(traceback.format_exc())
+            finish_job('FAILURE', 'Job Error', log_writer.get_tail())
+
+    def _send_message(self, smqc, action, target_id, payload):
+        """ post a message without waiting for a response and record how long the post took """
+        with SMQ_SEND_SECONDS.time(action):
+            smqc.send_message(smqc.construct_msg(action, target_id, payload))
+
+    def _send_notifications(self, subject, body, email_recipients, slack_webhook):
+        """ queue the email and slack notifications for a job, they are sent in the background so the caller is not
+            delayed """
+        self._notifier.send_email(subject=subject, body=body, recipients=email_recipients)
+        self._notifier.send_slack(text=subject, webhook_url=slack_webhook)
 
     def _update_next_cron_fire_time(self, job_name, base):
+        """ compute the next cron fire time of a job after base and push it onto the cron heap if it changed """
         cron_iter = croniter.croniter(self._cfg['jobs'][job_name]['cron'], base)
-        self._cfg['jobs'][job_name]['next_cron_fire_time'] = cron_iter.get_next(datetime.datetime)
+        next_cron_fire_time = cron_iter.get_next(datetime.datetime)
+        with self._scheduler_lock:
+            # the heap already has an entry for an unchanged fire time, a second one would fire the job twice
+            if self._cfg['jobs'][job_name].get('next_cron_fire_time', None) == next_cron_fire_time:
+                return
+            self._cfg['jobs'][job_name]['next_cron_fire_time'] = next_cron_fire_time
+            self._mark_config_changed([job_name])
+            heapq.heappush(self._cron_heap, (next_cron_fire_time, job_name))
+        self.wakeup()
 
     def change_job_state(self, smqc, job_name, new_state, reason):
+        # a running job may have been removed from the config by a reload
+        if job_name not in self._cfg['jobs']:
+            logging.warning(f'Ignoring state change of {job_name} to {new_state.name}, it is not in the config')
+            return {'retval': 1, 'error': f'{job_name} is not in the config'}
+
         # change the job state
         try:
             self._ledger_lock.acquire()
-            FlowController_util.FlowControllerLedger.append(self._cfg['ledger_dir'], self._cfg['uid'], job_name, new_state.name, reason)
-            self._cfg['jobs'][job_name]['state'] = new_state
+            with LEDGER_APPEND_SECONDS.time():
+                self._ledger.append(job_name, new_state.name, reason)
+            with self._scheduler_lock:
+                old_state = self._cfg['jobs'][job_name]['state']
+                self._cfg['jobs'][job_name]['state'] = new_state
+                self._mark_config_changed([job_name])
+                self._update_dependency_index(job_name, old_state, new_state)
+                version = self._get_config_version()
         finally:
             self._ledger_lock.release()
+        self.wakeup()
 
-        # broadcast config_changed
-        smqc.send_message(smqc.construct_msg('job_state_changed', '*', {'job_name': job_name, 'new_state': new_state.name}))
+        # broadcast config_changed, clients which patch their cached config advance it to the version
+        self._send_message(smqc, 'job_state_changed', '*', {'job_name': job_name, 'new_state': new_state.name,
+                                                             'version': version})
 
         # success
         return {'retval': 0}
@@ -178,12 +361,85 @@ class JobManager():
         """
         return self._cfg[prop]
 
-    def get_config_snapshot(self, _smqc):
-        # xmlrpc cannot marshal enums, so convert to string
-        d = copy.deepcopy(self._cfg)
-        for jn in d['jobs']:
-            d['jobs'][jn]['state'] = d['jobs'][jn]['state'].name
-        return {'retval': 0, 'config': d}
+    def _build_config_changed_payload(self, changes, full):
+        """ return the payload of a config_changed message for a change set.  The payload carries copies of the
+            added and modified jobs which can be sent in a message and the config version they belong to, so clients
+            can patch a cached config instead of fetching it
+
+            Args:
+                changes - dict with lists of the added, removed and modified job names
+                full - True if clients need to fetch the whole config
+        """
+        with self._scheduler_lock:
+            jobs = {}
+            for jn in changes['added'] + changes['modified']:
+                # xmlrpc cannot marshal enums, so convert to string
+                jobs[jn] = copy.deepcopy(self._cfg['jobs'][jn])
+                jobs[jn]['state'] = jobs[jn]['state'].name
+            payload = dict(changes, full=full, jobs=jobs, version=self._get_config_version())
+            if changes['added']:
+                # added jobs are placed where they are in the config file
+                payload['job_order'] = list(self._cfg['jobs'].keys())
+        return payload
+
+    def _get_config_version(self):
+        """ return the config version, unique across restarts of the FlowController.  Must hold the scheduler lock """
+        return f'{self._config_version_prefix}.{self._config_version}'
+
+    def get_config_snapshot(self, _smqc, serialized=False):
+        """ return a snapshot of the config.  The snapshot is only rebuilt after the config or a job state changed,
+            copying just the jobs which changed, and the same response is shared by all requesters so it must not be
+            modified
+
+            Args:
+                serialized - return the config as a json string in config_json instead of as a dict in config.  xmlrpc
+                             marshals a dict element by element for every requester, but a string is copied as is,
+                             so the json is built once per version and shared by all requesters
+
+            Returns:
+                dict with the config and its version
+        """
+        with self._scheduler_lock:
+            version = self._get_config_version()
+            if self._snapshot is None or self._snapshot['version'] != version:
+                jobs = {}
+                for jn, j in self._cfg['jobs'].items():
+                    if jn not in self._snapshot_jobs:
+                        # xmlrpc cannot marshal enums, so convert to string
+                        self._snapshot_jobs[jn] = copy.deepcopy(j)
+                        self._snapshot_jobs[jn]['state'] = j['state'].name
+                    jobs[jn] = self._snapshot_jobs[jn]
+                self._snapshot = {'retval': 0, 'config': dict(self._cfg, jobs=jobs), 'version': version}
+            snapshot = self._snapshot
+            serialized_snapshot = self._snapshot_serialized
+        if not serialized:
+            return snapshot
+
+        if serialized_snapshot is None or serialized_snapshot['version'] != version:
+            # the snapshot is never modified, so serialize it without blocking the scheduler.  datetimes such as the
+            # next cron fire time are sent as strings
+            serialized_snapshot = {'retval': 0, 'config_json': json.dumps(snapshot['config'], default=str),
+                                   'version': version}
+            with self._scheduler_lock:
+                self._snapshot_serialized = serialized_snapshot
+        return serialized_snapshot
+
+    def get_config_snapshot_if_changed(self, smqc, version, serialized=False):
+        """ return a snapshot of the config only if it changed since a version
+
+            Args:
+                version - version of the snapshot the requester has, or None
+                serialized - return the config as a json string, see get_config_snapshot
+
+            Returns:
+                dict with changed set to False if the requester is current, otherwise the snapshot with changed set
+                to True
+        """
+        with self._scheduler_lock:
+            current_version = self._get_config_version()
+        if version == current_version:
+            return {'retval': 0, 'changed': False, 'version': current_version}
+        return dict(self.get_config_snapshot(smqc, serialized), changed=True)
 
     def get_icon(self, _smqc):
         icon_filename = os.path.join(os.path.dirname(self._config_filename), self._cfg['logo_filename'])
@@ -202,6 +458,22 @@ class JobManager():
             s = f'This job may not have run for today yet.</span>\n\nlog file at {filename} does not exist.'
         return {'retval': 0, 'log': s}
 
+    def _read_log_bytes(self, job_name, offset, length):
+        """ read up to length bytes of a job log starting at a byte offset, without reading the rest of the file
+
+            Returns:
+                tuple of (filename, file size or None if the log does not exist, bytes read)
+        """
+        filename = self.get_log_filename(job_name)
+        try:
+            with open(filename, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(max(0, min(offset, size)))
+                # a negative length would read the whole file
+                return filename, size, f.read(max(0, min(length, MAX_LOG_CHUNK_SIZE)))
+        except FileNotFoundError:
+            return filename, None, b''
+
     def get_log_filename(self, job_name, date=None):
         if date is None:
             date = datetime.datetime.now()
@@ -209,102 +481,332 @@ class JobManager():
             self._cfg['job_logs_dir'],
             f"{self._cfg['uid']}.{job_name}.{datetime.datetime.now().strftime('%Y%m%d')}.log"))
 
+    def get_log_range(self, _smqc, job_name, offset, length):
+        """ read a byte range of a job log
+
+            Args:
+                job_name - name of the job
+                offset - byte offset to start reading at
+                length - number of bytes to read, at most MAX_LOG_CHUNK_SIZE bytes are returned
+
+            Returns:
+                log - the text in the range
+                offset - byte offset just after the returned text
+                size - size of the log file in bytes
+        """
+        offset = max(int(offset), 0)
+        length = max(0, min(int(length), MAX_LOG_CHUNK_SIZE))
+        filename, size, data = self._read_log_bytes(job_name, offset, length)
+        data = _trim_partial_utf8(data)
+        return {'retval': 0, 'filename': filename, 'exists': size is not None, 'log': data.decode(errors='replace'),
+                'offset': offset + len(data), 'size': size or 0}
+
+    def get_log_tail(self, _smqc, job_name, offset=None):
+        """ return the part of a job log after the offset a client has already read, so a client can follow a log
+            of any size with constant size requests
+
+            Args:
+                job_name - name of the job
+                offset - byte offset returned by the previous call, or None or a negative number to start with the
+                         last MAX_LOG_CHUNK_SIZE bytes of the log
+
+            Returns:
+                log - the new text, cut at a line boundary when more than MAX_LOG_CHUNK_SIZE bytes are available
+                offset - byte offset to pass to the next call
+                size - size of the log file in bytes
+                reset - True if the log is shorter than the offset, i.e. a new log was started, and the text is
+                        read from the start of the new log
+        """
+        filename, size, _ = self._read_log_bytes(job_name, 0, 0)
+        if size is None:
+            return {'retval': 0, 'filename': filename, 'exists': False, 'log': '', 'offset': 0, 'size': 0,
+                    'reset': False}
+
+        reset = False
+        start_in_middle = False
+        if offset is None or int(offset) < 0:
+            offset = max(size - MAX_LOG_CHUNK_SIZE, 0)
+            start_in_middle = offset > 0
+        elif int(offset) > size:
+            offset = 0
+            reset = True
+        offset = int(offset)
+
+        _, size, data = self._read_log_bytes(job_name, offset, MAX_LOG_CHUNK_SIZE)
+        if start_in_middle:
+            # skip the rest of a character cut by starting MAX_LOG_CHUNK_SIZE bytes before the end
+            skip = 0
+            while skip < min(3, len(data)) and data[skip] & 0xC0 == 0x80:
+                skip += 1
+            offset += skip
+            data = data[skip:]
+        if len(data) == MAX_LOG_CHUNK_SIZE and offset + len(data) < size and b'\n' in data:
+            data = data[:data.rindex(b'\n') + 1]
+        data = _trim_partial_utf8(data)
+        return {'retval': 0, 'filename': filename, 'exists': True, 'log': data.decode(errors='replace'),
+                'offset': offset + len(data), 'size': size, 'reset': reset}
+
+    def get_job_pids(self, _smqc):
+        """ return the pids of the running job processes """
+        return {'retval': 0, 'job_pids': self._supervisor.get_job_pids()}
+
+    def get_metrics(self, _smqc):
+        """ return the metrics of this process, see FlowController_metrics
+
+            Returns:
+                {'retval': 0, 'metrics': list of {'name', 'labels', 'value'} samples,
+                 'text': the metrics in the Prometheus text format}
+        """
+        registry = FlowController_metrics.REGISTRY
+        return {'retval': 0, 'metrics': registry.get_samples(), 'text': registry.render_prometheus()}
+
+    def get_next_wakeup_time(self):
+        """ return the time at which process_jobs next has timed work to do, i.e. the earliest cron fire time,
+            the midnight rollover or the fsync deadline of the ledger, whichever comes first """
+        wakeup_time = (datetime.datetime.now() + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0,
+                                                                                     microsecond=0)
+        with self._ledger_lock:
+            sync_deadline = self._ledger.get_sync_deadline() if self._ledger is not None else None
+        if sync_deadline is not None:
+            wakeup_time = min(datetime.datetime.fromtimestamp(sync_deadline), wakeup_time)
+        with self._scheduler_lock:
+            if self._cron_heap:
+                return min(self._cron_heap[0][0], wakeup_time)
+        return wakeup_time
+
+    def get_pool_stats(self):
+        """ return the number of jobs queued in and running in the execution pools """
+        return self._pools.get_stats()
+
+    def kill_job(self, _smqc, job_name):
+        """ kill the process group of a running job, the job changes to FAILURE once its process exits
+
+            Args:
+                job_name - name of the job to kill
+        """
+        if not self._supervisor.kill_job(job_name):
+            return {'retval': 1, 'error': f'Job {job_name} is not running'}
+        return {'retval': 0}
+
     def process_jobs(self, smqc):
+        """ process any work which is due.  Only jobs affected by state changes since the last call are looked at,
+            so this does nothing if no cron fire time has passed and the graph is idle """
+        start = time.perf_counter()
+        self._wakeup_event.clear()
+
         # check for a new day
         if self._current_date != datetime.datetime.now().strftime('%Y%m%d'):
             self._current_date = datetime.datetime.now().strftime('%Y%m%d')
-            self.reload_config(smqc)
+            self.reload_config(smqc, force=True)
 
-        # check if cron cooldown is passed
-        process_cron = False
+        # process cron jobs whose fire time has passed
         cron_time = datetime.datetime.now()
-        if cron_time > self._last_cron_check + datetime.timedelta(seconds=60):
-            self._last_cron_check = cron_time
-            process_cron = True
+        for jn in self._pop_due_cron_jobs(cron_time):
+            self._update_next_cron_fire_time(jn, cron_time)
+            self.change_job_state(smqc, jn, JobState.PENDING, 'cron fire time')
+
+        # check if any IDLE jobs whose parents just succeeded have all of their dependencies met, if so, change to
+        # pending.  a reload on another thread may replace the jobs or remove a job, so look them up under the lock
+        for jn in self._pop_work_queue('_ready_candidates'):
+            with self._scheduler_lock:
+                j = self._cfg['jobs'].get(jn, None)
+                ready = j is not None and j['state'] == JobState.IDLE and self._unsatisfied_parents.get(jn) == 0
+            if ready:
+                self.change_job_state(smqc, jn, JobState.PENDING, 'Dependencies Ready')
+
+        # set children of jobs which went to PENDING back to IDLE
+        for jn in self._pop_work_queue('_pending_resets'):
+            with self._scheduler_lock:
+                jobs = self._cfg['jobs']
+                resets = [cjn for cjn in self._children.get(jn, [])
+                          if cjn in jobs and jobs[cjn]['state'] in (JobState.SUCCESS, JobState.FAILURE)]
+            for cjn in resets:
+                self.change_job_state(smqc, cjn, JobState.IDLE, 'Parent went to pending')
+
+        # execute as many pending jobs as the execution pools allow, the rest stay queued in priority order
+        for jn, pool in self._pools.pop_runnable():
+            with self._scheduler_lock:
+                j = self._cfg['jobs'].get(jn, None)
+            if j is None or j['state'] != JobState.PENDING:
+                self._pools.release(pool)
+                continue
+            self.change_job_state(smqc, jn, JobState.RUNNING, 'pending')
+            self._run_job_in_separate_process(
+                smqc=smqc, FC_target_id=self.get_config_prop('uid'), job_name=jn, pool=pool,
+                cwd=os.path.join(os.path.dirname(os.path.abspath(self._config_filename))),
+                run_cmd=j.get('run_cmd', None),
+                log_filename=self.get_log_filename(jn),
+                success_email_recipients=j.get('success_email_recipients', None),
+                failure_email_recipients=j.get('failure_email_recipients', None),
+                success_slack_webhook=j.get('success_slack_webhook', None),
+                failure_slack_webhook=j.get('failure_slack_webhook', None),
+                timeout=j.get('timeout', None),
+                max_memory_mb=j.get('max_memory_mb', None),
+                max_cpu_seconds=j.get('max_cpu_seconds', None))
+
+        # fsync ledger appends which no later append has fsynced
+        with self._ledger_lock:
+            self._ledger.sync_if_due()
+        PROCESS_JOBS_SECONDS.observe(time.perf_counter() - start)
+
+    def _apply_config_diff(self, cfg, job_definitions):
+        """ apply a reloaded config to the live graph, keeping the state of jobs whose definition did not change
+
+            Args:
+                cfg - newly read config
+                job_definitions - job definitions of the new config as read from the config file
+
+            Returns:
+                dict with lists of the added, removed and modified job names
+        """
+        added = [jn for jn in job_definitions if jn not in self._job_definitions]
+        removed = [jn for jn in self._job_definitions if jn not in job_definitions]
+        modified = [jn for jn in job_definitions
+                    if jn in self._job_definitions and job_definitions[jn] != self._job_definitions[jn]]
+        changed = set(added) | set(modified)
+
+        cron_jobs = []
+        with self._ledger_lock:
+            # jobs which are added back keep the state they had today
+            ledger_states = self._ledger.get_states() if added else {}
+            with self._scheduler_lock:
+                old_jobs = self._cfg['jobs']
+                for jn in removed + modified:
+                    self._remove_job_from_index(jn)
+
+                # keep the dicts of unchanged jobs and the order of the config file
+                jobs = {}
+                for jn, j in cfg['jobs'].items():
+                    if jn not in changed:
+                        jobs[jn] = old_jobs[jn]
+                        continue
+                    if jn in old_jobs:
+                        j['state'] = old_jobs[jn]['state']
+                    else:
+                        j['state'] = JobState[ledger_states.get(jn, 'IDLE')]
+                    self._apply_job_defaults(cfg, j)
+                    if 'cron' in j:
+                        if j['cron'] == old_jobs.get(jn, {}).get('cron', None):
+                            j['next_cron_fire_time'] = old_jobs[jn]['next_cron_fire_time']
+                        else:
+                            cron_jobs.append(jn)
+                    jobs[jn] = j
+                for k in self.LIVE_CFG_KEYS:
+                    self._cfg[k] = cfg.get(k, None)
+                self._cfg['jobs'] = jobs
+                for jn in added + modified:
+                    self._add_job_to_index(jn)
+                self._recount_unsatisfied_parents(removed + added + modified)
+                for jn in added + modified:
+                    self._update_work_queues(jn, jobs[jn]['state'])
+                self._mark_config_changed(removed + added + modified)
+            self._job_definitions = job_definitions
+
+        cron_base = datetime.datetime.now()
+        for jn in cron_jobs:
+            self._update_next_cron_fire_time(jn, cron_base)
+        return {'added': added, 'removed': removed, 'modified': modified}
+
+    def _apply_job_defaults(self, cfg, j):
+        """ inject the config wide defaults into a job """
+        j['success_email_recipients'] = j.get('success_email_recipients', cfg['success_email_recipients'])
+        j['failure_email_recipients'] = j.get('failure_email_recipients', cfg['failure_email_recipients'])
+        j['success_slack_webhook'] = j.get('success_slack_webhook', cfg['success_slack_webhook'])
+        j['failure_slack_webhook'] = j.get('failure_slack_webhook', cfg['failure_slack_webhook'])
+
+    def reload_config(self, smqc, force=False):
+        """ reload the config and broadcast a config_changed message.  If only jobs or LIVE_CFG_KEYS changed, the
+            difference is applied to the live graph and the config_changed payload lists the added, removed and
+            modified jobs along with the new definitions of the added and modified jobs.  Otherwise all job states
+            are restored from the ledger.  The payload has full set to True if clients need to fetch the whole config
+
+            Args:
+                force - reload and reset the job states even if the config file did not change
+        """
+        # nothing to do if the config file did not change
+        signature = FlowController_util.get_cfg_file_signature(self._config_filename)
+        if not force and signature == self._cfg_signature:
+            return {'retval': 0}
 
-        # loop through all the jobs
-        jobs = self._cfg['jobs']
-        for jn, j in jobs.items():
-            # skip any nodes that are not IDLE or do not have depends
-            if j['state'] != JobState.IDLE:
-                if not process_cron:
-                    continue
-
-            # check if any jobs have all of their dependencies met, if so, change to pending
-            if len(j.get('depends', [])) != 0:
-                # check if all dependencies are met
-                if all([(djn in jobs) and (jobs[djn]['state'] == JobState.SUCCESS) for djn in j['depends']]):
-                    self.change_job_state(smqc, jn, JobState.PENDING, 'Dependencies Ready')
-
-            # process cron jobs
-            if process_cron:
-                if 'next_cron_fire_time' in j:
-                    if cron_time > j['next_cron_fire_time']:
-                        self._update_next_cron_fire_time(jn, cron_time)
-                        self.change_job_state(smqc, jn, JobState.PENDING, 'cron fire time')
-
-        # loop through all of the jobs to set dependencies of jobs that are PENDING to IDLE
-        loop_again = True
-        while loop_again:
-            loop_again = False
-            for jn, j in jobs.items():
-                if j['state'] == JobState.SUCCESS or j['state'] == JobState.FAILURE:
-                    if any([(djn in jobs) and (jobs[djn]['state'] == JobState.PENDING) for djn in j['depends']]):
-                        self.change_job_state(smqc, jn, JobState.IDLE, 'Parent went to pending')
-                        loop_again = True
-
-        # execute any pending jobs
-        for jn, j in jobs.items():
-            if j['state'] == JobState.PENDING:
-                self.change_job_state(smqc, jn, JobState.RUNNING, 'pending')
-                self._run_job_in_separate_process(
-                    smqc=smqc, FC_target_id=self.get_config_prop('uid'), job_name=jn,
-                    cwd=os.path.join(os.path.dirname(os.path.abspath(self._config_filename))),
-                    run_cmd=self._cfg['jobs'][jn].get('run_cmd', None),
-                    log_filename=self.get_log_filename(jn),
-                    success_email_recipients=self._cfg['jobs'][jn].get('success_email_recipients', None),
-                    failure_email_recipients=self._cfg['jobs'][jn].get('failure_email_recipients', None),
-                    success_slack_webhook=self._cfg['jobs'][jn].get('success_slack_webhook', None),
-                    failure_slack_webhook=self._cfg['jobs'][jn].get('failure_slack_webhook', None))
-
-    def reload_config(self, smqc):
-        """ reload the config and broadcast a config_changed message """
         # read the config file
-        self._cfg = FlowController_util.read_cfg_file(self._config_filename)
+        cfg = FlowController_util.read_cfg_file(self._config_filename, force=force)
+        self._cfg_signature = signature
 
         for k, v in self._config_override.items():
             if v is not None:
-                logging.info(f'Overriding {k} in config.  Old value was {self._cfg.get(k, "?")}, new value is {v}')
-                self._cfg[k] = v
+                logging.info(f'Overriding {k} in config.  Old value was {cfg.get(k, "?")}, new value is {v}')
+                cfg[k] = v
+        job_definitions = copy.deepcopy(cfg['jobs'])
+        self._pools.configure(cfg['max_concurrent_jobs'], cfg['pools'])
+        self._supervisor.flush_interval = cfg['log_changed_interval']
+        self._notifier.configure(cfg['smtp_server'], cfg['email_sender'], cfg['notification_digest_interval'])
+
+        # apply the difference if nothing changed which the jobs or the ledger depend on
+        if not force and self._cfg is not None:
+            changed_keys = set(k for k in set(cfg) | set(self._cfg)
+                               if k != 'jobs' and cfg.get(k, None) != self._cfg.get(k, None))
+            if changed_keys.issubset(self.LIVE_CFG_KEYS):
+                changes = self._apply_config_diff(cfg, job_definitions)
+                if not any(changes.values()) and not changed_keys:
+                    return {'retval': 0}
+                self.wakeup()
+
+                # broadcast config_changed with the change set
+                if smqc is not None:
+                    payload = self._build_config_changed_payload(changes, len(changed_keys) > 0)
+                    self._send_message(smqc, 'config_changed', '*', payload)
+                return dict(changes, retval=0)
 
         # set all job states to idle, setup the next cron fire time, and inject email addresses
+        self._cfg = cfg
+        self._job_definitions = job_definitions
         cron_base = datetime.datetime.now()
+        with self._scheduler_lock:
+            self._cron_heap = []
         for jn, j in self._cfg['jobs'].items():
             j['state'] = JobState.IDLE
             if 'cron' in j:
                 self._update_next_cron_fire_time(jn, cron_base)
-            j['success_email_recipients'] = j.get('success_email_recipients', self._cfg['success_email_recipients'])
-            j['failure_email_recipients'] = j.get('failure_email_recipients', self._cfg['failure_email_recipients'])
-            j['success_slack_webhook'] = j.get('success_slack_webhook', self._cfg['success_slack_webhook'])
-            j['failure_slack_webhook'] = j.get('failure_slack_webhook', self._cfg['failure_slack_webhook'])
+            self._apply_job_defaults(self._cfg, j)
 
-        # load the states from the ledger
+        # load the states from the ledger, the ledger keeps the latest state of every job so this is O(jobs)
         try:
             self._ledger_lock.acquire()
-            df = FlowController_util.FlowControllerLedger.read(self._cfg['ledger_dir'], self._cfg['uid'])
-            for _, r in df.iterrows():
-                if r['job_name'] in self._cfg['jobs']:
-                    self._cfg['jobs'][r['job_name']]['state'] = JobState[r['state']]
+            ledger_key = (self._cfg['ledger_dir'], self._cfg['uid'])
+            if self._ledger is None or self._ledger_key != ledger_key:
+                if self._ledger is not None:
+                    self._ledger.close()
+                self._ledger = FlowController_util.FlowControllerBinaryLedger(*ledger_key)
+                self._ledger_key = ledger_key
+            self._ledger.open()
+            for jn, state in self._ledger.get_states().items():
+                if jn in self._cfg['jobs']:
+                    self._cfg['jobs'][jn]['state'] = JobState[state]
         finally:
             self._ledger_lock.release()
 
+        # rebuild the dependency index from the restored states
+        with self._scheduler_lock:
+            self._build_dependency_index()
+            self._mark_config_changed()
+        self.wakeup()
+
         # broadcast config_changed
         if smqc is not None:
-            smqc.send_message(smqc.construct_msg('config_changed', '*', {}))
+            self._send_message(smqc, 'config_changed', '*', {'full': True})
 
         # success
         return {'retval': 0}
 
+    def shutdown(self):
+        """ stop supervising jobs, send queued notifications and close the ledger, running job processes are left
+            running """
+        self._supervisor.stop()
+        self._notifier.stop(timeout=self.NOTIFIER_SHUTDOWN_TIMEOUT)
+        with self._ledger_lock:
+            if self._ledger is not None:
+                self._ledger.close()
+
     def trigger_job(self, smqc, job_name, reason):
         """ trigger a job
 
@@ -314,27 +816,83 @@ class JobManager():
         self.change_job_state(smqc, job_name, JobState.PENDING, reason)
         return {'retval': 0}
 
+    def wait_for_work(self, max_wait=MAX_IDLE_WAIT):
+        """ block until a job state changes, wakeup is called, or the next cron fire time or midnight is reached
+
+            Args:
+                max_wait - maximum number of seconds to block
+        """
+        timeout = (self.get_next_wakeup_time() - datetime.datetime.now()).total_seconds()
+        self._wakeup_event.wait(min(max(timeout, 0), max_wait))
+
+    def wakeup(self):
+        """ wake up a thread blocked in wait_for_work """
+        self._wakeup_event.set()
+
 
 class FlowController():
     def __init__(self, config_filename, config_overrides={}):
         """ init """
         self._shutdown = False
         self._job_manager = JobManager(config_filename, config_overrides)
+        self._message_handlers = self._build_message_handlers()
+        self._metrics_server = None
+
+        # gauges are read when the metrics are collected so the scheduler pays nothing to keep them current
+        jm = self._job_manager
+        FlowController_metrics.REGISTRY.gauge('flowcontroller_pending_jobs',
+                                              'PENDING jobs waiting for a free slot in the execution pools',
+                                              lambda: jm.get_pool_stats()['queued'])
+        FlowController_metrics.REGISTRY.gauge('flowcontroller_running_jobs', 'jobs which are running',
+                                              lambda: jm.get_pool_stats()['running'])
 
     def _build_smq_client(self):
         client_uid = self.get_client_id()
         classifications = ['FlowController', client_uid]
         pub_list = ['change_job_state', 'config_changed', 'job_log_changed', 'job_state_changed']
-        sub_list = ['change_job_state', 'ping', 'reload_config', 'request_config', 'request_icon', 'request_log_chunk',
-                    'trigger_job']
+        sub_list = ['change_job_state', 'kill_job', 'ping', 'reload_config', 'request_batch', 'request_config',
+                    'request_config_if_changed', 'request_icon', 'request_job_pids', 'request_log_chunk',
+                    'request_log_range', 'request_log_tail', 'request_metrics', 'request_profile', 'trigger_job']
         return SMQ_Client(self._job_manager.get_config_prop('smq_server'), client_uid, client_uid, classifications,
                           pub_list, sub_list, tag={'title': self._job_manager.get_config_prop('title')})
 
+    def _build_message_handlers(self):
+        """ return a dict of action to the function which handles a message with that action, each timed in the
+            flowcontroller_message_handler_seconds metric and sampled as a section when profiling """
+        jm = self._job_manager
+        handlers = {
+            'change_job_state': lambda msg, smqc: jm.change_job_state(smqc, msg['payload']['job_name'],
+                                                                      JobState[msg['payload']['new_state']],
+                                                                      msg['payload']['reason']),
+            'kill_job': lambda msg, smqc: jm.kill_job(smqc, msg['payload']['job_name']),
+            'ping': lambda _msg, _smqc: {'retval': 0},
+            'reload_config': lambda msg, smqc: jm.reload_config(smqc, msg['payload'].get('force', False)),
+            'request_batch': self._handle_request_batch,
+            'request_config': lambda msg, smqc: jm.get_config_snapshot(smqc, msg['payload'].get('serialized', False)),
+            'request_config_if_changed': lambda msg, smqc: jm.get_config_snapshot_if_changed(
+                smqc, msg['payload'].get('version'), msg['payload'].get('serialized', False)),
+            'request_icon': lambda _msg, smqc: jm.get_icon(smqc),
+            'request_job_pids': lambda _msg, smqc: jm.get_job_pids(smqc),
+            'request_log_chunk': lambda msg, smqc: jm.get_log_chunk(smqc, msg['payload']['job_name'],
+                                                                    msg['payload']['range']),
+            'request_log_range': lambda msg, smqc: jm.get_log_range(smqc, msg['payload']['job_name'],
+                                                                    msg['payload']['offset'],
+                                                                    msg['payload']['length']),
+            'request_log_tail': lambda msg, smqc: jm.get_log_tail(smqc, msg['payload']['job_name'],
+                                                                  msg['payload'].get('offset', None)),
+            'request_metrics': lambda _msg, smqc: jm.get_metrics(smqc),
+            'request_profile': self._handle_request_profile,
+            'trigger_job': lambda msg, smqc: jm.trigger_job(smqc, msg['payload']['job_name'],
+                                                            msg['payload']['reason']),
+        }
+        return {action: self._time_handler(action, handler) for action, handler in handlers.items()}
+
     def build_smq_terminal_client(self):
         client_uid = 'FC_TERM_' + uuid.uuid4().hex
         classifications = ['FlowController_Terminal']
-        pub_list = ['change_job_state', 'ping', 'reload_config', 'request_config', 'request_icon', 'request_log_chunk',
-                    'trigger_job']
+        pub_list = ['change_job_state', 'kill_job', 'ping', 'reload_config', 'request_batch', 'request_config',
+                    'request_config_if_changed', 'request_icon', 'request_job_pids', 'request_log_chunk',
+                    'request_log_range', 'request_log_tail', 'request_metrics', 'request_profile', 'trigger_job']
         sub_list = []
         return SMQ_Client(self._job_manager.get_config_prop('smq_server'), client_uid, client_uid, classifications,
                           pub_list, sub_list, tag={'title': self._job_manager.get_config_prop('title')})
@@ -342,6 +900,43 @@ class FlowController():
     def get_client_id(self):
         return self._job_manager.get_config_prop('uid')
 
+    def _handle_request_batch(self, msg, smqc):
+        """ handle several requests sent as one message so the caller pays for one round trip.  The requests are
+            handled in order and a failed request does not stop the ones after it
+
+            Args:
+                msg - message with a payload of {'requests': [{'action': action, 'payload': payload}, ...]}
+                smqc - SMQ_Client
+
+            Returns:
+                {'retval': 0, 'responses': list with the response to each request}
+        """
+        responses = []
+        for r in msg['payload']['requests']:
+            handler = self._message_handlers.get(r['action'], None)
+            if handler is None or r['action'] == 'request_batch':
+                responses.append({'retval': 1, 'error': f'Action {r["action"]} can not be batched'})
+                continue
+            try:
+                responses.append(handler(dict(msg, action=r['action'], payload=r.get('payload', {})), smqc))
+            except Exception as e:
+                logging.exception(e)
+                responses.append({'retval': 1, 'error': str(e)})
+        return {'retval': 0, 'responses': responses}
+
+    def _handle_request_profile(self, msg, _smqc):
+        """ start or stop profiling, see FlowController_profile.SamplingProfiler.handle_request """
+        return FlowController_profile.PROFILER.handle_request(msg['payload'],
+                                                              self._job_manager.get_config_prop('profile_dir'),
+                                                              self.get_client_id())
+
+    @staticmethod
+    def _time_handler(action, handler):
+        def timed_handler(msg, smqc):
+            with MESSAGE_HANDLER_SECONDS.time(action), FlowController_profile.PROFILER.section(action):
+                return handler(msg, smqc)
+        return timed_handler
+
     def _main_loop(self, smqc):
         try:
             signal.signal(signal.SIGTERM, lambda _a, _b: self.stop())
@@ -349,10 +944,20 @@ class FlowController():
         except ValueError as e:
             logging.info(e)
 
+        # process jobs only when woken by a state change, a message, or a cron / midnight deadline
         while not self._shutdown:
-            self._job_manager.process_jobs(smqc)
-            time.sleep(0.1)
-
+            # an error in one pass must not stop the scheduling while the SMQ client keeps answering messages
+            try:
+                with FlowController_profile.PROFILER.section('process_jobs'):
+                    self._job_manager.process_jobs(smqc)
+            except Exception as e:
+                logging.exception(e)
+            self._job_manager.wait_for_work()
+
+        self._job_manager.shutdown()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+        FlowController_profile.PROFILER.stop()
         smqc.stop()
 
     def list(self):
@@ -360,8 +965,13 @@ class FlowController():
         all_client_info = client.get_info_for_all_clients()
         return all_client_info
 
-    def start(self):
-        """ start the flow controller """
+    def start(self, profile=False):
+        """ start the flow controller
+
+            Args:
+                profile - sample the scheduler loop and the message handlers and trace allocations from the start,
+                          writing the profiles to profile_dir.  Can also be toggled with the request_profile action
+        """
         client = self.build_smq_terminal_client()
         all_client_info = client.get_info_for_all_clients()
 
@@ -373,27 +983,26 @@ class FlowController():
 
         # start the SMQ_Client
         client = self._build_smq_client()
-        client.add_message_handler('change_job_state', lambda msg, smqc:
-                                   self._job_manager.change_job_state(smqc, msg['payload']['job_name'],
-                                                                      JobState[msg['payload']['new_state']],
-                                                                      msg['payload']['reason']))
-        client.add_message_handler('ping', lambda _msg, _smqc: {'retval': 0})
-        client.add_message_handler('reload_config', lambda _msg, smqc: self._job_manager.reload_config(smqc))
-        client.add_message_handler('request_config', lambda _msg, smqc: self._job_manager.get_config_snapshot(smqc))
-        client.add_message_handler('request_icon', lambda _msg, smqc: self._job_manager.get_icon(smqc))
-        client.add_message_handler('request_log_chunk', lambda msg, smqc:
-                                   self._job_manager.get_log_chunk(smqc, msg['payload']['job_name'],
-                                                                   msg['payload']['range']))
-        client.add_message_handler('trigger_job', lambda msg, smqc:
-                                   self._job_manager.trigger_job(smqc, msg['payload']['job_name'],
-                                                                 msg['payload']['reason']))
+        for action, handler in self._message_handlers.items():
+            client.add_message_handler(action, handler)
         client.start()
 
+        # serve the metrics over http if a port is configured
+        if self._job_manager.get_config_prop('metrics_port') is not None:
+            self._metrics_server = FlowController_metrics.start_http_server(
+                int(self._job_manager.get_config_prop('metrics_port')))
+
+        # profile from the start if requested
+        if profile:
+            FlowController_profile.PROFILER.start(self._job_manager.get_config_prop('profile_dir'),
+                                                  self.get_client_id())
+
         # start the main loop
         self._main_loop(client)
 
     def stop(self):
         self._shutdown = True
+        self._job_manager.wakeup()
 
 
 # --------------------------------------------------
@@ -414,9 +1023,16 @@ def run(args):
         if not os.path.exists(FC._job_manager.get_config_prop('job_logs_dir')):
             os.makedirs(FC._job_manager.get_config_prop('job_logs_dir'))
 
+        # export the ledger if requested, the ledger files are read directly so no Flow Controller needs to be running
+        if args.get('export_ledger_csv', None) is not None:
+            ledger = FlowController_util.FlowControllerBinaryLedger(FC._job_manager.get_config_prop('ledger_dir'),
+                                                                    FC.get_client_id())
+            ledger.export_csv(args['export_ledger_csv'], args.get('date', None))
+            return args['export_ledger_csv']
+
         # start the server if requested
         if args.get('start', False):
-            return FC.start()
+            return FC.start(profile=args.get('profile', False))
 
         # build a terminal client
         client = FC.build_smq_terminal_client()
@@ -446,10 +1062,25 @@ def run(args):
         if args.get('action', None) is not None:
             if args['action'] == 'change_job_state':
                 payload = {'job_name': args['job_name'], 'new_state': args['new_state'], 'reason': 'terminal'}
-            if args['action'] in ('ping', 'reload_config', 'request_config', 'request_icon'):
+            if args['action'] == 'kill_job':
+                payload = {'job_name': args['job_name']}
+            if args['action'] in ('ping', 'request_config', 'request_icon', 'request_job_pids', 'request_metrics'):
                 payload = {}
+            if args['action'] == 'reload_config':
+                payload = {'force': args.get('force', False)}
+            if args['action'] == 'request_batch':
+                payload = {'requests': json.loads(args['batch'])}
+            if args['action'] == 'request_config_if_changed':
+                payload = {'version': args.get('config_version', None)}
             if args['action'] == 'request_log_chunk':
                 payload = {'job_name': args['job_name'], 'range': args['log_range']}
+            if args['action'] == 'request_log_range':
+                payload = {'job_name': args['job_name'], 'offset': args.get('log_offset', None) or 0,
+                           'length': args.get('log_length', None) or MAX_LOG_CHUNK_SIZE}
+            if args['action'] == 'request_log_tail':
+                payload = {'job_name': args['job_name'], 'offset': args.get('log_offset', None)}
+            if args['action'] == 'request_profile':
+                payload = {'enable': {'on': True, 'off': False}.get(args.get('profile_state', None), None)}
             if args['action'] == 'trigger_job':
                 payload = {'job_name': args['job_name'], 'reason': 'terminal'}
 
@@ -472,15 +1103,39 @@ def console_entry():
         parser.add_argument('--status', action='store_true', help='show the status of jobs in the config')
         parser.add_argument('--list', action='store_true', help='list running Flow Controllers on the same ' +
                                                                 'bus as the config')
-        parser.add_argument('--action', choices=['change_job_state', 'ping', 'reload_config', 'request_config',
-                                                 'request_icon', 'request_log_chunk', 'trigger_job'],
+        parser.add_argument('--profile', action='store_true', help='profile the Flow Controller, only used with ' +
+                                                                   '--start.  see profile_dir in the config')
+        parser.add_argument('--action', choices=['change_job_state', 'kill_job', 'ping', 'reload_config',
+                                                 'request_batch', 'request_config', 'request_config_if_changed',
+                                                 'request_icon', 'request_job_pids', 'request_log_chunk',
+                                                 'request_log_range', 'request_log_tail', 'request_metrics',
+                                                 'request_profile', 'trigger_job'],
                                                  help='perform an action on the Flow Controller running the config')
+        parser.add_argument('--export_ledger_csv', metavar='FILE', help='export the ledger of the config to a csv ' +
+                                                                        'file in the format of the csv ledger')
+        parser.add_argument('--date', help='date of the ledger to export in YYYYMMDD format, default is today.  ' +
+                                           'only used with --export_ledger_csv')
         parser.add_argument('--job_name', help='job name to perform the action on')
         parser.add_argument('--new_state', help='new state of the job, only used with the change_job_state ' +
                                                 'action')
         parser.add_argument('--log_range', help='character range of the log to return, i.e. 0:1000 for the ' +
                                                 'first 1000 characters.  only used with the request_log_chunk ' +
                                                 'action', default='')
+        parser.add_argument('--log_offset', type=int, help='byte offset in the log to start reading at.  only used ' +
+                                                           'with the request_log_range and request_log_tail actions, ' +
+                                                           'request_log_tail returns the end of the log if not set')
+        parser.add_argument('--log_length', type=int, help='number of bytes of the log to return.  only used with ' +
+                                                           'the request_log_range action')
+        parser.add_argument('--config_version', help='version of the config the caller already has.  only used ' +
+                                                     'with the request_config_if_changed action')
+        parser.add_argument('--batch', help='json list of requests, each {"action": action, "payload": payload}.  ' +
+                                            'only used with the request_batch action')
+        parser.add_argument('--profile_state', choices=['on', 'off'], help='turn profiling on or off instead of ' +
+                                                                           'toggling it.  only used with the ' +
+                                                                           'request_profile action')
+        parser.add_argument('--force', action='store_true', help='reload the config and reset job states even if ' +
+                                                                 'the config file did not change.  only used with ' +
+                                                                 'the reload_config action')
         parser.add_argument('--logging_level', default='ERROR')
         parser.add_argument('--override_smq_server', help='override the sqm_server value in the config file')
         parser.add_argument('--override_ledger_dir', help='override the ledger_dir value in the config file')
@@ -494,6 +1149,9 @@ def console_entry():
                             help='override the success_slack_webhook value in the config file')
         parser.add_argument('--override_failure_slack_webhook',
                             help='override the failure_slack_webhook value in the config file')
+        parser.add_argument('--override_metrics_port', type=int,
+                            help='override the metrics_port value in the config file')
+        parser.add_argument('--override_profile_dir', help='override the profile_dir value in the config file')
 
         args = parser.parse_args()
 
@@ -0,0 +1,196 @@
+import bisect
+import contextlib
+import http.server
+import logging
+import math
+import threading
+import time
+
+
+# default histogram buckets in seconds, from 100us to 60s
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+
+def _format_value(v):
+    if math.isinf(v):
+        return '+Inf' if v > 0 else '-Inf'
+    return repr(float(v))
+
+
+class Counter():
+    """ monotonically increasing count, optionally split by labels """
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        """ add amount to the count of the label values """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        """ return a list of (name, labels, value) for every label value """
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, lv)), v) for lv, v in sorted(self._values.items())]
+
+
+class Gauge():
+    """ value read from a callback when the metrics are collected, so keeping it current costs nothing """
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+
+    def samples(self):
+        """ return a list with one (name, labels, value) """
+        try:
+            return [(self.name, {}, float(self.fn()))]
+        except Exception as e:
+            logging.exception(e)
+            return []
+
+
+class Histogram():
+    """ distribution of observed values in cumulative buckets, optionally split by labels """
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values to [count per bucket with the last one for values above all buckets, count, sum]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        """ record one observation for the label values """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(label_values, None)
+            if v is None:
+                v = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            v[0][i] += 1
+            v[1] += 1
+            v[2] += value
+
+    def samples(self):
+        """ return a list of (name, labels, value) for the buckets, count and sum of every label value """
+        with self._lock:
+            values = [(lv, list(v[0]), v[1], v[2]) for lv, v in sorted(self._values.items())]
+        samples = []
+        for lv, bucket_counts, count, total in values:
+            labels = dict(zip(self.labelnames, lv))
+            cumulative = 0
+            for le, n in zip(self.buckets + (math.inf, ), bucket_counts):
+                cumulative += n
+                samples.append((self.name + '_bucket', dict(labels, le=_format_value(le)), cumulative))
+            samples.append((self.name + '_count', labels, count))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """ context manager which observes the seconds its body takes """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+
+class MetricsRegistry():
+    """ named collection of metrics which can be rendered in the Prometheus text format """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            m = self._metrics.get(name, None)
+            if m is None:
+                m = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(m, cls):
+                raise Exception(f'Metric {name} is already registered as a {type(m).__name__}')
+            return m
+
+    def counter(self, name, help_text, labelnames=()):
+        """ return the counter with the name, registering it if it does not exist """
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, fn):
+        """ register a gauge read from fn, replacing the callback of an existing gauge with the name """
+        g = self._get_or_create(Gauge, name, help_text, fn)
+        g.fn = fn
+        return g
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """ return the histogram with the name, registering it if it does not exist """
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets)
+
+    def get_samples(self):
+        """ return a list of dicts with the name, labels and value of every sample, for the request_metrics action """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        # values are floats because xmlrpc can not marshal integers over 32 bits
+        return [{'name': n, 'labels': labels, 'value': float(v)} for m in metrics for n, labels, v in m.samples()]
+
+    def render_prometheus(self):
+        """ return all of the metrics in the Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            metric_type = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(m)]
+            lines.append(f'# HELP {m.name} {m.help_text}')
+            lines.append(f'# TYPE {m.name} {metric_type}')
+            for n, labels, v in m.samples():
+                lines.append(f'{n}{_format_labels(labels)} {_format_value(v)}')
+        return '\n'.join(lines) + '\n'
+
+
+# process wide registry which the FlowController and the webapp record their metrics in
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host='', registry=REGISTRY):
+    """ serve the metrics of a registry at /metrics in the Prometheus text format from a background thread
+
+        Args:
+            port - port to listen on, 0 for any free port
+            host - address to listen on, default is all addresses
+            registry - registry to serve
+
+        Returns:
+            the http server, call shutdown to stop it
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='MetricsHTTPServer', daemon=True).start()
+    logging.info(f'Serving metrics at http://{host or "0.0.0.0"}:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,284 @@
+from email.message import EmailMessage
+import heapq
+import itertools
+import json
+import logging
+import smtplib
+import threading
+import time
+try:
+    import FlowController.FlowController_metrics as FlowController_metrics
+except:
+    import FlowController_metrics
+
+
+NOTIFICATION_LATENCY_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_notification_latency_seconds', 'seconds from queueing a notification until it was sent', ('kind', ),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+NOTIFICATION_FAILURES = FlowController_metrics.REGISTRY.counter(
+    'flowcontroller_notification_failures_total', 'notification sends which failed and were retried or dropped',
+    ('kind', 'outcome'))
+
+
+class NotificationDispatcher():
+    """ sends email and slack notifications from a background thread so job bookkeeping is never delayed by a slow
+        mail relay or webhook.  One SMTP connection and one HTTP session are kept open and reused for all
+        notifications, failed sends are retried with exponential backoff, and notifications to the same recipients
+        can be combined into one digest per time window.
+
+        cfg keys
+            smtp_server                  - host[:port] of the mail relay, default is localhost
+            email_sender                 - From address of notification emails
+            notification_digest_interval - seconds over which notifications to the same recipients or webhook are
+                                           combined into one digest, default is 0 which sends each one immediately
+    """
+    # seconds before the first retry of a failed send, doubled for every following retry
+    RETRY_BACKOFF = 1.0
+    # maximum number of attempts to send a notification before it is dropped
+    MAX_ATTEMPTS = 5
+    # seconds an unused SMTP connection is kept open
+    SMTP_IDLE_TIMEOUT = 30
+    # seconds to wait for the mail relay or webhook to answer
+    SEND_TIMEOUT = 30
+
+    def __init__(self, smtp_server='localhost', email_sender=None, digest_interval=0):
+        self._cond = threading.Condition()
+        self._digests = {}
+        self._digest_interval = 0
+        self._email_sender = None
+        self._http_session = None
+        self._in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._shutdown = False
+        self._smtp = None
+        self._smtp_connected_server = None
+        self._smtp_last_used = 0
+        self._smtp_server = None
+        self._thread = None
+        self.configure(smtp_server, email_sender, digest_interval)
+
+    def _close_smtp(self):
+        smtp, self._smtp = self._smtp, None
+        self._quit_smtp(smtp)
+
+    def _enqueue(self, kind, key, subject, body):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._threadworker_dispatch, name='NotificationDispatcher',
+                                                daemon=True)
+                self._thread.start()
+            if self._digest_interval > 0:
+                # the first notification opens the window, the rest join the digest which is sent when it closes
+                if (kind, key) not in self._digests:
+                    self._digests[(kind, key)] = []
+                    self._push(time.time() + self._digest_interval, ('digest', kind, key, time.time()))
+                self._digests[(kind, key)].append((subject, body))
+            else:
+                self._push(time.time(), ('send', kind, key, subject, body, 0, time.time()))
+            self._cond.notify()
+
+    def _push(self, due, item):
+        """ queue an item to be processed at time due.  Must hold the condition """
+        heapq.heappush(self._queue, (due, next(self._seq), item))
+
+    def _get_smtp(self):
+        """ return the open SMTP connection to the current relay, connecting if there is none """
+        if self._smtp is not None and self._smtp_connected_server != self._smtp_server:
+            self._close_smtp()
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._smtp_server, timeout=self.SEND_TIMEOUT)
+            self._smtp_connected_server = self._smtp_server
+        return self._smtp
+
+    def _send(self, kind, key, subject, body):
+        if kind == 'email':
+            self._send_email_now(key, subject, body)
+        else:
+            self._send_slack_now(key, subject)
+
+    def _send_email_now(self, recipients, subject, body):
+        msg = EmailMessage()
+        msg.set_content(body)
+        msg['Subject'] = subject
+        msg['From'] = self._email_sender or ''
+        msg['To'] = recipients
+        logging.info(f'SENDING EMAIL! {self._smtp_server} {subject} {recipients}')
+
+        # reuse the open connection, reconnecting once if the relay closed it while it was idle
+        reused = self._smtp is not None
+        try:
+            try:
+                self._get_smtp().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                self._smtp = None
+                self._get_smtp().send_message(msg)
+        except Exception as _:
+            self._close_smtp()
+            raise
+        self._smtp_last_used = time.time()
+
+    def _send_slack_now(self, webhook_url, text):
+        if self._http_session is None:
+            # requests is slow to import and only needed here, keep it out of CLI startup
+            import requests
+            self._http_session = requests.Session()
+        response = self._http_session.post(webhook_url, data=json.dumps({'text': text}),
+                                           headers={'Content-Type': 'application/json'}, timeout=self.SEND_TIMEOUT)
+        if response.status_code != 200:
+            logging.error(response.status_code)
+            logging.error(response.text)
+            # client errors other than rate limiting will not succeed on a retry
+            if response.status_code >= 500 or response.status_code == 429:
+                raise Exception(f'Slack webhook returned {response.status_code}')
+
+    def _threadworker_dispatch(self):
+        while True:
+            item = None
+            # connection to close after the condition is released, quitting a hung relay can take SEND_TIMEOUT and
+            # must not block _enqueue which is called from the thread supervising the jobs
+            stale_smtp = None
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._queue and (self._queue[0][0] <= now or self._shutdown):
+                        _, _, item = heapq.heappop(self._queue)
+                        break
+                    if self._shutdown:
+                        stale_smtp, self._smtp = self._smtp, None
+                        self._cond.notify_all()
+                        break
+                    if not self._queue:
+                        # wake up flush
+                        self._cond.notify_all()
+
+                    # close the SMTP connection once it has been idle for a while
+                    timeout = None
+                    if self._smtp is not None:
+                        idle_deadline = self._smtp_last_used + self.SMTP_IDLE_TIMEOUT
+                        if idle_deadline <= now:
+                            stale_smtp, self._smtp = self._smtp, None
+                            break
+                        timeout = idle_deadline - now
+                    if self._queue:
+                        timeout = self._queue[0][0] - now if timeout is None else min(timeout, self._queue[0][0] - now)
+                    self._cond.wait(timeout)
+
+                if item is not None:
+                    if item[0] == 'digest':
+                        _, kind, key, queued_time = item
+                        entries = self._digests.pop((kind, key))
+                        item = ('send', kind, key) + self._combine_digest(kind, entries) + (0, queued_time)
+                    self._in_flight += 1
+
+            self._quit_smtp(stale_smtp)
+            if item is None:
+                if self._shutdown:
+                    return
+                continue
+
+            _, kind, key, subject, body, attempt, queued_time = item
+            try:
+                self._send(kind, key, subject, body)
+                NOTIFICATION_LATENCY_SECONDS.observe(time.time() - queued_time, kind)
+            except Exception as e:
+                attempt += 1
+                with self._cond:
+                    if attempt < self.MAX_ATTEMPTS and not self._shutdown:
+                        logging.warning(f'Sending {kind} notification to {key} failed, attempt {attempt}: {e}')
+                        NOTIFICATION_FAILURES.inc(1, kind, 'retried')
+                        self._push(time.time() + self.RETRY_BACKOFF * 2 ** (attempt - 1),
+                                   ('send', kind, key, subject, body, attempt, queued_time))
+                    else:
+                        NOTIFICATION_FAILURES.inc(1, kind, 'dropped')
+                        logging.exception(e)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+
+    @staticmethod
+    def _quit_smtp(smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception as _:
+                pass
+
+    @staticmethod
+    def _combine_digest(kind, entries):
+        """ combine a list of (subject, body) into the subject and body of one notification """
+        if len(entries) == 1:
+            return entries[0]
+        if kind == 'slack':
+            return '\n'.join(s for s, _ in entries), None
+        subject = f'{len(entries)} notifications: ' + ', '.join(s for s, _ in entries)
+        if len(subject) > 200:
+            subject = subject[:197] + '...'
+        body = '\n\n'.join(f'{s}\n-----\n{b}' for s, b in entries)
+        return subject, body
+
+    def configure(self, smtp_server, email_sender, digest_interval):
+        """ set the mail relay, the sender address and the digest window
+
+            Args:
+                smtp_server - host[:port] of the mail relay
+                email_sender - From address of notification emails
+                digest_interval - seconds over which notifications to the same recipients are combined, 0 for none
+        """
+        with self._cond:
+            # the dispatch thread reconnects on the next send if the relay changed
+            self._smtp_server = smtp_server
+            self._email_sender = email_sender
+            self._digest_interval = digest_interval or 0
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        """ send all queued notifications including open digests and pending retries now, and wait until they are
+            sent or dropped after MAX_ATTEMPTS
+
+            Returns:
+                True if the queue was empty before the timeout
+        """
+        with self._cond:
+            self._queue = [(0, seq, item) for _, seq, item in self._queue]
+            heapq.heapify(self._queue)
+            self._cond.notify_all()
+            if self._thread is None:
+                return True
+            return self._cond.wait_for(lambda: not self._queue and self._in_flight == 0, timeout)
+
+    def send_email(self, subject, body, recipients):
+        """ queue an email
+
+            Args:
+                subject - subject of the email
+                body - text of the email
+                recipients - comma separated email addresses, nothing is sent if empty
+        """
+        if recipients is None or recipients.strip() == '':
+            logging.info('NOT SEND SENDING EMAIL!')
+            return
+        self._enqueue('email', recipients, subject, body)
+
+    def send_slack(self, text, webhook_url):
+        """ queue a slack message
+
+            Args:
+                text - text of the message
+                webhook_url - url of the slack incoming webhook, nothing is sent if None
+        """
+        if webhook_url is None:
+            logging.info('NOT SENDING SLACK because webhook_url is not set')
+            return
+        self._enqueue('slack', webhook_url, text, None)
+
+    def stop(self, timeout=None):
+        """ send open digests and queued notifications without waiting for retries, then close the connections """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
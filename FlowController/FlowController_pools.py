@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import logging
+import threading
+
+
+class ExecutionPools():
+    """ admission control for job execution.  Limits the number of jobs running at once, both globally and per named
+        pool, and hands out queued jobs in priority order.  Jobs which can not run yet stay queued.
+
+        cfg keys
+            max_concurrent_jobs - maximum number of jobs running at once across all pools, default is unlimited
+            pools               - dict of pool name to the maximum number of jobs running at once in that pool
+
+        job keys
+            pool                - name of the pool the job runs in, default is 'default'
+            priority            - queued jobs with a higher priority run first, default is 0
+    """
+    DEFAULT_POOL = 'default'
+
+    def __init__(self, max_concurrent_jobs=None, pool_limits=None):
+        self._lock = threading.Lock()
+        self._max_concurrent_jobs = None
+        self._pool_limits = {}
+        self._queued = {}
+        self._queues = {}
+        self._running = {}
+        self._running_total = 0
+        self._seq = itertools.count()
+        self.configure(max_concurrent_jobs, pool_limits)
+
+    def _has_capacity(self, pool):
+        limit = self._pool_limits.get(pool, None)
+        return limit is None or self._running.get(pool, 0) < limit
+
+    def _discard_stale(self, queue):
+        # drop entries for jobs which were dequeued or re-enqueued since they were pushed
+        while queue and self._queued.get(queue[0][2], None) != queue[0][1]:
+            heapq.heappop(queue)
+
+    def clear_queue(self):
+        """ forget all queued jobs, running jobs keep their slots """
+        with self._lock:
+            self._queued = {}
+            self._queues = {}
+
+    def configure(self, max_concurrent_jobs, pool_limits):
+        """ set the concurrency limits
+
+            Args:
+                max_concurrent_jobs - maximum number of jobs running at once, None for unlimited
+                pool_limits - dict of pool name to the maximum number of jobs running at once in that pool
+        """
+        with self._lock:
+            self._max_concurrent_jobs = max_concurrent_jobs
+            self._pool_limits = dict(pool_limits or {})
+
+    def dequeue(self, job_name):
+        """ remove a job from the queue if it is queued """
+        with self._lock:
+            self._queued.pop(job_name, None)
+
+    def enqueue(self, job_name, pool=None, priority=0):
+        """ queue a job to run
+
+            Args:
+                job_name - name of the job
+                pool - name of the pool to run the job in
+                priority - jobs with a higher priority are handed out first
+        """
+        pool = pool or self.DEFAULT_POOL
+        with self._lock:
+            if job_name in self._queued:
+                return
+            if pool not in self._pool_limits and pool != self.DEFAULT_POOL:
+                logging.warning(f'Job {job_name} uses pool {pool} which has no limit in the config')
+            seq = next(self._seq)
+            self._queued[job_name] = seq
+            heapq.heappush(self._queues.setdefault(pool, []), (-priority, seq, job_name))
+
+    def get_stats(self):
+        """ return the number of queued and running jobs """
+        with self._lock:
+            return {'queued': len(self._queued), 'running': self._running_total,
+                    'running_per_pool': dict(self._running)}
+
+    def pop_runnable(self):
+        """ take as many queued jobs as the limits allow, highest priority first, and reserve a slot for each
+
+            Returns:
+                list of (job_name, pool) tuples, release must be called for each one when the job finishes
+        """
+        runnable = []
+        with self._lock:
+            while self._max_concurrent_jobs is None or self._running_total < self._max_concurrent_jobs:
+                # pick the best head of queue among the pools with a free slot
+                best = None
+                for pool, queue in self._queues.items():
+                    self._discard_stale(queue)
+                    if queue and self._has_capacity(pool):
+                        if best is None or queue[0] < self._queues[best][0]:
+                            best = pool
+                if best is None:
+                    break
+
+                _, _, job_name = heapq.heappop(self._queues[best])
+                del self._queued[job_name]
+                self._running[best] = self._running.get(best, 0) + 1
+                self._running_total += 1
+                runnable.append((job_name, best))
+        return runnable
+
+    def release(self, pool):
+        """ give back the slot reserved by pop_runnable for a job which finished """
+        with self._lock:
+            self._running[pool] = self._running.get(pool, 0) - 1
+            self._running_total -= 1
@@ -0,0 +1,215 @@
+import collections
+import contextlib
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class SamplingProfiler():
+    """ low overhead sampling profiler for diagnosing cpu spikes and memory growth in a running process.  Code marks
+        the sections worth profiling, i.e. one pass of the scheduler loop or the handling of one SMQ message, with
+        the section context manager.  While the profiler runs a background thread samples the stacks of the threads
+        which are inside a section, and allocations are traced with tracemalloc.  Every dump_interval seconds the
+        samples are written as folded stacks which flamegraph.pl and speedscope read, and the largest allocations
+        are written as a text report.  Nothing is sampled while the profiler is stopped
+    """
+    # seconds between stack samples
+    SAMPLE_INTERVAL = 0.01
+    # seconds between dumps of the samples and the allocation report
+    DUMP_INTERVAL = 60
+    # number of frames tracemalloc records for each allocation
+    TRACEMALLOC_FRAMES = 16
+    # number of lines in each section of the allocation report
+    TOP_ALLOCATIONS = 30
+
+    def __init__(self):
+        self._last_snapshot = None
+        self._lock = threading.Lock()
+        self._name = None
+        self._output_dir = None
+        self._samples = collections.Counter()
+        self._sample_count = 0
+        self._sections = {}
+        self._started_tracemalloc = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _dump(self):
+        """ write the samples since the last dump and the allocation report, return the filenames written """
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        with self._lock:
+            samples, self._samples = self._samples, collections.Counter()
+            sample_count, self._sample_count = self._sample_count, 0
+        filenames = []
+
+        if samples:
+            filename = os.path.join(self._output_dir, f'{self._name}_{timestamp}_cpu.folded')
+            with open(filename, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f'{stack} {count}\n')
+            filenames.append(filename)
+
+        if tracemalloc.is_tracing():
+            # leave out the allocations of the profiler itself
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')])
+            current, peak = tracemalloc.get_traced_memory()
+            filename = os.path.join(self._output_dir, f'{self._name}_{timestamp}_allocations.txt')
+            with open(filename, 'w') as f:
+                f.write(f'traced memory {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB, ' +
+                        f'{sample_count} stack samples since the last report\n\n')
+                f.write(f'top {self.TOP_ALLOCATIONS} allocations by line\n')
+                for stat in snapshot.statistics('lineno')[:self.TOP_ALLOCATIONS]:
+                    f.write(f'{stat}\n')
+                if self._last_snapshot is not None:
+                    f.write(f'\ntop {self.TOP_ALLOCATIONS} changes since the last report\n')
+                    for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:self.TOP_ALLOCATIONS]:
+                        f.write(f'{stat}\n')
+                f.write(f'\ntop {self.TOP_ALLOCATIONS} allocations by stack\n')
+                for stat in snapshot.statistics('traceback')[:self.TOP_ALLOCATIONS]:
+                    f.write(f'\n{stat}\n')
+                    for line in stat.traceback.format(most_recent_first=True):
+                        f.write(f'{line}\n')
+            self._last_snapshot = snapshot
+            filenames.append(filename)
+        return filenames
+
+    def _sample(self):
+        """ record the stack of every thread which is inside a section """
+        sections = dict(self._sections)
+        if not sections:
+            return
+        frames = sys._current_frames()
+        stacks = []
+        for ident, section in sections.items():
+            frame = frames.get(ident, None)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            # folded stacks are root first and separated by semicolons, the section is the root
+            stack.append(section)
+            stacks.append(';'.join(reversed(stack)).replace('\n', ' '))
+        with self._lock:
+            self._samples.update(stacks)
+            self._sample_count += 1
+
+    def _threadworker_sample(self, interval, dump_interval):
+        next_dump = time.monotonic() + dump_interval
+        while not self._stop_event.wait(interval):
+            try:
+                self._sample()
+                if time.monotonic() >= next_dump:
+                    next_dump = time.monotonic() + dump_interval
+                    self._dump()
+            except Exception as e:
+                logging.exception(e)
+
+    def get_status(self):
+        """ return a dict with whether the profiler is running and the directory it writes to """
+        return {'profiling': self.is_running(), 'output_dir': self._output_dir}
+
+    def handle_request(self, payload, output_dir, name):
+        """ handle a request_profile message
+
+            Args:
+                payload - {'enable': True to start, False to stop, missing or None to toggle}
+                output_dir - directory to write the profiles to if the profiler is started
+                name - prefix of the filenames of the profiles
+
+            Returns:
+                {'retval': 0, 'profiling': whether the profiler is now running, 'output_dir': directory of the
+                 profiles, 'files': filenames written by the final dump if the profiler was stopped}
+        """
+        enable = payload.get('enable', None)
+        if enable is None:
+            enable = not self.is_running()
+        files = []
+        if enable and not self.is_running():
+            self.start(output_dir, name)
+        elif not enable and self.is_running():
+            files = self.stop()
+        return dict(self.get_status(), retval=0, files=files)
+
+    def is_running(self):
+        return self._thread is not None
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """ context manager marking its body as a section to sample, it does nothing when the profiler is stopped """
+        if self._thread is None:
+            yield
+            return
+        ident = threading.get_ident()
+        outer = self._sections.get(ident, None)
+        self._sections[ident] = name
+        try:
+            yield
+        finally:
+            if outer is None:
+                self._sections.pop(ident, None)
+            else:
+                self._sections[ident] = outer
+
+    def start(self, output_dir, name, interval=None, dump_interval=None):
+        """ start sampling and tracing allocations
+
+            Args:
+                output_dir - directory to write the profiles to, created if it does not exist
+                name - prefix of the filenames of the profiles
+                interval - seconds between stack samples, default is SAMPLE_INTERVAL
+                dump_interval - seconds between dumps, default is DUMP_INTERVAL
+        """
+        if self.is_running():
+            raise Exception('The profiler is already running')
+        os.makedirs(output_dir, exist_ok=True)
+        self._output_dir = output_dir
+        self._name = name
+        self._last_snapshot = None
+        with self._lock:
+            self._samples = collections.Counter()
+            self._sample_count = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._threadworker_sample,
+                                        args=(interval or self.SAMPLE_INTERVAL, dump_interval or self.DUMP_INTERVAL),
+                                        name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        logging.info(f'Profiling to {output_dir}')
+
+    def stop(self):
+        """ stop sampling, write a final dump and stop tracing allocations
+
+            Returns:
+                list of the filenames written by the final dump
+        """
+        if not self.is_running():
+            return []
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self._sections.clear()
+        try:
+            return self._dump()
+        finally:
+            self._last_snapshot = None
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            logging.info(f'Stopped profiling to {self._output_dir}')
+
+
+# process wide profiler which the FlowController and the webapp mark their sections with
+PROFILER = SamplingProfiler()
@@ -0,0 +1,355 @@
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import threading
+import time
+
+
+class JobLogWriter():
+    """ buffered writer for a job log file.  Every line is prefixed with a timestamp in the same format the logging
+        module uses, output goes through a large write buffer which the owner flushes periodically, and only a bounded
+        tail of the output is kept in memory for notifications """
+    BUFFER_SIZE = 1024 * 1024
+    TAIL_SIZE = 64 * 1024
+
+    def __init__(self, filename, tail_size=TAIL_SIZE):
+        self._at_line_start = True
+        self._f = open(filename, 'ab', buffering=self.BUFFER_SIZE)
+        self._size = self._f.tell()
+        self._tail = bytearray()
+        self._tail_size = tail_size
+        self._truncated = False
+
+    def _timestamp_prefix(self):
+        now = datetime.datetime.now()
+        return f"{now.strftime('%Y-%m-%d %H:%M:%S')},{now.microsecond // 1000:03d} ".encode()
+
+    def close(self):
+        """ flush and close the log file """
+        self._f.close()
+
+    def flush(self):
+        """ flush buffered output to the log file """
+        self._f.flush()
+
+    def get_size(self):
+        """ return the size of the log file in bytes including output which is not flushed yet """
+        return self._size
+
+    def get_tail(self):
+        """ return the last tail_size bytes of the job output as a string """
+        s = self._tail.decode(errors='replace')
+        if self._truncated:
+            s = '... output truncated ...\n' + s[s.find('\n') + 1:]
+        return s
+
+    def write(self, data):
+        """ write a chunk of job output, the chunk does not need to end on a line boundary """
+        if not data:
+            return
+
+        # stamp every line which starts in this chunk with one timestamp
+        prefix = self._timestamp_prefix()
+        if data.endswith(b'\n'):
+            body = data[:-1].replace(b'\n', b'\n' + prefix) + b'\n'
+        else:
+            body = data.replace(b'\n', b'\n' + prefix)
+        if self._at_line_start:
+            self._size += self._f.write(prefix)
+        self._size += self._f.write(body)
+        self._at_line_start = data.endswith(b'\n')
+
+        # keep a bounded tail, trimming only once it is twice the size to amortize the copy
+        self._tail += data
+        if len(self._tail) > 2 * self._tail_size:
+            del self._tail[:-self._tail_size]
+            self._truncated = True
+
+    def write_line(self, text):
+        """ write a line of FlowController text to the log, this text is not part of the job output tail """
+        if not self._at_line_start:
+            self._size += self._f.write(b'\n')
+        self._size += self._f.write(self._timestamp_prefix() + text.encode() + b'\n')
+        self._at_line_start = True
+
+
+class _JobProcess():
+    """ bookkeeping for one running job process """
+    def __init__(self, job_name, proc, on_output, on_flush, on_exit):
+        self.job_name = job_name
+        self.proc = proc
+        self.on_output = on_output
+        self.on_flush = on_flush
+        self.on_exit = on_exit
+        self.flush_deadline = None
+        self.pidfd = None
+        self.reason = None
+        self.start_time = time.time()
+        self.stdout_open = True
+
+
+def _build_preexec_fn(max_memory_mb, max_cpu_seconds):
+    """ build a function which applies resource limits in the child before the job command runs """
+    limits = []
+    if max_memory_mb:
+        limits.append((resource.RLIMIT_AS, int(max_memory_mb * 1024 * 1024)))
+    if max_cpu_seconds:
+        limits.append((resource.RLIMIT_CPU, int(max_cpu_seconds)))
+    if not limits:
+        return None
+
+    def preexec_fn():
+        for r, v in limits:
+            resource.setrlimit(r, (v, v))
+    return preexec_fn
+
+
+class JobSupervisor():
+    """ runs jobs as child processes, each in its own process group, and supervises all of them from a single
+        selector thread which reads their output in large non-blocking chunks, periodically asks the owner to flush
+        it, reaps the processes when they exit, and enforces timeouts.
+
+        job keys
+            timeout         - seconds a job may run before its process group is terminated, default is no timeout
+            max_memory_mb   - address space limit of the job process in MB, default is no limit
+            max_cpu_seconds - cpu time limit of the job process in seconds, default is no limit
+    """
+    # default seconds between the first unflushed output of a job and the on_flush callback
+    FLUSH_INTERVAL = 0.25
+    # seconds between SIGTERM and SIGKILL when killing a job
+    KILL_GRACE_PERIOD = 5
+    # seconds between exit checks for processes which could not be given a pidfd
+    POLL_INTERVAL = 0.5
+
+    def __init__(self):
+        self._deadlines = []
+        self.flush_interval = self.FLUSH_INTERVAL
+        self._job_pids = {}
+        self._lock = threading.Lock()
+        self._new_procs = []
+        self._procs = {}
+        self._selector = selectors.DefaultSelector()
+        self._seq = itertools.count()
+        self._shutdown = False
+        self._thread = None
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def _add_deadline(self, deadline, pid, sig):
+        with self._lock:
+            heapq.heappush(self._deadlines, (deadline, next(self._seq), pid, sig))
+        self._wakeup()
+
+    def _finish(self, p):
+        """ drain any remaining output of an exited process, release its resources and report the exit """
+        if p.stdout_open:
+            self._read_output(p, drain=True)
+            if p.stdout_open:
+                # a grandchild still holds the pipe open, stop listening to it
+                self._selector.unregister(p.proc.stdout.fileno())
+                p.stdout_open = False
+        p.proc.stdout.close()
+        if p.pidfd is not None:
+            self._selector.unregister(p.pidfd)
+            os.close(p.pidfd)
+
+        with self._lock:
+            del self._procs[p.proc.pid]
+            self._job_pids[p.job_name].discard(p.proc.pid)
+            if not self._job_pids[p.job_name]:
+                del self._job_pids[p.job_name]
+
+        try:
+            p.on_exit(p.proc.returncode, p.reason)
+        except Exception as e:
+            logging.exception(e)
+
+    def _process_deadlines(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._deadlines or self._deadlines[0][0] > now:
+                    return
+                _, _, pid, sig = heapq.heappop(self._deadlines)
+                p = self._procs.get(pid, None)
+            if p is None:
+                continue
+            if sig == signal.SIGTERM:
+                if p.reason is None:
+                    p.reason = 'timeout'
+                logging.info(f'Job {p.job_name} with pid {pid} timed out')
+                self._add_deadline(now + self.KILL_GRACE_PERIOD, pid, signal.SIGKILL)
+            self._signal_process_group(p, sig)
+
+    def _process_flushes(self, procs):
+        now = time.time()
+        for p in procs:
+            if p.flush_deadline is not None and p.flush_deadline <= now and p.proc.pid in self._procs:
+                p.flush_deadline = None
+                try:
+                    p.on_flush()
+                except Exception as e:
+                    logging.exception(e)
+
+    def _read_output(self, p, drain=False):
+        """ read whatever output is available without blocking """
+        fd = p.proc.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            if not data:
+                self._selector.unregister(fd)
+                p.stdout_open = False
+                return
+            try:
+                p.on_output(data)
+            except Exception as e:
+                logging.exception(e)
+            if p.flush_deadline is None:
+                p.flush_deadline = time.time() + self.flush_interval
+            if not drain:
+                return
+
+    def _register_new_procs(self):
+        with self._lock:
+            new_procs = self._new_procs
+            self._new_procs = []
+        for p in new_procs:
+            os.set_blocking(p.proc.stdout.fileno(), False)
+            self._selector.register(p.proc.stdout.fileno(), selectors.EVENT_READ, ('stdout', p))
+            # a pidfd becomes readable when the process exits, otherwise fall back to polling
+            try:
+                p.pidfd = os.pidfd_open(p.proc.pid)
+                self._selector.register(p.pidfd, selectors.EVENT_READ, ('exit', p))
+            except (AttributeError, OSError):
+                p.pidfd = None
+
+    def _signal_process_group(self, p, sig):
+        try:
+            os.killpg(p.proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _threadworker_supervise(self):
+        while not self._shutdown:
+            self._register_new_procs()
+
+            # sleep until output arrives, a process exits, or the next deadline
+            with self._lock:
+                procs = list(self._procs.values())
+                timeout = None
+                if self._deadlines:
+                    timeout = max(self._deadlines[0][0] - time.time(), 0)
+            if any(p.pidfd is None for p in procs):
+                timeout = self.POLL_INTERVAL if timeout is None else min(timeout, self.POLL_INTERVAL)
+            flush_deadlines = [p.flush_deadline for p in procs if p.flush_deadline is not None]
+            if flush_deadlines:
+                flush_timeout = max(min(flush_deadlines) - time.time(), 0)
+                timeout = flush_timeout if timeout is None else min(timeout, flush_timeout)
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                kind, p = key.data
+                if kind == 'stdout' and p.stdout_open:
+                    self._read_output(p)
+                elif kind == 'exit' and p.proc.pid in self._procs:
+                    p.proc.wait()
+                    self._finish(p)
+
+            self._process_deadlines()
+            self._process_flushes(procs)
+
+            for p in procs:
+                if p.pidfd is None and p.proc.pid in self._procs and p.proc.poll() is not None:
+                    self._finish(p)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def get_job_pids(self):
+        """ return a dict of job name to the list of pids of its running processes """
+        with self._lock:
+            return {jn: sorted(pids) for jn, pids in self._job_pids.items()}
+
+    def kill_job(self, job_name):
+        """ terminate the process groups of all running processes of a job, escalating to SIGKILL after
+            KILL_GRACE_PERIOD seconds
+
+            Returns:
+                True if the job was running
+        """
+        with self._lock:
+            procs = [self._procs[pid] for pid in self._job_pids.get(job_name, [])]
+        for p in procs:
+            logging.info(f'Killing job {job_name} with pid {p.proc.pid}')
+            p.reason = 'killed'
+            self._signal_process_group(p, signal.SIGTERM)
+            self._add_deadline(time.time() + self.KILL_GRACE_PERIOD, p.proc.pid, signal.SIGKILL)
+        return len(procs) > 0
+
+    def start(self):
+        """ start the supervisor thread """
+        self._thread = threading.Thread(target=self._threadworker_supervise, name='JobSupervisor', daemon=True)
+        self._thread.start()
+
+    def start_job(self, job_name, run_cmd, cwd, on_output, on_flush, on_exit, timeout=None, max_memory_mb=None,
+                  max_cpu_seconds=None):
+        """ start a job process
+
+            Args:
+                job_name - name of the job
+                run_cmd - shell command to run
+                cwd - working directory of the command
+                on_output - called from the supervisor thread with each chunk of bytes the job writes to stdout or
+                            stderr
+                on_flush - called from the supervisor thread at most every flush_interval seconds while the job has
+                           output which arrived since the last call
+                on_exit - called from the supervisor thread with the return code and a reason of None, 'timeout' or
+                          'killed' when the job exits
+                timeout - seconds before the job is terminated
+                max_memory_mb - address space limit of the job in MB
+                max_cpu_seconds - cpu time limit of the job in seconds
+
+            Returns:
+                pid of the job process
+        """
+        with self._lock:
+            if self._thread is None:
+                self.start()
+
+        proc = subprocess.Popen(run_cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True,
+                                start_new_session=True,
+                                preexec_fn=_build_preexec_fn(max_memory_mb, max_cpu_seconds))
+        p = _JobProcess(job_name, proc, on_output, on_flush, on_exit)
+        with self._lock:
+            self._procs[proc.pid] = p
+            self._job_pids.setdefault(job_name, set()).add(proc.pid)
+            self._new_procs.append(p)
+        if timeout:
+            self._add_deadline(p.start_time + timeout, proc.pid, signal.SIGTERM)
+        self._wakeup()
+        return proc.pid
+
+    def stop(self):
+        """ stop the supervisor thread, running jobs are left running """
+        self._shutdown = True
+        self._wakeup()
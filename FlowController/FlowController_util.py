@@ -1,23 +1,99 @@
 import ast
+import copy
+import csv
 import datetime
+import hashlib
+import json
 import logging
+import marshal
 import os
-import pandas as pd
+import struct
 import subprocess
+import sys
 import threading
+import time
 import traceback
 
 
-def read_cfg_file(cfg_filename):
-    # execute the config to get the output
-    proc = subprocess.Popen(['python3', cfg_filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+# runs in a child process to evaluate a cfg file.  The cfg prints its CONFIG dict, the print is captured and sent
+# back marshalled, falling back to the printed repr for values marshal can not handle.  Other prints go to stderr.
+_CFG_RUNNER = """
+import builtins, marshal, os, runpy, sys
+captured = []
+original_print = builtins.print
+def capture_print(*args, **kwargs):
+    if len(args) == 1 and isinstance(args[0], dict) and kwargs.get('file', None) is None:
+        captured.append(args[0])
+    else:
+        kwargs.setdefault('file', sys.stderr)
+        original_print(*args, **kwargs)
+builtins.print = capture_print
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name='__main__')
+if not captured:
+    raise Exception('config file did not print a dict')
+try:
+    data = b'M' + marshal.dumps(captured[-1])
+except ValueError:
+    data = b'R' + repr(captured[-1]).encode()
+sys.stdout.buffer.write(data)
+"""
+
+# parsed cfg files keyed by absolute filename, each entry is (signature, cfg as printed by the cfg file)
+_cfg_cache = {}
+_cfg_cache_lock = threading.Lock()
+
+
+def get_cfg_file_signature(cfg_filename):
+    """ return a signature of a cfg file which changes whenever the file changes
+
+        Args:
+            cfg_filename - filename of the cfg file
+
+        Returns:
+            tuple of mtime in ns, size, and sha256 of the contents
+    """
+    with open(cfg_filename, 'rb') as f:
+        data = f.read()
+    st = os.stat(cfg_filename)
+    return (st.st_mtime_ns, len(data), hashlib.sha256(data).hexdigest())
+
+
+def _evaluate_cfg_file(cfg_filename):
+    """ run a cfg file in a child process and return the dict it prints """
+    proc = subprocess.Popen([sys.executable, '-c', _CFG_RUNNER, cfg_filename], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate()
     if proc.returncode != 0:
         logging.error('Error interpeting config file')
-        logging.error(stdout.decode())
         logging.error(stderr.decode())
         raise Exception('Error interpreting config file')
-    cfg = ast.literal_eval(stdout.decode())
+    if stdout[:1] == b'M':
+        return marshal.loads(stdout[1:])
+    return ast.literal_eval(stdout[1:].decode())
+
+
+def read_cfg_file(cfg_filename, force=False):
+    """ read a cfg file and fill in defaults.  The cfg file is only evaluated again when its signature changes
+
+        Args:
+            cfg_filename - filename of the cfg file
+            force - evaluate the cfg file even if its signature did not change, for cfg files whose jobs come from
+                    other files or depend on the date
+
+        Returns:
+            cfg dict, the caller owns it and may modify it
+    """
+    key = os.path.abspath(cfg_filename)
+    signature = get_cfg_file_signature(cfg_filename)
+    with _cfg_cache_lock:
+        cached = _cfg_cache.get(key, None)
+    if force or cached is None or cached[0] != signature:
+        cached = (signature, _evaluate_cfg_file(cfg_filename))
+        with _cfg_cache_lock:
+            _cfg_cache[key] = cached
+    cfg = copy.deepcopy(cached[1])
 
     cfg['jobs'] = {j['name']: j for j in cfg['jobs']}
     cfg['smq_server'] = f'http://{cfg["smq_server"]}'
@@ -28,6 +104,14 @@ def read_cfg_file(cfg_filename):
     cfg['failure_email_recipients'] = cfg.get('failure_email_recipients', None)
     cfg['success_slack_webhook'] = cfg.get('success_slack_webhook', None)
     cfg['failure_slack_webhook'] = cfg.get('failure_slack_webhook', None)
+    cfg['log_changed_interval'] = cfg.get('log_changed_interval', 0.25)
+    cfg['max_concurrent_jobs'] = cfg.get('max_concurrent_jobs', None)
+    cfg['pools'] = cfg.get('pools', {})
+    cfg['smtp_server'] = cfg.get('smtp_server', 'localhost')
+    cfg['notification_digest_interval'] = cfg.get('notification_digest_interval', 0)
+    cfg['metrics_port'] = cfg.get('metrics_port', None)
+    cfg['profile_dir'] = os.path.join(os.path.dirname(os.path.abspath(cfg_filename)),
+                                      cfg.get('profile_dir', 'profiles'))
     return cfg
 
 
@@ -115,22 +199,267 @@ class FlowControllerLedger():
 
     @classmethod
     def read(cls, ledger_dir, ledger_uid, date=None):
-        # default dataframe if file does not exist or is empty
+        """ read a csv ledger
+
+            Args:
+                ledger_dir - directory the ledger files are in
+                ledger_uid - uid of the config the ledger belongs to
+                date - date of the ledger in YYYYMMDD format, default is today
+
+            Returns:
+                list of dicts with COLUMN_NAMES as keys, empty if the file does not exist or is empty
+        """
         if date is None:
             date = datetime.datetime.now().strftime('%Y%m%d')
 
-        df = pd.DataFrame(columns=FlowControllerLedger.COLUMN_NAMES)
-
-        # try to read the file
+        records = []
         filename = cls._get_filename(date, ledger_dir, ledger_uid)
-        if os.path.exists(filename):
-            try:
-                df = pd.read_csv(filename, parse_dates=True)
-            except pd.errors.EmptyDataError:
-                pass
+        if not os.path.exists(filename):
+            return records
 
-        # convert timestamp to a datetime
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 4:
+                    continue
+                # append does not quote, so a reason containing commas spills into extra columns
+                records.append({'timestamp': datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S'),
+                                'job_name': row[1], 'state': row[2], 'reason': ','.join(row[3:])})
 
         # success!
-        return df
+        return records
+
+
+def records_to_dataframe(records):
+    """ convert ledger records to a pandas DataFrame for analytics, pandas is optional and only imported here
+
+        Args:
+            records - list of dicts returned by FlowControllerLedger.read or FlowControllerBinaryLedger.read
+
+        Returns:
+            DataFrame with FlowControllerLedger.COLUMN_NAMES as columns
+    """
+    import pandas as pd
+    return pd.DataFrame(records, columns=FlowControllerLedger.COLUMN_NAMES)
+
+
+class FlowControllerBinaryLedger():
+    """ append-only binary ledger of job state changes, one file per day.
+
+        The file handle stays open between appends, every append is flushed to the OS but fsync is batched.  The
+        owner calls sync_if_due periodically so an append is fsynced within fsync_interval even if no later append
+        arrives.  The latest state of every job is kept in memory.  That index is checkpointed to a sidecar snapshot
+        file so opening a ledger only replays the records written after the last checkpoint.  Appending is only
+        allowed for the one FlowController which owns the ledger, other processes may open it to read.
+
+        record format, little endian
+            uint32  length of the rest of the record
+            float64 unix timestamp
+            uint8   state code, index into STATE_NAMES
+            uint16  length of the job name in bytes
+            bytes   job name, utf-8
+            bytes   reason, utf-8
+    """
+    FILE_MAGIC = b'FCLEDGR1'
+    RECORD_HEADER = struct.Struct('<IdBH')
+    STATE_NAMES = ['IDLE', 'PENDING', 'RUNNING', 'SUCCESS', 'FAILURE']
+    STATE_CODES = {n: i for i, n in enumerate(STATE_NAMES)}
+
+    def __init__(self, ledger_dir, ledger_uid, fsync_interval=1.0, checkpoint_interval=1000):
+        """ init
+
+            Args:
+                ledger_dir - directory the ledger files are in
+                ledger_uid - uid of the config the ledger belongs to
+                fsync_interval - minimum seconds between fsyncs of the ledger file, and the most seconds an append
+                                 stays unsynced if sync_if_due is called
+                checkpoint_interval - number of appends between snapshots of the state index
+        """
+        self._checkpoint_interval = checkpoint_interval
+        self._date = None
+        self._f = None
+        self._fsync_interval = fsync_interval
+        self._last_fsync = 0
+        self._ledger_dir = ledger_dir
+        self._ledger_uid = ledger_uid
+        self._records_since_checkpoint = 0
+        self._size = 0
+        self._states = {}
+        self._unsynced = False
+
+    def _get_filename(self, date):
+        datetime.datetime.strptime(date, '%Y%m%d')
+        return os.path.join(self._ledger_dir, f'{self._ledger_uid}.{date}.ledger.bin')
+
+    def _get_snapshot_filename(self, date):
+        return self._get_filename(date) + '.snapshot'
+
+    def _iter_records(self, filename, offset):
+        """ yield (end offset, timestamp, state name, job name, reason) for every complete record after offset """
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb') as f:
+            if f.read(len(self.FILE_MAGIC)) != self.FILE_MAGIC:
+                raise Exception(f'{filename} is not a FlowController binary ledger')
+            f.seek(max(offset, len(self.FILE_MAGIC)))
+            data = f.read()
+        pos = 0
+        header_size = self.RECORD_HEADER.size
+        while pos + header_size <= len(data):
+            record_len, timestamp, state_code, name_len = self.RECORD_HEADER.unpack_from(data, pos)
+            end = pos + 4 + record_len
+            if end > len(data):
+                # torn write at the end of the file
+                break
+            name_end = pos + header_size + name_len
+            yield (max(offset, len(self.FILE_MAGIC)) + end, timestamp, self.STATE_NAMES[state_code],
+                   data[pos + header_size:name_end].decode(), data[name_end:end].decode())
+            pos = end
+
+    def _open_for_append(self):
+        # cut off any torn record left by a crash so new records start on a record boundary
+        filename = self._get_filename(self._date)
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                f.write(self.FILE_MAGIC)
+            self._size = len(self.FILE_MAGIC)
+        elif os.path.getsize(filename) > self._size:
+            os.truncate(filename, self._size)
+        self._f = open(filename, 'ab')
+
+    def _write_snapshot(self):
+        filename = self._get_snapshot_filename(self._date)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'offset': self._size, 'states': self._states}, f)
+        os.replace(filename + '.tmp', filename)
+        self._records_since_checkpoint = 0
+
+    def append(self, job_name, state, reason):
+        """ append a state change, rolling over to a new file at midnight
+
+            Args:
+                job_name - name of the job
+                state - name of the new state
+                reason - reason for the state change
+        """
+        today = datetime.datetime.now().strftime('%Y%m%d')
+        if today != self._date:
+            self.close()
+            self.open(today)
+        if self._f is None:
+            self._open_for_append()
+
+        name = job_name.encode()
+        reason = str(reason).encode()
+        record = self.RECORD_HEADER.pack(self.RECORD_HEADER.size - 4 + len(name) + len(reason), time.time(),
+                                         self.STATE_CODES[state], len(name)) + name + reason
+        self._f.write(record)
+        self._f.flush()
+        self._size += len(record)
+        self._states[job_name] = state
+        self._unsynced = True
+
+        # batch the expensive parts
+        if time.time() - self._last_fsync >= self._fsync_interval:
+            self.sync()
+        self._records_since_checkpoint += 1
+        if self._records_since_checkpoint >= self._checkpoint_interval:
+            self._write_snapshot()
+
+    def close(self):
+        """ fsync and close the ledger file and checkpoint the state index """
+        if self._f is not None:
+            self.sync()
+            self._f.close()
+            self._f = None
+            self._write_snapshot()
+
+    def export_csv(self, filename, date=None):
+        """ export the ledger of a day in the FlowControllerLedger csv format
+
+            Args:
+                filename - name of the csv file to write
+                date - date of the ledger in YYYYMMDD format, default is today
+        """
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(FlowControllerLedger.COLUMN_NAMES)
+            for r in self.read(date):
+                writer.writerow([r['timestamp'].strftime('%Y-%m-%d %H:%M:%S'), r['job_name'], r['state'],
+                                 r['reason']])
+
+    def get_sync_deadline(self):
+        """ return the unix time by which appended records are due to be fsynced, None if they all are """
+        if not self._unsynced:
+            return None
+        return self._last_fsync + self._fsync_interval
+
+    def get_states(self):
+        """ return a dict of job name to the name of its latest state in the open ledger """
+        return dict(self._states)
+
+    def open(self, date=None):
+        """ open the ledger of a day and restore the latest state of every job from the snapshot and the records
+            written after it.  A csv ledger written by older versions for the same day is used if there is no
+            snapshot yet.
+
+            Args:
+                date - date of the ledger in YYYYMMDD format, default is today
+        """
+        if date is None:
+            date = datetime.datetime.now().strftime('%Y%m%d')
+        self.close()
+        self._date = date
+        self._records_since_checkpoint = 0
+        self._size = len(self.FILE_MAGIC)
+        self._states = {}
+
+        # start from the snapshot if it is consistent with the ledger file
+        filename = self._get_filename(date)
+        ledger_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        snapshot = None
+        try:
+            with open(self._get_snapshot_filename(date), 'r') as f:
+                snapshot = json.load(f)
+            if snapshot['offset'] > ledger_size:
+                snapshot = None
+        except (OSError, ValueError, KeyError):
+            snapshot = None
+
+        if snapshot is not None:
+            self._states = snapshot['states']
+            self._size = snapshot['offset']
+        else:
+            for r in FlowControllerLedger.read(self._ledger_dir, self._ledger_uid, date):
+                self._states[r['job_name']] = r['state']
+
+        for end, _, state, job_name, _ in self._iter_records(filename, self._size):
+            self._states[job_name] = state
+            self._size = end
+
+    def read(self, date=None):
+        """ return every record of the ledger of a day as a list of dicts with the FlowControllerLedger column
+            names as keys
+
+            Args:
+                date - date of the ledger in YYYYMMDD format, default is the open ledger or today
+        """
+        if date is None:
+            date = self._date or datetime.datetime.now().strftime('%Y%m%d')
+        return [{'timestamp': datetime.datetime.fromtimestamp(timestamp), 'job_name': job_name, 'state': state,
+                 'reason': reason}
+                for _, timestamp, state, job_name, reason in self._iter_records(self._get_filename(date), 0)]
+
+    def sync(self):
+        """ fsync the ledger file """
+        if self._f is not None:
+            os.fsync(self._f.fileno())
+            self._last_fsync = time.time()
+        self._unsynced = False
+
+    def sync_if_due(self):
+        """ fsync the ledger file if there are records which have not been fsynced for fsync_interval """
+        deadline = self.get_sync_deadline()
+        if deadline is not None and time.time() >= deadline:
+            self.sync()
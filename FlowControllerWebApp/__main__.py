@@ -2,16 +2,22 @@
 #    Imports
 # --------------------------------------------------
 import argparse
+import functools
+import json
 import logging
+import math
 import os
 import signal
+import threading
+import time
 import traceback
 from urllib.parse import parse_qs
 
 from pylinkjs.PyLinkJS import run_pylinkjs_app, get_all_jsclients
 from pylinkjs.plugins.authGoogleOAuth2Plugin import pluginGoogleOAuth2
 from pylinkjs.plugins.authDevAuthPlugin import pluginDevAuth
-from FlowController.FlowController import JobState
+from FlowController import FlowController_metrics, FlowController_profile
+from FlowController.FlowController import JobState, MAX_LOG_CHUNK_SIZE
 from SimpleMessageQueue.SMQ_Client import SMQ_Client
 
 
@@ -20,6 +26,24 @@ from SimpleMessageQueue.SMQ_Client import SMQ_Client
 # --------------------------------------------------
 SMQC = None
 
+# process wide cache of the flows shown by the clients, keyed by cfg_uid and shared by all clients.  Each entry holds
+# the config, its version, the gui nodes, the data url of the icon and the scene drawn on the canvas
+FLOW_CACHE = {}
+FLOW_CACHE_LOCK = threading.Lock()
+
+# time.monotonic() of the last message received from each flow, any message from a flow shows it is alive so it
+# only has to be pinged when it has been quiet for longer than the heartbeat interval
+FLOW_LAST_SEEN = {}
+HEARTBEAT_INTERVAL = 1
+
+# size of the cells of the grid used to find the job icon under a click, about the vertical spacing of the jobs
+HIT_GRID_CELL_SIZE = 32
+
+# time from sending a request to a FlowController until its response arrived
+SMQ_ROUND_TRIP_SECONDS = FlowController_metrics.REGISTRY.histogram(
+    'flowcontroller_webapp_smq_round_trip_seconds', 'seconds from sending a request to a FlowController until the ' +
+    'response arrived', ('action', ))
+
 COLOR_MAPPING = {
     JobState.IDLE: '#FFEF02',
     JobState.PENDING: 'lightsalmon',
@@ -106,18 +130,76 @@ def _convert_job_to_guinode(j):
 
     # set some derived values
     gn['children'] = []
-    gn['children_rendered'] = []
     gn['parents'] = []
     gn['text'] = gn.get('text', gn['name'])
 
-    gn['state'] = JobState[gn['state']]
+    _set_gui_node_state(gn, JobState[gn['state']])
 
-    job_state = gn['state']
+    # success!
+    return gn
+
+
+def _set_gui_node_state(gn, job_state):
+    gn['state'] = job_state
     gn['icon_color'] = COLOR_MAPPING.get(job_state, 'gainsboro')
     gn['link_color'] = LINK_COLOR_MAPPING.get(job_state, 'gainsboro')
 
-    # success!
-    return gn
+
+@functools.lru_cache(maxsize=32)
+def _compute_layout(shape):
+    """ compute the position of every job in O(V+E).  Jobs without dependencies are placed at the origin, every
+        other job is placed to the right of its first parent, fanned out vertically among the children of that parent
+        in config order.  The result only depends on the shape of the graph, so it is memoized by shape
+
+        Args:
+            shape - tuple of (name, tuple of depends, width, x_offset, y_offset) for every job in config order
+
+        Returns:
+            dict of job name to (x, y) before offsets
+    """
+    index = {name: i for i, (name, _, _, _, _) in enumerate(shape)}
+    parents = [[index[pjn] for pjn in depends if pjn in index] for _, depends, _, _, _ in shape]
+
+    # children in config order, and the slot of each job among the children placed relative to its first parent
+    children = [[] for _ in shape]
+    slots = [0] * len(shape)
+    placed_children = [0] * len(shape)
+    for i, ps in enumerate(parents):
+        for p in ps:
+            children[p].append(i)
+        if ps:
+            slots[i] = placed_children[ps[0]]
+            placed_children[ps[0]] += 1
+
+    # topological order with kahn's algorithm, so every parent is placed before its children
+    indegree = [len(ps) for ps in parents]
+    order = [i for i in range(0, len(shape)) if indegree[i] == 0]
+    for i in order:
+        for c in children[i]:
+            indegree[c] -= 1
+            if indegree[c] == 0:
+                order.append(c)
+    if len(order) < len(shape):
+        # walk first parents among the jobs which were never reached until one repeats
+        i = next(i for i in range(0, len(shape)) if indegree[i] > 0)
+        path = []
+        while i not in path:
+            path.append(i)
+            i = next(p for p in parents[i] if indegree[p] > 0)
+        cycle = path[path.index(i):] + [i]
+        raise Exception('Circular job dependencies: ' + ' <- '.join(shape[c][0] for c in cycle))
+
+    positions = [None] * len(shape)
+    for i in order:
+        if parents[i]:
+            p = parents[i][0]
+            _, _, p_width, p_x_offset, p_y_offset = shape[p]
+            px, py = positions[p]
+            positions[i] = (px + p_x_offset + p_width,
+                            py + p_y_offset + (slots[i] - (len(children[p]) - 1) / 2.0) * 30)
+        else:
+            positions[i] = (0, 0)
+    return {shape[i][0]: positions[i] for i in range(0, len(shape))}
 
 
 def _convert_cfg_to_gui_nodes(config_snapshot):
@@ -125,44 +207,26 @@ def _convert_cfg_to_gui_nodes(config_snapshot):
     gui_jobs = config_snapshot['jobs']
     gui_jobs = {k: _convert_job_to_guinode(v) for k, v in gui_jobs.items()}
 
-    # repoint the depends to parent gui nodes, and find roots at the same time
-    stack = []
+    # repoint the depends to parent gui nodes, parents which are not in the config are not drawn
     for j in gui_jobs.values():
-        if not j['depends']:
-            stack.append(j)
-        else:
-            for pjn in j['depends']:
+        for pjn in j['depends']:
+            if pjn in gui_jobs:
                 j['parents'].append(gui_jobs[pjn])
                 gui_jobs[pjn]['children'].append(j)
 
-            # fix any missing curve settings
-            for i in range(0, len(j['parents'])):
-                if len(j['parent_curve_settings']) <= i:
-                    j['parent_curve_settings'].append(None)
-                if j['parent_curve_settings'][i] is None:
-                    j['parent_curve_settings'][i] = [[0.5, 0], [0.75, 1]]
-
-    # do our best to traverse the nodes in order, i think it might be ok to be circular sometimes
-    processed = set()
+        # fix any missing curve settings
+        for i in range(0, len(j['parents'])):
+            if len(j['parent_curve_settings']) <= i:
+                j['parent_curve_settings'].append(None)
+            if j['parent_curve_settings'][i] is None:
+                j['parent_curve_settings'][i] = [[0.5, 0], [0.75, 1]]
+
+    # place the nodes
+    shape = tuple((j['name'], tuple(j['depends']), j['width'], j['x_offset'], j['y_offset'])
+                  for j in gui_jobs.values())
+    positions = _compute_layout(shape)
     for j in gui_jobs.values():
-        if j not in stack:
-            stack.append(j)
-    while stack:
-        j = stack.pop(0)
-        if j['parents']:
-            if j['parents'][0]['name'] in processed:
-                # parent already processed so we can computer our x and y
-                j['x'] = j['parents'][0]['x_render'] + j['parents'][0]['width']
-                j['y'] = j['parents'][0]['y_render'] + (len(j['parents'][0]['children_rendered']) -
-                                                        (len(j['parents'][0]['children']) - 1) / 2.0) * 30
-                j['parents'][0]['children_rendered'].append(j)
-            else:
-                # parent hasn't been processed yet, so reinsert into the stack
-                stack.remove(j['parents'][0])
-                stack.insert(j)
-                stack.insert(j['parents'][0], 0)
-                continue
-        processed.add(j['name'])
+        j['x'], j['y'] = positions[j['name']]
         j['x_render'] = j['x'] + j['x_offset']
         j['y_render'] = j['y'] + j['y_offset']
         j['x_rendertext'] = j['x_render'] + j['icon_radius'] * 1.5
@@ -171,80 +235,275 @@ def _convert_cfg_to_gui_nodes(config_snapshot):
     return gui_jobs
 
 
-def _generate_draw_job_node_js(node_info):
-    js = ""
-    if node_info['icon_shape'] == 'circle':
-        js = f"""
-            gCtx.beginPath();
-            gCtx.strokeStyle = "{node_info['icon_color']}";
-            gCtx.strokeStyle = "#B0B0B0";
-            gCtx.fillStyle = "{node_info['icon_color']}";
-            gCtx.arc({node_info['x_render']}, {node_info['y_render']}, {node_info['icon_radius']}, 0, Math.PI * 2, true);
-            gCtx.stroke();
-            gCtx.fill();
-        """
-    js += f"""
-        var t = "{node_info['text_prefix']}" + "{node_info['text']}";
-        gCtx.fillStyle = "{node_info['text_color']}";
-        gCtx.fillText(t, {node_info['x_rendertext'] + node_info['text_padding_left']}, {node_info['y_render']});
-
-        if (({node_info['x_render']} - {node_info['icon_radius']}) < gBoundingBox[0]) {{
-            gBoundingBox[0] = ({node_info['x_render']} - {node_info['icon_radius']});
-        }}
-
-        if (({node_info['y_render']} - {node_info['icon_radius']}) < gBoundingBox[1]) {{
-            gBoundingBox[1] = ({node_info['y_render']} - {node_info['icon_radius']});
-        }}
-
-        if (({node_info['x_rendertext']} + gCtx.measureText(t).width + {node_info['text_padding_left']}) > gBoundingBox[2]) {{
-            gBoundingBox[2] = ({node_info['x_rendertext']} + gCtx.measureText(t).width + {node_info['text_padding_left']});
-        }}
-
-        if (({node_info['y_render']} + {node_info['icon_radius']}) > gBoundingBox[3]) {{
-            gBoundingBox[3] = ({node_info['y_render']} + {node_info['icon_radius']});
-        }}
+def _generate_scene(gui_nodes):
+    """ convert the gui nodes to the compact scene drawn by canvasSceneDraw in canvas_viewport.js
+
+        Returns:
+            dict with a list of nodes, each a list of [name, text, x, y, icon radius, icon shape, icon color, link
+            color, text color, text x, text padding right, dependency line after text], a list of edges, each a list
+            of [parent node index, child node index, bezier control point settings], a grid of the icons which can
+            be clicked, and an index of job name to node index which is not sent to the browser
+    """
+    index = {jn: i for i, jn in enumerate(gui_nodes)}
+    nodes = []
+    edges = []
+    for j in gui_nodes.values():
+        nodes.append([j['name'], j['text_prefix'] + j['text'], j['x_render'], j['y_render'], j['icon_radius'],
+                      j['icon_shape'], j['icon_color'], j['link_color'], j['text_color'],
+                      j['x_rendertext'] + j['text_padding_left'], j['text_padding_right'],
+                      j['dependency_line_after_text']])
+        for i, p in enumerate(j['parents']):
+            pc = j['parent_curve_settings'][i]
+            edges.append([index[p['name']], index[j['name']], pc[0][0], pc[0][1], pc[1][0], pc[1][1]])
+    grid = _build_hit_grid([n for n in nodes if not gui_nodes[n[0]]['no_context_menu']], index)
+    return {'nodes': nodes, 'edges': edges, 'grid': grid, 'index': index}
+
+
+def _build_hit_grid(nodes, index):
+    """ build a uniform grid over the icons of the scene nodes so a click only tests the icons in one cell
+
+        Args:
+            nodes - scene nodes which can be clicked
+            index - dict of job name to node index
+
+        Returns:
+            dict with the cell size and a dict of "cell x,cell y" to the list of node indices whose icon overlaps the
+            cell in node order.  The same grid is used by canvasSceneHitTest in canvas_viewport.js
+    """
+    cells = {}
+    for n in nodes:
+        x, y, r = n[2], n[3], n[4]
+        for cx in range(math.floor((x - r) / HIT_GRID_CELL_SIZE), math.floor((x + r) / HIT_GRID_CELL_SIZE) + 1):
+            for cy in range(math.floor((y - r) / HIT_GRID_CELL_SIZE), math.floor((y + r) / HIT_GRID_CELL_SIZE) + 1):
+                cells.setdefault(f'{cx},{cy}', []).append(index[n[0]])
+    return {'cellSize': HIT_GRID_CELL_SIZE, 'cells': cells}
+
+
+def _hit_test_scene(scene, x, y):
+    """ return the name of the job whose icon contains the point, None if there is none """
+    cell = f'{math.floor(x / HIT_GRID_CELL_SIZE)},{math.floor(y / HIT_GRID_CELL_SIZE)}'
+    for i in scene['grid']['cells'].get(cell, []):
+        n = scene['nodes'][i]
+        if abs(x - n[2]) < n[4] and abs(y - n[3]) < n[4]:
+            return n[0]
+    return None
+
+
+def _get_flow_cache(cfg_uid):
+    """ return the cache entry of a flow, fetching the config if it is not cached """
+    entry = _get_flow_cache_entry(cfg_uid)
+    with entry['lock']:
+        if entry['config'] is None:
+            _refresh_flow_cache(entry, cfg_uid)
+    return entry
+
+
+def _get_flow_cache_entry(cfg_uid):
+    """ return the cache entry of a flow without fetching anything, creating an empty entry if there is none """
+    with FLOW_CACHE_LOCK:
+        if cfg_uid not in FLOW_CACHE:
+            FLOW_CACHE[cfg_uid] = {'lock': threading.RLock(), 'config': None, 'version': None, 'gui_nodes': None,
+                                   'icon': None, 'scene': None, 'scene_json': None}
+        return FLOW_CACHE[cfg_uid]
+
+
+def _get_flow_scene_json(cfg_uid):
+    """ return the cached scene of a flow serialized for canvasSceneLoad """
+    entry = _get_flow_cache(cfg_uid)
+    with entry['lock']:
+        if entry['scene_json'] is None:
+            scene = entry['scene']
+            entry['scene_json'] = json.dumps({'nodes': scene['nodes'], 'edges': scene['edges'], 'grid': scene['grid']},
+                                             separators=(',', ':'))
+        return entry['scene_json']
+
+
+def _get_flow_icon(cfg_uid):
+    """ return the cached data url of the icon of a flow, empty if the FlowController has no icon """
+    entry = _get_flow_cache_entry(cfg_uid)
+    with entry['lock']:
+        if entry['icon'] is None or entry['config'] is None:
+            _refresh_flow_cache(entry, cfg_uid, include_icon=True)
+        return entry['icon']
+
+
+def _mark_flow_seen(cfg_uid):
+    """ record that a message was just received from a flow """
+    FLOW_LAST_SEEN[cfg_uid] = time.monotonic()
+
+
+def _invalidate_flow_cache(cfg_uid, include_icon=False):
+    """ drop the cached config of a flow so the next access fetches it """
+    with FLOW_CACHE_LOCK:
+        entry = FLOW_CACHE.get(cfg_uid, None)
+    if entry is not None:
+        with entry['lock']:
+            entry['config'] = None
+            entry['version'] = None
+            if include_icon:
+                entry['icon'] = None
+
+
+def _is_next_config_version(cached_version, version):
+    """ return True if a config version directly follows the cached version.  The FlowController bumps the number
+        after the dot on every change, including cron reschedules which are not broadcast, so a gap means the cache
+        missed a change and has to be fetched again """
+    if cached_version is None or version is None:
+        return False
+    prefix, _, number = cached_version.rpartition('.')
+    return version == f'{prefix}.{int(number) + 1}'
+
+
+def _patch_flow_cache(cfg_uid, payload):
+    """ apply the change set of a config_changed message to the cached config of a flow and regenerate the gui nodes
+        and the scene from it, so an edit of a few jobs does not fetch the whole config
+
+        Args:
+            cfg_uid - uid of the flow
+            payload - payload of the config_changed message
+
+        Returns:
+            True if the cache was patched, False if the config has to be fetched again
+    """
+    if payload.get('full', True) or 'version' not in payload:
+        return False
+    with FLOW_CACHE_LOCK:
+        entry = FLOW_CACHE.get(cfg_uid, None)
+    if entry is None:
+        return False
+    with entry['lock']:
+        if entry['config'] is None or not _is_next_config_version(entry['version'], payload['version']):
+            return False
+        jobs = entry['config']['jobs']
+        for jn in payload['removed']:
+            jobs.pop(jn, None)
+        jobs.update(payload['jobs'])
+        if 'job_order' in payload:
+            if set(payload['job_order']) != set(jobs.keys()):
+                return False
+            jobs = {jn: jobs[jn] for jn in payload['job_order']}
+        entry['config']['jobs'] = jobs
+        entry['version'] = payload['version']
+        entry['gui_nodes'] = _convert_cfg_to_gui_nodes(entry['config'])
+        entry['scene'] = _generate_scene(entry['gui_nodes'])
+        entry['scene_json'] = None
+    return True
+
+
+def _refresh_flow_cache(entry, cfg_uid, requests=(), include_icon=False):
+    """ fetch the config of a flow if it changed since the cached version and recompute the gui nodes.  The check,
+        the icon and any other requests to the FlowController are sent as one request_batch message so they cost a
+        single round trip.  Must hold the lock of the entry
+
+        Args:
+            entry - cache entry of the flow
+            cfg_uid - uid of the flow
+            requests - list of (action, payload) tuples of other requests to send with the check
+            include_icon - also fetch the icon if it is not cached
+
+        Returns:
+            list of the responses to requests
+    """
+    batch = [('request_config_if_changed', {'version': entry['version'], 'serialized': True})]
+    fetch_icon = include_icon and entry['icon'] is None
+    if fetch_icon:
+        batch.append(('request_icon', {}))
+    batch_response = _send_request(cfg_uid, 'request_batch',
+                                   {'requests': [{'action': a, 'payload': p} for a, p in batch + list(requests)]})
+    responses = batch_response['responses']
+
+    if fetch_icon:
+        # the FlowController has no icon if request_icon failed
+        icon = responses[1].get('icon', None)
+        entry['icon'] = "data:image/png;base64," + icon if icon else ''
+
+    response = responses[0]
+    if response['changed']:
+        entry['config'] = json.loads(response['config_json'])
+        entry['version'] = response['version']
+        entry['gui_nodes'] = _convert_cfg_to_gui_nodes(entry['config'])
+        entry['scene'] = _generate_scene(entry['gui_nodes'])
+        entry['scene_json'] = None
+    return responses[len(batch):]
+
+
+def _revalidate_flow_cache(cfg_uid, requests=(), include_icon=False):
+    """ check the cached config of a flow is current, see _refresh_flow_cache
+
+        Returns:
+            list of the responses to requests
     """
+    entry = _get_flow_cache_entry(cfg_uid)
+    with entry['lock']:
+        return _refresh_flow_cache(entry, cfg_uid, requests, include_icon)
 
-    if node_info['parents'] is not None:
-        for i, p in enumerate(node_info['parents']):
-            js += f"""
-                    var t = "{p['text_prefix']}" + "{p['text']}";
-                """
-            pc = node_info['parent_curve_settings'][i]
-            if p['dependency_line_after_text']:
-                sx = f"""({p['x_rendertext']} + gCtx.measureText(t).width + {p['text_padding_left']} + {p['text_padding_right']})"""
-            else:
-                sx = f"""({p['x_render']})"""
-            sy = f"""({p['y_render']})"""
-            ex = f"""({node_info['x_render'] - node_info['icon_radius']})"""
-            ey = f"""({node_info['y_render']})"""
-            cx1 = f"""({sx} + ({ex} - {sx}) * {pc[0][0]})"""
-            cy1 = f"""({sy} + ({ey} - {sy}) * {pc[0][1]})"""
-            cx2 = f"""({sx} + ({ex} - {sx}) * {pc[1][0]})"""
-            cy2 = f"""({sy} + ({ey} - {sy}) * {pc[1][1]})"""
-            js += f"""
-            gCtx.beginPath();
-            gCtx.strokeStyle = "{p['link_color']}";
-            gCtx.moveTo({sx}, {sy});
-            gCtx.bezierCurveTo({cx1}, {cy1}, {cx2}, {cy2}, {ex}, {ey});
-            gCtx.stroke();
-            """
-
-    return js
+
+def _fetch_log_tail(cfg_uid, job_name, offset):
+    return _send_request(cfg_uid, 'request_log_tail', {'job_name': job_name, 'offset': offset})
+
+
+def _profiled(section, fn):
+    # sample calls of fn as a section when profiling
+    def profiled_fn(*args):
+        with FlowController_profile.PROFILER.section(section):
+            return fn(*args)
+    return profiled_fn
+
+
+def _send_request(cfg_uid, action, payload):
+    """ send a request to a FlowController, wait for the response and record the round trip time """
+    with SMQ_ROUND_TRIP_SECONDS.time(action):
+        return SMQC.send_message(SMQC.construct_msg(action, cfg_uid, payload), wait=5)
+
+
+def _show_metrics(jsc):
+    # show a summary of the metrics of the flow in the status pane and all of them in the log pane, followed by the
+    # metrics of the webapp
+    jsc.tag['current_job_selected'] = None
+    response = _send_request(jsc.tag['cfg_uid'], 'request_metrics', {})
+    values = {(m['name'], tuple(sorted(m['labels'].items()))): m['value'] for m in response['metrics']}
+
+    def mean(name):
+        count = values.get((name + '_count', ()), 0)
+        return f'{values[(name + "_sum", ())] / count * 1000:.3f} ms over {count:.0f}' if count else 'no samples'
+
+    summary = [('pending jobs', f"{values.get(('flowcontroller_pending_jobs', ()), 0):.0f}"),
+               ('running jobs', f"{values.get(('flowcontroller_running_jobs', ()), 0):.0f}"),
+               ('scheduler tick mean', mean('flowcontroller_process_jobs_seconds')),
+               ('ledger append mean', mean('flowcontroller_ledger_append_seconds'))]
+    html = ''.join(f'<span style="color: steelblue">{k} :</span> {v}\n' for k, v in summary)
+    jsc.eval_js_code(blocking=False, js_code=f"$('#pre_status').html({json.dumps(html)})")
+
+    s = (f'Metrics of {jsc.tag["cfg_uid"]}\n-----\n' + response['text'] + '\nMetrics of the WebApp\n-----\n' +
+         FlowController_metrics.REGISTRY.render_prometheus())
+    jsc.eval_js_code(blocking=False, js_code=f"$('#pre_log').text({json.dumps(s)}); $('#pre_log').scrollTop(0)")
+
+
+def _show_log(jsc, response, replace):
+    # show the text returned by request_log_tail, replacing the log or appending the new text to it
+    jsc.tag['log_offset'] = response['offset']
+    if not response['exists']:
+        s = f'This job may not have run for today yet.\n\nlog file at {response["filename"]} does not exist.'
+        js = f"$('#pre_log').text({json.dumps(s)});"
+    elif replace or response['reset']:
+        s = response['filename'] + "\n-----\n" + response['log']
+        js = f"$('#pre_log').text({json.dumps(s)});"
+    else:
+        js = f"$('#pre_log').append(document.createTextNode({json.dumps(response['log'])}));"
+    jsc.eval_js_code(blocking=False, js_code=js + " $('#pre_log').scrollTop($('#pre_log')[0].scrollHeight)")
 
 
 def _update_status_and_log(jsc, job_name):
     jsc.tag['current_job_selected'] = job_name
-    msg = SMQC.construct_msg('request_log_chunk', jsc.tag['cfg_uid'], {'job_name': job_name, 'range': ''})
-    response = SMQC.send_message(msg, wait=5)
-    response_log = response['log'].replace('`', '\`')
-    jsc.eval_js_code(blocking=False, js_code=f"""$('#pre_log').html(`{response_log}`); $('#pre_log').scrollTop($('#pre_log')[0].scrollHeight)""")
 
-    response = SMQC.send_message(SMQC.construct_msg('request_config', jsc.tag['cfg_uid'], {}), wait=5)
-    jsc.tag['config'] = response['config']
+    # the cached config does not follow cron fire times, so check it is current before showing the details.  The
+    # check goes in the same round trip as the log
+    responses = _revalidate_flow_cache(jsc.tag['cfg_uid'], [('request_log_tail', {'job_name': job_name,
+                                                                                  'offset': None})])
+    _show_log(jsc, responses[0], replace=True)
 
     html = ''
-    details = jsc.tag['config']['jobs'][job_name]
+    details = _get_flow_cache(jsc.tag['cfg_uid'])['config']['jobs'][job_name]
     for k in sorted(details.keys()):
         html += f'<span style="color: steelblue">{k} :</span> {details[k]}\n'
 
@@ -267,6 +526,9 @@ def admin_menu_click(jsc, item_text):
     if item_text == 'Refresh':
         reconnect_cfg_view(jsc, *jsc.tag['url_args'])
 
+    if item_text == 'Metrics':
+        _show_metrics(jsc)
+
 
 def context_menu_click(jsc, item_text, job_name):
     if item_text == 'Trigger Job':
@@ -275,6 +537,10 @@ def context_menu_click(jsc, item_text, job_name):
                                               'reason': f'manually set by user {jsc.user_auth_username}'}))
         refresh_status_and_log = True
 
+    if item_text == 'Kill Job':
+        SMQC.send_message(SMQC.construct_msg('kill_job', jsc.tag['cfg_uid'], {'job_name': job_name}))
+        refresh_status_and_log = True
+
     if item_text == 'Set as Ready':
         SMQC.send_message(SMQC.construct_msg('change_job_state', jsc.tag['cfg_uid'],
                                              {'job_name': job_name, 'new_state': 'IDLE',
@@ -298,40 +564,46 @@ def context_menu_click(jsc, item_text, job_name):
 
 
 def canvas_click(jsc, x, y):
-    for j in jsc.tag['gui_nodes'].values():
-        if j['no_context_menu']:
-            continue
+    # pages hit test clicks themselves and call canvas_click_job, this is kept for pages loaded before that
+    job_name = _hit_test_scene(_get_flow_cache(jsc.tag['cfg_uid'])['scene'], x, y)
+    if job_name is not None:
+        _update_status_and_log(jsc, job_name)
 
-        if abs(x - j['x_render']) < j['icon_radius']:
-            if abs(y - j['y_render']) < j['icon_radius']:
-                _update_status_and_log(jsc, j['name'])
-                return
 
+def canvas_click_job(jsc, job_name):
+    if job_name in _get_flow_cache(jsc.tag['cfg_uid'])['gui_nodes']:
+        _update_status_and_log(jsc, job_name)
 
-def context_menu_request_show(jsc, x, y, page_x, page_y):
-    for j in jsc.tag['gui_nodes'].values():
-        if j['no_context_menu']:
-            continue
 
-        if abs(x - j['x_render']) < j['icon_radius']:
-            if abs(y - j['y_render']) < j['icon_radius']:
-                jsc.eval_js_code(blocking=False, js_code=f"contextMenuShow({page_x}, {page_y}, \"{j['name']}\");")
-                return
+def context_menu_request_show(jsc, x, y, page_x, page_y):
+    # pages hit test clicks themselves and show the context menu directly, this is kept for pages loaded before that
+    job_name = _hit_test_scene(_get_flow_cache(jsc.tag['cfg_uid'])['scene'], x, y)
+    if job_name is not None:
+        jsc.eval_js_code(blocking=False, js_code=f"contextMenuShow({page_x}, {page_y}, {json.dumps(job_name)});")
 
 
 def heartbeat_callback():
+    # group the clients by flow, clients without a cfg_uid don't need to process a heartbeat
+    jscs_by_cfg_uid = {}
     for jsc in get_all_jsclients():
-        # if the jsc does not have cfg_uid we don't need to process a heartbeat
-        if 'cfg_uid' not in jsc.tag:
-            continue
-
-        # check if the FlowControllerRPC is alive
-        try:
-            if not SMQC.is_alive(jsc.tag['cfg_uid']):
-                raise Exception('Dead')
-            jsc.eval_js_code(blocking=False, js_code="clear_no_connection();")
-        except Exception as _:
-            jsc.eval_js_code(blocking=False, js_code="show_no_connection();")
+        if 'cfg_uid' in jsc.tag:
+            jscs_by_cfg_uid.setdefault(jsc.tag['cfg_uid'], []).append(jsc)
+
+    for cfg_uid, jscs in jscs_by_cfg_uid.items():
+        # check if the FlowControllerRPC is alive once per flow, only pinging flows which have been quiet
+        alive = time.monotonic() - FLOW_LAST_SEEN.get(cfg_uid, float('-inf')) < HEARTBEAT_INTERVAL
+        if not alive:
+            try:
+                alive = SMQC.is_alive(cfg_uid)
+            except Exception as _:
+                alive = False
+
+        # only tell the clients whose connection indicator is wrong
+        for jsc in jscs:
+            if jsc.tag.get('connected', None) != alive:
+                jsc.tag['connected'] = alive
+                js_code = "clear_no_connection();" if alive else "show_no_connection();"
+                jsc.eval_js_code(blocking=False, js_code=js_code)
 
 
 def ready_cfg_view(jsc, *args):
@@ -416,14 +688,12 @@ def reconnect_cfg_view(jsc, *args):
         jsc.eval_js_code(blocking=False, js_code=js)
         return
 
-    try:
-        response = SMQC.send_message(SMQC.construct_msg('request_icon', jsc.tag['cfg_uid'], {}), wait=5)
-        icon = "data:image/png;base64," + response['icon']
+    # check the cached config is current and fetch the icon if it is not cached in one round trip
+    _revalidate_flow_cache(jsc.tag['cfg_uid'], include_icon=True)
+    icon = _get_flow_icon(jsc.tag['cfg_uid'])
+    if icon:
         jsc.eval_js_code(blocking=False, js_code=f"""gLogoImg.src = '{icon}';""")
-    except Exception as _:
-        jsc.tag['icon'] = ''
 
-    refresh_gui_nodes(jsc)
     redraw_canvas(jsc)
 
 
@@ -444,54 +714,95 @@ def reconnect_index(jsc, *_args):
 
 
 def refresh_gui_nodes(jsc):
-    response = SMQC.send_message(SMQC.construct_msg('request_config', jsc.tag['cfg_uid'], {}), wait=5)
-    jsc.tag['config'] = response['config']
-    jsc.eval_js_code(blocking=False, js_code=f"""$('#title').html("{jsc.tag['config']['title']}");""")
-    jsc.tag['gui_nodes'] = _convert_cfg_to_gui_nodes(jsc.tag['config'])
+    # revalidate the cache, the version changes if the FlowController restarted or a cron fire time moved
+    _revalidate_flow_cache(jsc.tag['cfg_uid'])
 
 
 def redraw_canvas(jsc):
-    js = """
-        gCtx.textBaseline = "middle";
-        gBoundingBox = [0, 0, 0, 0];
-        var oldtransform = gCtx.getTransform();
-        gCtx.setTransform();
-        gCtx.fillStyle = "#F8F8F8";
-        gCtx.clearRect(0, 0, gCanvas.width, gCanvas.height);
-        gCtx.fillRect(0, 0, gCanvas.width, gCanvas.height);
-
-        var wh = Math.min(gCanvas.width, gCanvas.height) * 0.85;
-        gCtx.globalAlpha = 0.2;
-        try {
-            gCtx.drawImage(gLogoImg, (gCanvas.width - wh) / 2, (gCanvas.height - wh) / 2, wh, wh);
-        } catch(err) {
-        }
-        gCtx.globalAlpha = 1;
-
-        gCtx.setTransform(oldtransform);
-    """
-    for j in jsc.tag['gui_nodes'].values():
-        js += _generate_draw_job_node_js(j)
-
-    js = f"""
-        gJSCanvasFrame = `{js}`;
-        eval(gJSCanvasFrame);
-        """
-    jsc.eval_js_code(blocking=False, js_code=js)
+    # the scene is only sent if the client does not have the current one, state changes are sent as diffs
+    entry = _get_flow_cache(jsc.tag['cfg_uid'])
+    jsc.eval_js_code(blocking=False, js_code=f"""$('#title').html("{entry['config']['title']}");""")
+    if jsc.tag.get('scene', None) is not entry['scene']:
+        jsc.tag['scene'] = entry['scene']
+        scene_json = _get_flow_scene_json(jsc.tag['cfg_uid'])
+        jsc.eval_js_code(blocking=False, js_code=f"canvasSceneLoad({scene_json}); canvasViewportRequestRedraw();")
+    else:
+        jsc.eval_js_code(blocking=False, js_code="canvasViewportRequestRedraw();")
 
 
 def on_job_log_changed(msg, _smc):
+    # the controller already coalesces log output into at most one message per job per log_changed_interval.  Only
+    # the clients showing the job fetch the bytes added after what they already have, once per distinct offset
+    _mark_flow_seen(msg['sender_id'])
+    payload = msg['payload']
+    responses = {}
     for jsc in get_all_jsclients():
         if jsc.tag.get('cfg_uid', None) == msg['sender_id']:
-            if jsc.tag.get('current_job_selected', None) == msg['payload']['job_name']:
-                _update_status_and_log(jsc, jsc.tag['current_job_selected'])
+            if jsc.tag.get('current_job_selected', None) == payload['job_name']:
+                # clients which fell too far behind start over at the end of the log
+                offset = jsc.tag.get('log_offset', None)
+                if offset is not None and 'offset' in payload:
+                    if payload['offset'] + payload['length'] - offset > MAX_LOG_CHUNK_SIZE:
+                        offset = None
+                if offset not in responses:
+                    responses[offset] = _fetch_log_tail(msg['sender_id'], payload['job_name'], offset)
+                _show_log(jsc, responses[offset], replace=offset is None)
+
+
+def on_config_changed(msg, _smc):
+    # patch the cached config with the change set, or fetch the whole config if the change set is not enough.  Either
+    # way the layout is computed once for all of the clients showing the flow
+    _mark_flow_seen(msg['sender_id'])
+    if not _patch_flow_cache(msg['sender_id'], msg['payload']):
+        _invalidate_flow_cache(msg['sender_id'], include_icon=msg['payload'].get('full', True))
+    jscs = [jsc for jsc in get_all_jsclients() if jsc.tag.get('cfg_uid', None) == msg['sender_id']]
+    if jscs:
+        icon = _get_flow_icon(msg['sender_id'])
+        for jsc in jscs:
+            if icon:
+                jsc.eval_js_code(blocking=False, js_code=f"""gLogoImg.src = '{icon}';""")
+            redraw_canvas(jsc)
+
+
+def on_job_state_changed(msg, _smc):
+    # only the state of one job changed, so update the cached gui node in place instead of fetching the config
+    _mark_flow_seen(msg['sender_id'])
+    with FLOW_CACHE_LOCK:
+        entry = FLOW_CACHE.get(msg['sender_id'], None)
+    if entry is None:
+        return
+    job_name = msg['payload']['job_name']
+    job_state = JobState[msg['payload']['new_state']]
+    with entry['lock']:
+        if entry['config'] is None:
+            return
+        if job_name not in entry['gui_nodes']:
+            entry['config'] = None
+            entry['version'] = None
+            js = None
+        else:
+            gn = entry['gui_nodes'][job_name]
+            _set_gui_node_state(gn, job_state)
+            entry['config']['jobs'][job_name]['state'] = job_state.name
+            # only the state is patched, so the cache is current only if this was the one change since its version
+            if _is_next_config_version(entry['version'], msg['payload'].get('version', None)):
+                entry['version'] = msg['payload']['version']
+            else:
+                entry['version'] = None
 
+            # patch the cached scene for clients which load it later, and send clients which have it a small diff
+            node_index = entry['scene']['index'][job_name]
+            entry['scene']['nodes'][node_index][6:8] = [gn['icon_color'], gn['link_color']]
+            entry['scene_json'] = None
+            js = f"canvasSceneSetNodeColors({node_index}, {json.dumps(gn['icon_color'])}, " + \
+                 f"{json.dumps(gn['link_color'])}); canvasViewportRequestRedraw();"
 
-def on_job_state_changed_or_on_config_changed(msg, _smc):
     for jsc in get_all_jsclients():
         if jsc.tag.get('cfg_uid', None) == msg['sender_id']:
-            refresh_gui_nodes(jsc)
-            redraw_canvas(jsc)
+            if js is not None and jsc.tag.get('scene', None) is entry['scene']:
+                jsc.eval_js_code(blocking=False, js_code=js)
+            else:
+                redraw_canvas(jsc)
 
 
 # --------------------------------------------------
@@ -500,20 +811,34 @@ def on_job_state_changed_or_on_config_changed(msg, _smc):
 def run(args):
     global SMQC
 
-    # configure the SMQ Client
+    # configure the SMQ Client, request_profile sent to the webapp turns profiling of the webapp on or off
     SMQC = SMQ_Client('http://' + args['smq_server'], 'Flow Controller WebApp', 'Flow Controller WebApp', ['WebApp'],
-                      ['change_job_state', 'ping', 'reload_config', 'request_config', 'request_icon',
-                       'request_log_chunk', 'trigger_job'],
-                      ['config_changed', 'job_log_changed', 'job_state_changed'])
-    SMQC.add_message_handler('config_changed', on_job_state_changed_or_on_config_changed)
-    SMQC.add_message_handler('job_state_changed', on_job_state_changed_or_on_config_changed)
-    SMQC.add_message_handler('job_log_changed', on_job_log_changed)
+                      ['change_job_state', 'kill_job', 'ping', 'reload_config', 'request_batch', 'request_config',
+                       'request_config_if_changed', 'request_icon', 'request_log_chunk', 'request_log_tail',
+                       'request_metrics', 'trigger_job'],
+                      ['config_changed', 'job_log_changed', 'job_state_changed', 'request_profile'])
+    profile_dir = args.get('profile_dir', None) or 'profiles'
+    handlers = {'config_changed': on_config_changed,
+                'job_state_changed': on_job_state_changed,
+                'job_log_changed': on_job_log_changed,
+                'request_profile': lambda msg, _smqc: FlowController_profile.PROFILER.handle_request(
+                    msg['payload'], profile_dir, 'FlowControllerWebApp')}
+    for action, handler in handlers.items():
+        SMQC.add_message_handler(action, _profiled(action, handler))
     try:
         SMQC.start()
     except ConnectionRefusedError:
         SMQC = None
         logging.error('SMQ Server is not running!')
 
+    # profile from the start if requested
+    if args.get('profile', False):
+        FlowController_profile.PROFILER.start(profile_dir, 'FlowControllerWebApp')
+
+    # serve the metrics of the webapp over http if a port is given
+    if args.get('metrics_port', None) is not None:
+        FlowController_metrics.start_http_server(args['metrics_port'])
+
     # shutdown the SMQ Client on exit
     signal.signal(signal.SIGTERM, lambda _a, _b: SMQC.shutdown())
     signal.signal(signal.SIGINT, lambda _a, _b: SMQC.shutdown())
@@ -524,8 +849,8 @@ def run(args):
     run_kwargs['default_html'] = default_html_page
     run_kwargs['port'] = 7010
     run_kwargs['html_dir'] = os.path.dirname(__file__)
-    run_kwargs['heartbeat_callback'] = heartbeat_callback
-    run_kwargs['heartbeat_interval'] = 1
+    run_kwargs['heartbeat_callback'] = _profiled('heartbeat', heartbeat_callback)
+    run_kwargs['heartbeat_interval'] = HEARTBEAT_INTERVAL
     run_kwargs['internal_polling_interval'] = 0.05
 
     # init the auth method
@@ -538,8 +863,11 @@ def run(args):
         auth_plugin = pluginDevAuth()
     run_kwargs['plugins'] = [auth_plugin]
 
-    # run the application
-    run_pylinkjs_app(**run_kwargs)
+    # run the application, writing the last profile on exit
+    try:
+        run_pylinkjs_app(**run_kwargs)
+    finally:
+        FlowController_profile.PROFILER.stop()
 
 
 def console_entry():
@@ -552,6 +880,12 @@ def console_entry():
         parser.add_argument('--oauth2_clientid', help='google oath2 client id')
         parser.add_argument('--oauth2_redirect_url', help='google oath2 redirect url', default='http://localhost:7010')
         parser.add_argument('--oauth2_secret', help='google oath2 secret')
+        parser.add_argument('--profile', action='store_true', help='sample the SMQ message handlers and the ' +
+                                                                   'heartbeat and trace allocations, writing the ' +
+                                                                   'profiles to --profile_dir')
+        parser.add_argument('--profile_dir', default='profiles', help='directory to write profiles to')
+        parser.add_argument('--metrics_port', type=int, help='port to serve the metrics of the webapp on at /metrics ' +
+                                                             'in the Prometheus text format')
         args = parser.parse_args()
 
         # setup logging
@@ -6,8 +6,14 @@ var gCanvasViewPortCanvas;
 var gCanvasViewPortCtx;
 var gCanvasViewportPanning = false;
 var gCanvasViewportPanningOrigin = [0, 0];
+var gCanvasViewportRedrawRequested = false;
 var gCanvasViewportRefreshHandler;
 var gCanvasViewPortZoom = 1.0;
+var gCanvasScene = null;
+
+// below these zoom levels text is not drawn and edges are drawn as straight lines
+var CANVAS_SCENE_TEXT_MIN_ZOOM = 0.4;
+var CANVAS_SCENE_CURVE_MIN_ZOOM = 0.2;
 
 
 function canvasViewportInit(canvasId, refreshHandler) {
@@ -48,14 +54,11 @@ function canvasViewportMousedown(e) {
 
 function canvasViewportMousemove(e) {
     if (gCanvasViewportPanning) {
-        var oldtransform = gCanvasViewPortCtx.getTransform();
-        gCanvasViewPortCtx.setTransform();
-        gCanvasViewPortCtx.clearRect(0, 0, gCanvasViewPortCanvas.width, gCanvasViewPortCanvas.height);
         gCanvasViewPortCtx.setTransform(
             gCanvasViewPortZoom, 0, 0, gCanvasViewPortZoom,
             e.offsetX - gCanvasViewportPanningOrigin[0],
             e.offsetY - gCanvasViewportPanningOrigin[1]);
-        gCanvasViewportRefreshHandler(); 
+        canvasViewportRequestRedraw();
     }
 }
 
@@ -77,19 +80,188 @@ function canvasViewportMousewheel(e) {
     }
 
     gCanvasViewPortCtx.setTransform();
-    gCanvasViewPortCtx.clearRect(0, 0, gCanvasViewPortCanvas.width, gCanvasViewPortCanvas.height);
     gCanvasViewPortCtx.scale(gCanvasViewPortZoom, gCanvasViewPortZoom);
     gCanvasViewPortCtx.translate(e.offsetX / gCanvasViewPortZoom - (e.offsetX - oldtransform.e) / oldZoom,
                                  e.offsetY / gCanvasViewPortZoom - (e.offsetY - oldtransform.f) / oldZoom);
 
-    gCanvasViewportRefreshHandler();
+    canvasViewportRequestRedraw();
     e.preventDefault();
 }
 
 
+function canvasViewportRequestRedraw() {
+    // redraw at most once per animation frame no matter how many events arrive
+    if (!gCanvasViewportRedrawRequested) {
+        gCanvasViewportRedrawRequested = true;
+        window.requestAnimationFrame(function() {
+            gCanvasViewportRedrawRequested = false;
+            gCanvasViewportRefreshHandler();
+        });
+    }
+}
+
+
 function canvasViewportOffsetXYToAbsoluteXY(x, y) {
     var currentTransform = gCanvasViewPortCtx.getTransform();
     
     return [(x - currentTransform.e) / currentTransform.a,
             (y - currentTransform.f) / currentTransform.d];
-}
\ No newline at end of file
+}
+
+
+/* --------------------------------------------------
+    Scene
+-------------------------------------------------- */
+function canvasSceneLoad(scene) {
+    // scene.nodes are [name, text, x, y, iconRadius, iconShape, iconColor, linkColor, textColor, textX,
+    // textPaddingRight, dependencyLineAfterText], scene.edges are [parentIndex, childIndex, c1x, c1y, c2x, c2y]
+    // where the control points are fractions of the distance between the ends of the edge, scene.grid.cells maps
+    // "cellX,cellY" to the indices of the nodes which can be clicked whose icon overlaps the cell
+    // the width of the text of each node is appended to the node on the first draw
+    gCanvasScene = scene;
+}
+
+
+function canvasSceneHitTest(x, y) {
+    // return the name of the job whose icon contains the absolute point, null if there is none
+    if (gCanvasScene == null) {
+        return null;
+    }
+    var cellSize = gCanvasScene.grid.cellSize;
+    var candidates = gCanvasScene.grid.cells[Math.floor(x / cellSize) + "," + Math.floor(y / cellSize)];
+    if (candidates === undefined) {
+        return null;
+    }
+    for (var i = 0; i < candidates.length; i++) {
+        var n = gCanvasScene.nodes[candidates[i]];
+        if (Math.abs(x - n[2]) < n[4] && Math.abs(y - n[3]) < n[4]) {
+            return n[0];
+        }
+    }
+    return null;
+}
+
+
+function canvasSceneSetNodeColors(nodeIndex, iconColor, linkColor) {
+    gCanvasScene.nodes[nodeIndex][6] = iconColor;
+    gCanvasScene.nodes[nodeIndex][7] = linkColor;
+}
+
+
+function _canvasSceneMeasure(ctx) {
+    // measure the text of every node once and compute the bounding box of the scene
+    var nodes = gCanvasScene.nodes;
+    var boundingBox = [0, 0, 0, 0];
+    ctx.textBaseline = "middle";
+    for (var i = 0; i < nodes.length; i++) {
+        var n = nodes[i];
+        n[12] = ctx.measureText(n[1]).width;
+        boundingBox[0] = Math.min(boundingBox[0], n[2] - n[4]);
+        boundingBox[1] = Math.min(boundingBox[1], n[3] - n[4]);
+        boundingBox[2] = Math.max(boundingBox[2], n[9] + n[12]);
+        boundingBox[3] = Math.max(boundingBox[3], n[3] + n[4]);
+    }
+    gCanvasScene.boundingBox = boundingBox;
+}
+
+
+function canvasSceneDraw(ctx) {
+    // draw the parts of the scene inside the viewport with the current transform of ctx and return the bounding box
+    // of the whole scene.  Text, icon outlines and curves are dropped when zoomed far out
+    if (gCanvasScene == null) {
+        return [0, 0, 0, 0];
+    }
+    if (gCanvasScene.boundingBox === undefined) {
+        _canvasSceneMeasure(ctx);
+    }
+
+    var nodes = gCanvasScene.nodes;
+    var edges = gCanvasScene.edges;
+    var t = ctx.getTransform();
+    var vx0 = -t.e / t.a;
+    var vy0 = -t.f / t.d;
+    var vx1 = (ctx.canvas.width - t.e) / t.a;
+    var vy1 = (ctx.canvas.height - t.f) / t.d;
+    var drawText = t.a >= CANVAS_SCENE_TEXT_MIN_ZOOM;
+    var drawCurves = t.a >= CANVAS_SCENE_CURVE_MIN_ZOOM;
+    ctx.textBaseline = "middle";
+
+    // nodes, when zoomed out the icons are drawn as squares batched into one path per color
+    var squares = {};
+    ctx.strokeStyle = "#B0B0B0";
+    for (var i = 0; i < nodes.length; i++) {
+        var n = nodes[i];
+        if (n[2] - n[4] > vx1 || n[9] + n[12] < vx0 || n[3] - n[4] > vy1 || n[3] + n[4] < vy0) {
+            continue;
+        }
+        if (n[5] == 'circle') {
+            if (drawText) {
+                ctx.beginPath();
+                ctx.fillStyle = n[6];
+                ctx.arc(n[2], n[3], n[4], 0, Math.PI * 2, true);
+                ctx.stroke();
+                ctx.fill();
+            } else {
+                if (!(n[6] in squares)) {
+                    squares[n[6]] = [];
+                }
+                squares[n[6]].push(n);
+            }
+        }
+        if (drawText) {
+            ctx.fillStyle = n[8];
+            ctx.fillText(n[1], n[9], n[3]);
+        }
+    }
+    for (var color in squares) {
+        var batch = squares[color];
+        ctx.beginPath();
+        ctx.fillStyle = color;
+        for (var i = 0; i < batch.length; i++) {
+            ctx.rect(batch[i][2] - batch[i][4], batch[i][3] - batch[i][4], batch[i][4] * 2, batch[i][4] * 2);
+        }
+        ctx.fill();
+    }
+
+    // edges from the end of the parent text, or the parent icon, to the child icon.  Edges are batched into one path
+    // per color, and skipped if the box around their control points is outside the viewport
+    var paths = {};
+    for (var i = 0; i < edges.length; i++) {
+        var e = edges[i];
+        var p = nodes[e[0]];
+        var c = nodes[e[1]];
+        var sx = p[11] ? p[9] + p[12] + p[10] : p[2];
+        var sy = p[3];
+        var ex = c[2] - c[4];
+        var ey = c[3];
+        var c1x = sx + (ex - sx) * e[2];
+        var c1y = sy + (ey - sy) * e[3];
+        var c2x = sx + (ex - sx) * e[4];
+        var c2y = sy + (ey - sy) * e[5];
+        if (Math.min(sx, ex, c1x, c2x) > vx1 || Math.max(sx, ex, c1x, c2x) < vx0 ||
+            Math.min(sy, ey, c1y, c2y) > vy1 || Math.max(sy, ey, c1y, c2y) < vy0) {
+            continue;
+        }
+        if (!(p[7] in paths)) {
+            paths[p[7]] = [];
+        }
+        paths[p[7]].push([sx, sy, c1x, c1y, c2x, c2y, ex, ey]);
+    }
+    for (var color in paths) {
+        var segments = paths[color];
+        ctx.beginPath();
+        ctx.strokeStyle = color;
+        for (var i = 0; i < segments.length; i++) {
+            var g = segments[i];
+            ctx.moveTo(g[0], g[1]);
+            if (drawCurves) {
+                ctx.bezierCurveTo(g[2], g[3], g[4], g[5], g[6], g[7]);
+            } else {
+                ctx.lineTo(g[6], g[7]);
+            }
+        }
+        ctx.stroke();
+    }
+
+    return gCanvasScene.boundingBox;
+}
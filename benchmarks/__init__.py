@@ -0,0 +1,2 @@
+""" micro benchmarks of the Flow Controller scheduler, ledger and webapp layout on synthetic flows.  Run with
+    python -m benchmarks --output results.json """
@@ -0,0 +1,76 @@
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+
+from benchmarks import dag_generator
+from benchmarks.scheduler_benchmarks import compare_results, run_benchmarks
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+def _get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception as _:
+        return None
+
+
+def run(args):
+    """ run the benchmarks, write the results and compare them to a baseline
+
+        Returns:
+            number of regressions found compared to the baseline
+    """
+    report = run_benchmarks(args['shapes'], args['sizes'], args['repeat'], not args['no_webapp'])
+    report['python'] = platform.python_version()
+    report['platform'] = platform.platform()
+    report['git_commit'] = _get_git_commit()
+
+    for r in report['results']:
+        print(f"{r['name']:32} {r['shape'] or '':8} {r['size']:>8} {r['value']:>14.6g} {r['unit']}")
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args['compare']:
+        with open(args['compare'], 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, report, args['tolerance'])
+        for r, base, ratio in regressions:
+            print(f"REGRESSION {r['name']} {r['shape'] or ''} {r['size']}: {r['value']:.6g} {r['unit']}, " +
+                  f"baseline {base:.6g}, {ratio:.2f}x worse")
+    return len(regressions)
+
+
+def console_entry():
+    parser = argparse.ArgumentParser(description='Flow Controller scheduler benchmarks')
+    parser.add_argument('--shapes', nargs='+', choices=dag_generator.SHAPES, default=list(dag_generator.SHAPES),
+                        help='shapes of the synthetic flows')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000], help='numbers of jobs in the ' +
+                                                                                     'synthetic flows')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times cheap measurements are repeated, ' +
+                                                              'the median is reported')
+    parser.add_argument('--no_webapp', action='store_true', help='skip the webapp layout and scene benchmarks')
+    parser.add_argument('--output', help='filename to write the results to as json')
+    parser.add_argument('--compare', help='filename of the json results of a baseline run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction by which a result may be worse ' +
+                                                                      'than the baseline before it is reported')
+    parser.add_argument('--logging_level', default='ERROR')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(args.logging_level),
+                        format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    sys.exit(1 if run(vars(args)) else 0)
+
+
+if __name__ == "__main__":
+    console_entry()
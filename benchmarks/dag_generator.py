@@ -0,0 +1,83 @@
+import os
+
+
+SHAPES = ('chain', 'fanout', 'diamond')
+
+# width of the layers between the join jobs of the diamond shape
+DIAMOND_WIDTH = 10
+
+CFG_TEMPLATE = """CONFIG = {config!r}
+
+
+def get_jobs():
+    return {jobs!r}
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+if __name__ == '__main__':
+    # print the info to stdout
+    CONFIG['jobs'] = get_jobs()
+    print(CONFIG)
+"""
+
+
+def generate_jobs(shape, size, run_cmd='true'):
+    """ generate the jobs of a synthetic flow
+
+        Args:
+            shape - 'chain' where every job depends on the one before it, 'fanout' where every job depends on one
+                    root job, or 'diamond' where layers of DIAMOND_WIDTH jobs depend on the join job before them and
+                    are joined by the next join job
+            size - number of jobs
+            run_cmd - command run by every job
+
+        Returns:
+            list of job dicts in config order, parents before children
+    """
+    if shape not in SHAPES:
+        raise Exception(f'Unknown shape {shape}, expected one of {SHAPES}')
+
+    jobs = []
+    for i in range(0, size):
+        if i == 0:
+            depends = []
+        elif shape == 'chain':
+            depends = [f'job{i - 1}']
+        elif shape == 'fanout':
+            depends = ['job0']
+        else:
+            # job 0 is the first join, then each group of DIAMOND_WIDTH jobs is followed by a join of the group
+            group_start = (i - 1) // (DIAMOND_WIDTH + 1) * (DIAMOND_WIDTH + 1) + 1
+            if i - group_start < DIAMOND_WIDTH:
+                depends = [f'job{group_start - 1}']
+            else:
+                depends = [f'job{j}' for j in range(group_start, i)]
+        jobs.append({'name': f'job{i}', 'depends': depends, 'run_cmd': run_cmd})
+    return jobs
+
+
+def write_cfg(directory, shape, size, run_cmd='true', **config):
+    """ write the cfg file of a synthetic flow
+
+        Args:
+            directory - directory to write the cfg file, job logs and ledgers to
+            shape - shape of the graph, see generate_jobs
+            size - number of jobs
+            run_cmd - command run by every job
+            config - values of the CONFIG dict which override the defaults
+
+        Returns:
+            filename of the cfg file
+    """
+    uid = f'bench_{shape}_{size}'
+    cfg = {'title': f'Benchmark {shape} {size}', 'uid': uid, 'job_logs_dir': 'job_logs', 'ledger_dir': 'ledgers',
+           'smq_server': 'localhost:6050'}
+    cfg.update(config)
+    filename = os.path.join(directory, f'{uid}.py.cfg')
+    with open(filename, 'w') as f:
+        f.write(CFG_TEMPLATE.format(config=cfg, jobs=generate_jobs(shape, size, run_cmd)))
+    for d in (cfg['job_logs_dir'], cfg['ledger_dir']):
+        os.makedirs(os.path.join(directory, d), exist_ok=True)
+    return filename
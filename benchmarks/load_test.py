@@ -0,0 +1,276 @@
+""" end to end load test of a FlowController.  Starts an SMQ_Server in process, a FlowController in a child process
+    running a synthetic flow of fast jobs, and simulated webapp clients which subscribe to the broadcasts.  Run with
+    python -m benchmarks.load_test --jobs 2000 --clients 20 --output load.json """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import argparse
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from SimpleMessageQueue.SMQ_Client import SMQ_Client
+from SimpleMessageQueue.SMQ_Server import SMQ_Server
+
+from benchmarks import dag_generator
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class SimulatedWebAppClient():
+    """ subscribes to the broadcasts the webapp subscribes to and records when each job state change arrives """
+    def __init__(self, smq_server_url, index):
+        self.message_count = 0
+        self.state_times = {}
+        self._lock = threading.Lock()
+        self._smqc = SMQ_Client(smq_server_url, f'LoadTest_WebApp_{index}', f'LoadTest_WebApp_{index}', ['WebApp'],
+                                [], ['config_changed', 'job_log_changed', 'job_state_changed'])
+        self._smqc.add_message_handler('config_changed', self._on_message)
+        self._smqc.add_message_handler('job_log_changed', self._on_message)
+        self._smqc.add_message_handler('job_state_changed', self._on_job_state_changed)
+
+    def _on_message(self, _msg, _smqc):
+        with self._lock:
+            self.message_count += 1
+
+    def _on_job_state_changed(self, msg, _smqc):
+        now = time.time()
+        with self._lock:
+            self.message_count += 1
+            self.state_times.setdefault(msg['payload']['job_name'], {})[msg['payload']['new_state']] = now
+
+    def count_state(self, state):
+        """ return the number of jobs which reached a state """
+        with self._lock:
+            return sum(1 for times in self.state_times.values() if state in times)
+
+    def start(self):
+        self._smqc.start()
+
+    def stop(self):
+        self._smqc.stop()
+
+
+class ProcessSampler():
+    """ samples the cpu time and memory of a process from /proc while the load test runs """
+    def __init__(self, pid, interval=0.5):
+        self._interval = interval
+        self._pid = pid
+        self._stop = threading.Event()
+        self._thread = None
+        self.cpu_seconds_start = None
+        self.cpu_seconds_end = None
+        self.peak_rss_mb = 0
+
+    def _read_cpu_seconds(self):
+        with open(f'/proc/{self._pid}/stat', 'r') as f:
+            # the command name may contain spaces, the fields after it are fixed
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def _read_rss_mb(self):
+        with open(f'/proc/{self._pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+        return 0
+
+    def _sample(self):
+        try:
+            self.cpu_seconds_end = self._read_cpu_seconds()
+            self.peak_rss_mb = max(self.peak_rss_mb, self._read_rss_mb())
+        except (OSError, IndexError, ValueError):
+            # the process exited
+            pass
+
+    def _threadworker_sample(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def start(self):
+        self.cpu_seconds_start = self._read_cpu_seconds()
+        self._thread = threading.Thread(target=self._threadworker_sample, name='ProcessSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def percentiles(values, points=(50, 90, 99, 100)):
+    """ return a dict of 'p<point>' to the nearest rank percentile of the values, None if there are no values """
+    values = sorted(values)
+    result = {}
+    for p in points:
+        result[f'p{p}'] = values[max(0, -(-len(values) * p // 100) - 1)] if values else None
+    return result
+
+
+def summarize(trigger_time, clients, job_names):
+    """ summarize the job state changes seen by the simulated clients
+
+        Args:
+            trigger_time - time.time() when the root job was triggered
+            clients - list of SimulatedWebAppClient
+            job_names - names of the jobs which were expected to run
+
+        Returns:
+            dict of latency percentiles in seconds, message counts and delivery statistics
+    """
+    times = clients[0].state_times
+    pending_to_running = []
+    running_to_success = []
+    trigger_to_success = []
+    for jn in job_names:
+        t = times.get(jn, {})
+        if 'PENDING' in t and 'RUNNING' in t:
+            pending_to_running.append(t['RUNNING'] - t['PENDING'])
+        if 'RUNNING' in t and 'SUCCESS' in t:
+            running_to_success.append(t['SUCCESS'] - t['RUNNING'])
+        if 'SUCCESS' in t:
+            trigger_to_success.append(t['SUCCESS'] - trigger_time)
+
+    transitions = sum(len(t) for t in times.values())
+    # time at which each client saw the last job succeed
+    finished = [max(t['SUCCESS'] for t in c.state_times.values() if 'SUCCESS' in t) for c in clients
+                if c.count_state('SUCCESS')]
+    return {'jobs_succeeded': len(trigger_to_success),
+            'jobs_expected': len(job_names),
+            'wall_seconds': max(finished) - trigger_time if finished else None,
+            'pending_to_running_seconds': percentiles(pending_to_running),
+            'running_to_success_seconds': percentiles(running_to_success),
+            'trigger_to_success_seconds': percentiles(trigger_to_success),
+            'state_transitions': transitions,
+            'messages_per_client': [c.message_count for c in clients],
+            'messages_per_transition': clients[0].message_count / transitions if transitions else None,
+            'client_finish_spread_seconds': max(finished) - min(finished) if finished else None}
+
+
+def _start_smq_server():
+    """ start an SMQ_Server on a free port in a background thread and return it with its port """
+    server = SMQ_Server('localhost', 0)
+    threading.Thread(target=server.start, daemon=True).start()
+    for _ in range(0, 50):
+        time.sleep(0.1)
+        try:
+            return server, server._rpc_server.server_address[1]
+        except Exception as _:
+            pass
+    raise Exception('SMQ Server did not start')
+
+
+def run_load_test(num_jobs, num_clients, max_concurrent_jobs=32, run_cmd='echo done', timeout=600):
+    """ run one load test
+
+        Args:
+            num_jobs - number of jobs which fan out from the root job
+            num_clients - number of simulated webapp clients
+            max_concurrent_jobs - maximum number of jobs the FlowController runs at once
+            run_cmd - command run by every job
+            timeout - seconds to wait for all of the jobs to succeed
+
+        Returns:
+            dict with the parameters and the results of the load test
+    """
+    server, port = _start_smq_server()
+    smq_server_url = f'http://localhost:{port}'
+    clients = []
+    controller = None
+    terminal = None
+    with tempfile.TemporaryDirectory() as d:
+        try:
+            cfg_filename = dag_generator.write_cfg(d, 'fanout', num_jobs + 1, run_cmd=run_cmd,
+                                                   smq_server=f'localhost:{port}',
+                                                   max_concurrent_jobs=max_concurrent_jobs)
+            uid = f'bench_fanout_{num_jobs + 1}'
+            job_names = [f'job{i}' for i in range(0, num_jobs + 1)]
+
+            # the FlowController runs in its own process so its cpu and memory can be measured
+            start = time.time()
+            controller = subprocess.Popen([sys.executable, '-m', 'FlowController.FlowController', '--config',
+                                           cfg_filename, '--start'],
+                                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            terminal = SMQ_Client(smq_server_url, 'LoadTest_Terminal', 'LoadTest_Terminal', ['LoadTest'],
+                                  ['trigger_job'], [])
+            terminal.start()
+            while uid not in terminal.get_info_for_all_clients():
+                if controller.poll() is not None or time.time() - start > timeout:
+                    raise Exception('FlowController did not start')
+                time.sleep(0.2)
+            startup_seconds = time.time() - start
+
+            for i in range(0, num_clients):
+                clients.append(SimulatedWebAppClient(smq_server_url, i))
+                clients[-1].start()
+            sampler = ProcessSampler(controller.pid)
+            sampler.start()
+
+            trigger_time = time.time()
+            terminal.send_message(terminal.construct_msg('trigger_job', uid, {'job_name': 'job0',
+                                                                              'reason': 'load test'}), wait=5)
+            while clients[0].count_state('SUCCESS') < len(job_names) and time.time() - trigger_time < timeout:
+                time.sleep(0.1)
+            # give the other clients a moment to receive the last broadcasts
+            time.sleep(1)
+            sampler.stop()
+
+            result = summarize(trigger_time, clients, job_names)
+            result.update({'created': datetime.datetime.now().isoformat(), 'jobs': num_jobs, 'clients': num_clients,
+                           'max_concurrent_jobs': max_concurrent_jobs, 'run_cmd': run_cmd,
+                           'controller_startup_seconds': startup_seconds,
+                           'controller_cpu_seconds': sampler.cpu_seconds_end - sampler.cpu_seconds_start,
+                           'controller_peak_rss_mb': sampler.peak_rss_mb})
+            return result
+        finally:
+            # stop the FlowController before its ledger directory is removed
+            for c in clients:
+                c.stop()
+            if terminal is not None:
+                terminal.stop()
+            if controller is not None:
+                controller.terminate()
+                try:
+                    controller.wait(10)
+                except subprocess.TimeoutExpired:
+                    controller.kill()
+            server.shutdown()
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+def console_entry():
+    parser = argparse.ArgumentParser(description='Flow Controller end to end load test')
+    parser.add_argument('--jobs', type=int, default=1000, help='number of jobs which fan out from the root job')
+    parser.add_argument('--clients', type=int, default=10, help='number of simulated webapp clients')
+    parser.add_argument('--max_concurrent_jobs', type=int, default=32, help='maximum number of jobs the ' +
+                                                                            'FlowController runs at once')
+    parser.add_argument('--run_cmd', default='echo done', help='command run by every job')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds to wait for all of the jobs to succeed')
+    parser.add_argument('--output', help='filename to write the results to as json')
+    parser.add_argument('--logging_level', default='ERROR')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(args.logging_level),
+                        format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    result = run_load_test(args.jobs, args.clients, args.max_concurrent_jobs, args.run_cmd, args.timeout)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    sys.exit(0 if result['jobs_succeeded'] == result['jobs_expected'] else 1)
+
+
+if __name__ == "__main__":
+    console_entry()
@@ -0,0 +1,244 @@
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from FlowController.FlowController import JobManager, JobState
+from FlowController.FlowController_util import FlowControllerBinaryLedger, FlowControllerLedger
+from benchmarks import dag_generator
+
+try:
+    import FlowControllerWebApp.__main__ as webapp
+except ImportError:
+    # the webapp depends on pylinkjs which is not needed to run the scheduler benchmarks
+    webapp = None
+
+
+class NullSMQClient():
+    """ stands in for the SMQ_Client of the controller and counts the messages instead of sending them """
+    def __init__(self):
+        self.message_count = 0
+
+    def construct_msg(self, action, target_id, payload):
+        return {'action': action, 'target_id': target_id, 'payload': payload}
+
+    def send_message(self, msg, wait=0):
+        self.message_count += 1
+
+
+class _FakeJSClient():
+    """ stands in for a pylinkjs client and discards the javascript sent to it """
+    def __init__(self, cfg_uid):
+        self.tag = {'cfg_uid': cfg_uid}
+
+    def eval_js_code(self, blocking=False, js_code=''):
+        pass
+
+
+def _measure(fn, repeat):
+    """ return the median number of seconds one call of fn takes over repeat calls """
+    timings = []
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _result(name, shape, size, value, unit, **extra):
+    return dict({'name': name, 'shape': shape, 'size': size, 'value': value, 'unit': unit}, **extra)
+
+
+def benchmark_job_manager(directory, shape, size, repeat):
+    """ benchmark the scheduler hot paths of JobManager on a synthetic flow.  The flow allows no jobs to run at once,
+        so jobs which become PENDING stay queued and no processes are started
+
+        Returns:
+            list of result dicts
+    """
+    # max_concurrent_jobs of 0 keeps the benchmark in the scheduler, nothing is executed
+    cfg_filename = dag_generator.write_cfg(directory, shape, size, max_concurrent_jobs=0)
+    results = []
+    smqc = NullSMQClient()
+
+    start = time.perf_counter()
+    job_manager = JobManager(cfg_filename)
+    results.append(_result('load_config', shape, size, time.perf_counter() - start, 'seconds'))
+    try:
+        start = time.perf_counter()
+        job_manager.get_config_snapshot(smqc)
+        results.append(_result('get_config_snapshot_cold', shape, size, time.perf_counter() - start, 'seconds'))
+        results.append(_result('get_config_snapshot_cached', shape, size,
+                               _measure(lambda: job_manager.get_config_snapshot(smqc), repeat * 100), 'seconds'))
+
+        def change_and_snapshot():
+            job_manager.change_job_state(smqc, 'job0', JobState.FAILURE, 'benchmark')
+            job_manager.get_config_snapshot(smqc)
+        results.append(_result('get_config_snapshot_one_change', shape, size, _measure(change_and_snapshot, repeat),
+                               'seconds'))
+
+        job_manager.process_jobs(smqc)
+        results.append(_result('process_jobs_idle_tick', shape, size,
+                               _measure(lambda: job_manager.process_jobs(smqc), repeat * 100), 'seconds'))
+
+        # the root succeeding makes its children ready, which one tick moves to PENDING
+        job_manager.change_job_state(smqc, 'job0', JobState.SUCCESS, 'benchmark')
+        message_count = smqc.message_count
+        start = time.perf_counter()
+        job_manager.process_jobs(smqc)
+        results.append(_result('process_jobs_ready_tick', shape, size, time.perf_counter() - start, 'seconds',
+                               state_changes=smqc.message_count - message_count))
+
+        # every change is written to the ledger and broadcast
+        job_names = [f'job{i}' for i in range(1, size)]
+        start = time.perf_counter()
+        for jn in job_names:
+            job_manager.change_job_state(smqc, jn, JobState.SUCCESS, 'benchmark')
+        elapsed = time.perf_counter() - start
+        results.append(_result('change_job_state', shape, size, len(job_names) / elapsed, 'ops_per_second'))
+    finally:
+        job_manager.shutdown()
+    return results
+
+
+def benchmark_ledger(directory, size):
+    """ benchmark appending and reading size records with the csv and the binary ledger
+
+        Returns:
+            list of result dicts
+    """
+    results = []
+    ledger_dir = os.path.join(directory, 'ledger_benchmark')
+    os.makedirs(ledger_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    for i in range(0, size):
+        FlowControllerLedger.append(ledger_dir, 'csv', f'job{i}', 'SUCCESS', 'benchmark')
+    results.append(_result('csv_ledger_append', None, size, size / (time.perf_counter() - start), 'ops_per_second'))
+    start = time.perf_counter()
+    FlowControllerLedger.read(ledger_dir, 'csv')
+    results.append(_result('csv_ledger_read', None, size, time.perf_counter() - start, 'seconds'))
+
+    ledger = FlowControllerBinaryLedger(ledger_dir, 'bin')
+    ledger.open()
+    start = time.perf_counter()
+    for i in range(0, size):
+        ledger.append(f'job{i}', 'SUCCESS', 'benchmark')
+    ledger.sync()
+    results.append(_result('binary_ledger_append', None, size, size / (time.perf_counter() - start),
+                           'ops_per_second'))
+    ledger.close()
+    start = time.perf_counter()
+    ledger.read()
+    results.append(_result('binary_ledger_read', None, size, time.perf_counter() - start, 'seconds'))
+    start = time.perf_counter()
+    ledger.open()
+    results.append(_result('binary_ledger_open', None, size, time.perf_counter() - start, 'seconds'))
+    ledger.close()
+    return results
+
+
+def benchmark_webapp(directory, shape, size, repeat):
+    """ benchmark the layout and the scene the webapp sends to the browser for a synthetic flow
+
+        Returns:
+            list of result dicts, empty if the webapp can not be imported
+    """
+    if webapp is None:
+        return []
+    cfg_filename = dag_generator.write_cfg(directory, shape, size, max_concurrent_jobs=0)
+    job_manager = JobManager(cfg_filename)
+    try:
+        snapshot = job_manager.get_config_snapshot(None)
+    finally:
+        job_manager.shutdown()
+    # round trip through json the same way the config arrives over the message queue
+    config = json.loads(json.dumps(snapshot['config'], default=str))
+
+    results = []
+
+    def convert():
+        webapp._compute_layout.cache_clear()
+        return webapp._convert_cfg_to_gui_nodes(json.loads(json.dumps(config)))
+    results.append(_result('convert_cfg_to_gui_nodes', shape, size, _measure(convert, repeat), 'seconds'))
+
+    gui_nodes = convert()
+    results.append(_result('generate_scene', shape, size, _measure(lambda: webapp._generate_scene(gui_nodes), repeat),
+                           'seconds'))
+
+    # populate the flow cache the way a request_config_if_changed response does
+    cfg_uid = config['uid']
+    entry = webapp._get_flow_cache_entry(cfg_uid)
+    with entry['lock']:
+        entry['config'] = config
+        entry['version'] = snapshot['version']
+        entry['gui_nodes'] = gui_nodes
+
+    def redraw_new_scene():
+        with entry['lock']:
+            entry['scene'] = webapp._generate_scene(gui_nodes)
+            entry['scene_json'] = None
+        webapp.redraw_canvas(_FakeJSClient(cfg_uid))
+    results.append(_result('redraw_canvas_new_scene', shape, size, _measure(redraw_new_scene, repeat), 'seconds'))
+
+    jsc = _FakeJSClient(cfg_uid)
+    webapp.redraw_canvas(jsc)
+    results.append(_result('redraw_canvas_cached_scene', shape, size, _measure(lambda: webapp.redraw_canvas(jsc),
+                                                                               repeat * 100), 'seconds'))
+    with webapp.FLOW_CACHE_LOCK:
+        del webapp.FLOW_CACHE[cfg_uid]
+    return results
+
+
+def run_benchmarks(shapes, sizes, repeat=5, include_webapp=True):
+    """ run the benchmark suite
+
+        Args:
+            shapes - list of graph shapes, see dag_generator.SHAPES
+            sizes - list of numbers of jobs
+            repeat - number of times the cheap measurements are repeated, the median is reported
+            include_webapp - also benchmark the webapp layout and scene
+
+        Returns:
+            dict with information about the environment and a list of results, each with a name, the shape and size
+            of the flow, a value and the unit of the value
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for size in sizes:
+            results.extend(benchmark_ledger(os.path.join(d, f'ledger_{size}'), size))
+            for shape in shapes:
+                directory = os.path.join(d, f'{shape}_{size}')
+                os.makedirs(directory)
+                results.extend(benchmark_job_manager(directory, shape, size, repeat))
+                if include_webapp:
+                    results.extend(benchmark_webapp(directory, shape, size, repeat))
+
+    return {'created': datetime.datetime.now().isoformat(), 'webapp_included': include_webapp and webapp is not None,
+            'results': results}
+
+
+def compare_results(baseline, current, tolerance):
+    """ compare two benchmark runs
+
+        Args:
+            baseline - result of run_benchmarks of the reference version
+            current - result of run_benchmarks of the version under test
+            tolerance - fraction by which a result may be worse than the baseline before it is a regression
+
+        Returns:
+            list of (result, baseline value, ratio of current to baseline where above 1 is worse) for every
+            regression
+    """
+    baseline_values = {(r['name'], r['shape'], r['size']): r['value'] for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        base = baseline_values.get((r['name'], r['shape'], r['size']), None)
+        if not base or not r['value']:
+            continue
+        ratio = base / r['value'] if r['unit'] == 'ops_per_second' else r['value'] / base
+        if ratio > 1 + tolerance:
+            regressions.append((r, base, ratio))
+    return regressions
@@ -15,6 +15,7 @@ setup(name='FlowController',
       packages=['FlowController', 'FlowControllerWebApp'],
       include_package_data=True,
       install_requires=read_requirements(),
+      extras_require={'analytics': ['pandas']},
       entry_points={
         'console_scripts': ['FlowControllerWebApp=FlowControllerWebApp.__main__:console_entry',
                             'FlowController=FlowController.FlowController:console_entry',],
@@ -0,0 +1,62 @@
+""" unit tests for Flow Controller benchmarks """
+import threading
+import unittest
+from benchmarks import dag_generator, load_test
+from benchmarks.scheduler_benchmarks import compare_results, run_benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    """ Test Class for Flow Controller benchmarks """
+    def test_generate_jobs(self):
+        """ test the synthetic flows have the requested shape """
+        chain = dag_generator.generate_jobs('chain', 3)
+        assert([j['depends'] for j in chain] == [[], ['job0'], ['job1']])
+        fanout = dag_generator.generate_jobs('fanout', 3)
+        assert([j['depends'] for j in fanout] == [[], ['job0'], ['job0']])
+        diamond = dag_generator.generate_jobs('diamond', 2 * (dag_generator.DIAMOND_WIDTH + 1) + 1)
+        assert(diamond[dag_generator.DIAMOND_WIDTH]['depends'] == ['job0'])
+        assert(len(diamond[dag_generator.DIAMOND_WIDTH + 1]['depends']) == dag_generator.DIAMOND_WIDTH)
+        assert(diamond[dag_generator.DIAMOND_WIDTH + 2]['depends'] == [f'job{dag_generator.DIAMOND_WIDTH + 1}'])
+        with self.assertRaises(Exception):
+            dag_generator.generate_jobs('star', 3)
+
+    def test_run_and_compare(self):
+        """ test a small run produces results for every shape and a slower run is reported as a regression """
+        report = run_benchmarks(['chain', 'fanout'], [20], repeat=1, include_webapp=False)
+        names = set((r['name'], r['shape']) for r in report['results'])
+        assert(('process_jobs_ready_tick', 'fanout') in names)
+        assert(('binary_ledger_append', None) in names)
+        ready_tick = [r for r in report['results'] if r['name'] == 'process_jobs_ready_tick' and
+                      r['shape'] == 'fanout'][0]
+        assert(ready_tick['state_changes'] == 19)
+
+        assert(compare_results(report, report, 0.25) == [])
+        slower = {'results': [dict(r, value=r['value'] * 2 if r['unit'] == 'seconds' else r['value'] / 2)
+                              for r in report['results']]}
+        assert(len(compare_results(report, slower, 0.25)) == len(report['results']))
+
+    def test_summarize(self):
+        """ test the load test latency percentiles and message counts """
+        assert(load_test.percentiles([]) == {'p50': None, 'p90': None, 'p99': None, 'p100': None})
+        assert(load_test.percentiles(list(range(1, 101)), (50, 99, 100)) == {'p50': 50, 'p99': 99, 'p100': 100})
+
+        class Client(load_test.SimulatedWebAppClient):
+            def __init__(self, state_times, message_count):
+                self._lock = threading.Lock()
+                self.message_count = message_count
+                self.state_times = state_times
+
+        clients = [Client({'job0': {'PENDING': 1.0, 'RUNNING': 1.5, 'SUCCESS': 3.0},
+                           'job1': {'PENDING': 3.0, 'RUNNING': 4.0}}, 10),
+                   Client({'job0': {'SUCCESS': 3.5}}, 9)]
+        result = load_test.summarize(0.5, clients, ['job0', 'job1'])
+        assert(result['jobs_succeeded'] == 1)
+        assert(result['pending_to_running_seconds']['p100'] == 1.0)
+        assert(result['trigger_to_success_seconds']['p50'] == 2.5)
+        assert(result['messages_per_transition'] == 2)
+        assert(result['client_finish_spread_seconds'] == 0.5)
+        assert(result['wall_seconds'] == 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
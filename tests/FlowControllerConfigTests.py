@@ -0,0 +1,64 @@
+""" unit tests for Flow Controller config loading """
+import os
+import tempfile
+import unittest
+from unittest import mock
+from FlowController import FlowController_util
+from FlowController.FlowController_util import read_cfg_file
+
+
+CFG_TEMPLATE = """
+import decimal
+CONFIG = {'title': 'test', 'uid': 'test', 'job_logs_dir': 'logs', 'ledger_dir': 'logs', 'smq_server': 'localhost:1',
+          'value': %s}
+if __name__ == '__main__':
+    print('debug output which is not the config')
+    CONFIG['jobs'] = [{'name': 'job0'}]
+    print(CONFIG)
+"""
+
+
+class TestConfig(unittest.TestCase):
+    """ Test Class for Flow Controller config loading """
+    def _write_cfg(self, d, value):
+        filename = os.path.join(d, 'test.py.cfg')
+        with open(filename, 'w') as f:
+            f.write(CFG_TEMPLATE % value)
+        return filename
+
+    def test_cache(self):
+        """ test an unchanged cfg file is not evaluated again, a changed or forced one is """
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(FlowController_util, '_evaluate_cfg_file',
+                                  wraps=FlowController_util._evaluate_cfg_file) as evaluate:
+            filename = self._write_cfg(d, '1')
+            cfg = read_cfg_file(filename)
+            assert(cfg['value'] == 1)
+            assert(list(cfg['jobs'].keys()) == ['job0'])
+            assert(evaluate.call_count == 1)
+
+            # callers own the returned dict
+            cfg['jobs']['job0']['state'] = 'modified'
+            assert('state' not in read_cfg_file(filename)['jobs']['job0'])
+            assert(evaluate.call_count == 1)
+
+            self._write_cfg(d, '2')
+            assert(read_cfg_file(filename)['value'] == 2)
+            assert(evaluate.call_count == 2)
+
+            read_cfg_file(filename, force=True)
+            assert(evaluate.call_count == 3)
+
+    def test_repr_fallback(self):
+        """ test values which can not be marshalled fall back to the printed repr """
+        with tempfile.TemporaryDirectory() as d:
+            filename = self._write_cfg(d, "decimal.Decimal('1.5')")
+            with self.assertRaises(ValueError):
+                # a Decimal repr is not a literal, the same as when the cfg output was always parsed as a repr
+                read_cfg_file(filename)
+            filename = self._write_cfg(d, "type('StrSubclass', (str,), {})('x')")
+            assert(read_cfg_file(filename)['value'] == 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()
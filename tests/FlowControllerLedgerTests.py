@@ -0,0 +1,101 @@
+""" unit tests for Flow Controller binary ledger """
+import csv
+import datetime
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from FlowController.FlowController_util import FlowControllerBinaryLedger, FlowControllerLedger
+
+
+class TestBinaryLedger(unittest.TestCase):
+    """ Test Class for Flow Controller binary ledger """
+    def test_csv_read(self):
+        """ test the csv ledger reader handles missing files and unquoted commas """
+        with tempfile.TemporaryDirectory() as d:
+            assert(FlowControllerLedger.read(d, 'uid') == [])
+            FlowControllerLedger.append(d, 'uid', 'job0', 'FAILURE', 'rc 1, see log')
+            records = FlowControllerLedger.read(d, 'uid')
+            assert(len(records) == 1)
+            assert(records[0]['reason'] == 'rc 1, see log')
+            assert(isinstance(records[0]['timestamp'], datetime.datetime))
+
+    def test_export_csv(self):
+        """ test the csv export uses the csv ledger columns """
+        with tempfile.TemporaryDirectory() as d:
+            ledger = FlowControllerBinaryLedger(d, 'uid')
+            ledger.open()
+            ledger.append('job0', 'PENDING', 'reason, with a comma')
+            ledger.close()
+            ledger.export_csv(os.path.join(d, 'export.csv'))
+            with open(os.path.join(d, 'export.csv'), newline='') as f:
+                rows = list(csv.reader(f))
+            assert(rows[0] == FlowControllerLedger.COLUMN_NAMES)
+            assert(rows[1][1:] == ['job0', 'PENDING', 'reason, with a comma'])
+
+    def test_fsync_deadline(self):
+        """ test an append is fsynced by sync_if_due once fsync_interval has passed, without a later append """
+        with tempfile.TemporaryDirectory() as d:
+            ledger = FlowControllerBinaryLedger(d, 'uid', fsync_interval=0.2)
+            ledger.open()
+            assert(ledger.get_sync_deadline() is None)
+            # the first append is fsynced straight away, the second one is left for sync_if_due
+            ledger.append('job0', 'PENDING', 'first')
+            assert(ledger.get_sync_deadline() is None)
+            ledger.append('job0', 'RUNNING', 'second')
+            deadline = ledger.get_sync_deadline()
+            assert(deadline is not None and deadline <= time.time() + 0.2)
+            with mock.patch('os.fsync') as fsync:
+                ledger.sync_if_due()
+                assert(fsync.call_count == 0)
+                time.sleep(max(deadline - time.time(), 0) + 0.01)
+                ledger.sync_if_due()
+                assert(fsync.call_count == 1)
+            assert(ledger.get_sync_deadline() is None)
+            ledger.close()
+
+    def test_legacy_csv(self):
+        """ test states are restored from a csv ledger written by older versions """
+        with tempfile.TemporaryDirectory() as d:
+            FlowControllerLedger.append(d, 'uid', 'job0', 'SUCCESS', 'done')
+            ledger = FlowControllerBinaryLedger(d, 'uid')
+            ledger.open()
+            ledger.append('job1', 'FAILURE', 'failed')
+            ledger.close()
+            ledger.open()
+            assert(ledger.get_states() == {'job0': 'SUCCESS', 'job1': 'FAILURE'})
+
+    def test_restore(self):
+        """ test the latest states survive reopening with and without a snapshot and a torn record """
+        with tempfile.TemporaryDirectory() as d:
+            ledger = FlowControllerBinaryLedger(d, 'uid', checkpoint_interval=3)
+            ledger.open()
+            for i in range(0, 10):
+                ledger.append(f'job{i % 4}', 'PENDING' if i % 2 else 'RUNNING', f'reason {i}')
+            expected = ledger.get_states()
+            ledger.sync()
+
+            # reopen without closing, which replays the records after the last checkpoint
+            reader = FlowControllerBinaryLedger(d, 'uid')
+            reader.open()
+            assert(reader.get_states() == expected)
+            assert(len(reader.read()) == 10)
+            ledger.close()
+
+            # simulate a crash part way through writing a record, the torn record is ignored and overwritten
+            date = datetime.datetime.now().strftime('%Y%m%d')
+            filename = os.path.join(d, f'uid.{date}.ledger.bin')
+            os.remove(filename + '.snapshot')
+            with open(filename, 'ab') as f:
+                f.write(b'\x40\x00\x00\x00partial')
+            ledger = FlowControllerBinaryLedger(d, 'uid')
+            ledger.open()
+            assert(ledger.get_states() == expected)
+            ledger.append('job9', 'SUCCESS', 'done')
+            ledger.close()
+            assert([r['job_name'] for r in ledger.read()][-2:] == ['job1', 'job9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+""" unit tests for Flow Controller metrics """
+import unittest
+import urllib.error
+import urllib.request
+from FlowController.FlowController_metrics import MetricsRegistry, start_http_server
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test Class for Flow Controller metrics """
+    def test_histogram(self):
+        """ test observations land in cumulative buckets split by label """
+        registry = MetricsRegistry()
+        h = registry.histogram('test_seconds', 'test histogram', ('action', ), buckets=(0.1, 1))
+        for v in (0.05, 0.1, 0.5, 5):
+            h.observe(v, 'a')
+        with h.time('b'):
+            pass
+        assert(registry.histogram('test_seconds', 'test histogram') is h)
+
+        samples = {(s['name'], tuple(sorted(s['labels'].items()))): s['value'] for s in registry.get_samples()}
+        assert(samples[('test_seconds_bucket', (('action', 'a'), ('le', '0.1')))] == 2)
+        assert(samples[('test_seconds_bucket', (('action', 'a'), ('le', '1.0')))] == 3)
+        assert(samples[('test_seconds_bucket', (('action', 'a'), ('le', '+Inf')))] == 4)
+        assert(samples[('test_seconds_count', (('action', 'a'), ))] == 4)
+        assert(samples[('test_seconds_sum', (('action', 'a'), ))] == 5.65)
+        assert(samples[('test_seconds_count', (('action', 'b'), ))] == 1)
+
+        with self.assertRaises(Exception):
+            registry.counter('test_seconds', 'same name as the histogram')
+
+    def test_prometheus_text(self):
+        """ test the text format and the http endpoint """
+        registry = MetricsRegistry()
+        registry.counter('test_total', 'test counter', ('kind', )).inc(2, 'say "hi"')
+        registry.gauge('test_gauge', 'test gauge', lambda: 3)
+        text = registry.render_prometheus()
+        assert('# TYPE test_total counter\ntest_total{kind="say \\"hi\\""} 2.0\n' in text)
+        assert('# HELP test_gauge test gauge\n# TYPE test_gauge gauge\ntest_gauge 3.0\n' in text)
+
+        server = start_http_server(0, host='localhost', registry=registry)
+        try:
+            url = f'http://localhost:{server.server_address[1]}'
+            with urllib.request.urlopen(url + '/metrics') as response:
+                assert(response.read().decode() == text)
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/other')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+""" unit tests for Flow Controller notifications """
+import email
+import http.server
+import json
+import socketserver
+import threading
+import unittest
+from FlowController.FlowController_notify import NotificationDispatcher
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """ minimal SMTP server which records the messages it receives """
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line.split(' ')[0].upper()
+            if command == 'DATA':
+                self._reply('354 go ahead')
+                data = b''
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b'.\r\n', b''):
+                        break
+                    data += chunk
+                self.server.messages.append(email.message_from_bytes(data))
+                self._reply('250 ok')
+            elif command == 'QUIT':
+                # a hung relay answers QUIT only once released
+                self.server.quit_received.set()
+                self.server.quit_released.wait(10)
+                self._reply('221 bye')
+                return
+            else:
+                self._reply('250 ok')
+
+
+class _SlackHandler(http.server.BaseHTTPRequestHandler):
+    """ minimal webhook which records the texts it receives and fails the first requests if asked to """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            status = 500
+        else:
+            self.server.texts.append(json.loads(body)['text'])
+            status = 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNotify(unittest.TestCase):
+    """ Test Class for Flow Controller notifications """
+    def setUp(self):
+        self.smtp_server = socketserver.ThreadingTCPServer(('localhost', 0), _SMTPHandler)
+        self.smtp_server.daemon_threads = True
+        self.smtp_server.connections = 0
+        self.smtp_server.messages = []
+        self.smtp_server.quit_received = threading.Event()
+        self.smtp_server.quit_released = threading.Event()
+        self.smtp_server.quit_released.set()
+        self.http_server = http.server.ThreadingHTTPServer(('localhost', 0), _SlackHandler)
+        self.http_server.connections = 0
+        self.http_server.failures = 0
+        self.http_server.texts = []
+        for server in (self.smtp_server, self.http_server):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.smtp_address = f'localhost:{self.smtp_server.server_address[1]}'
+        self.webhook_url = f'http://localhost:{self.http_server.server_address[1]}/hook'
+
+    def tearDown(self):
+        for server in (self.smtp_server, self.http_server):
+            server.shutdown()
+            server.server_close()
+
+    def test_digest(self):
+        """ test notifications to the same recipients within the digest interval are combined into one """
+        notifier = NotificationDispatcher(self.smtp_address, 'fc@test.com', digest_interval=60)
+        for i in range(0, 3):
+            notifier.send_email(f'FAILED job{i}', f'log {i}', 'ops@test.com')
+            notifier.send_slack(f'FAILED job{i}', self.webhook_url)
+        notifier.send_email('SUCCEEDED job3', 'log 3', 'dev@test.com')
+        assert(self.smtp_server.messages == [])
+        assert(notifier.flush(timeout=10))
+        notifier.stop()
+
+        messages = {m['To']: m for m in self.smtp_server.messages}
+        assert(len(self.smtp_server.messages) == 2)
+        assert(messages['ops@test.com']['Subject'].startswith('3 notifications'))
+        assert('log 2' in messages['ops@test.com'].get_payload())
+        assert(messages['dev@test.com']['Subject'] == 'SUCCEEDED job3')
+        assert(self.http_server.texts == ['FAILED job0\nFAILED job1\nFAILED job2'])
+
+    def test_idle_close_does_not_block(self):
+        """ test closing an idle connection to a hung relay does not block queueing notifications """
+        notifier = NotificationDispatcher(self.smtp_address, 'fc@test.com')
+        notifier.SMTP_IDLE_TIMEOUT = 0.1
+        self.smtp_server.quit_released.clear()
+        try:
+            notifier.send_email('SUCCEEDED job0', 'log', 'ops@test.com')
+            assert(notifier.flush(timeout=10))
+            assert(self.smtp_server.quit_received.wait(10))
+            # the dispatch thread is waiting for the relay to answer QUIT
+            assert(notifier._cond.acquire(timeout=5))
+            notifier._cond.release()
+            notifier.send_email('SUCCEEDED job1', 'log', 'ops@test.com')
+        finally:
+            self.smtp_server.quit_released.set()
+        assert(notifier.flush(timeout=10))
+        notifier.stop()
+        assert([m['Subject'] for m in self.smtp_server.messages] == ['SUCCEEDED job0', 'SUCCEEDED job1'])
+
+    def test_persistent_connections(self):
+        """ test many notifications share one SMTP connection and one HTTP connection """
+        notifier = NotificationDispatcher(self.smtp_address, 'fc@test.com')
+        for i in range(0, 50):
+            notifier.send_email(f'SUCCEEDED job{i}', 'log', 'ops@test.com')
+            notifier.send_slack(f'SUCCEEDED job{i}', self.webhook_url)
+        notifier.send_email('not sent', 'log', '')
+        notifier.send_slack('not sent', None)
+        assert(notifier.flush(timeout=10))
+        notifier.stop()
+        assert(len(self.smtp_server.messages) == 50)
+        assert(len(self.http_server.texts) == 50)
+        assert(self.smtp_server.connections == 1)
+        assert(self.http_server.connections == 1)
+
+    def test_retry(self):
+        """ test a failed send is retried with backoff """
+        notifier = NotificationDispatcher(self.smtp_address, 'fc@test.com')
+        notifier.RETRY_BACKOFF = 0.05
+        self.http_server.failures = 2
+        notifier.send_slack('FAILED job0', self.webhook_url)
+        assert(notifier.flush(timeout=10))
+        notifier.stop()
+        assert(self.http_server.texts == ['FAILED job0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
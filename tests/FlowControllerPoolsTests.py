@@ -0,0 +1,42 @@
+""" unit tests for Flow Controller execution pools """
+import unittest
+from FlowController.FlowController_pools import ExecutionPools
+
+
+class TestExecutionPools(unittest.TestCase):
+    """ Test Class for Flow Controller execution pools """
+    def test_global_limit(self):
+        """ test no more than max_concurrent_jobs are handed out """
+        pools = ExecutionPools(max_concurrent_jobs=2)
+        for i in range(0, 5):
+            pools.enqueue(f'job{i}')
+        assert([jn for jn, _ in pools.pop_runnable()] == ['job0', 'job1'])
+        assert(pools.pop_runnable() == [])
+        pools.release('default')
+        assert(pools.pop_runnable() == [('job2', 'default')])
+        assert(pools.get_stats()['queued'] == 2)
+
+    def test_pool_limit(self):
+        """ test a full pool does not block jobs in other pools """
+        pools = ExecutionPools(pool_limits={'slow': 1})
+        pools.enqueue('slow0', 'slow')
+        pools.enqueue('slow1', 'slow')
+        pools.enqueue('fast0')
+        assert(sorted(pools.pop_runnable()) == [('fast0', 'default'), ('slow0', 'slow')])
+        pools.release('slow')
+        assert(pools.pop_runnable() == [('slow1', 'slow')])
+
+    def test_priority(self):
+        """ test higher priority jobs run first and dequeued jobs do not run """
+        pools = ExecutionPools(max_concurrent_jobs=1)
+        pools.enqueue('low', priority=0)
+        pools.enqueue('high', priority=10)
+        pools.enqueue('removed', priority=20)
+        pools.dequeue('removed')
+        assert(pools.pop_runnable() == [('high', 'default')])
+        pools.release('default')
+        assert(pools.pop_runnable() == [('low', 'default')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+""" unit tests for Flow Controller profiling """
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from FlowController.FlowController_profile import SamplingProfiler
+
+
+def _busy_loop(seconds):
+    end = time.time() + seconds
+    data = []
+    while time.time() < end:
+        data.append(str(len(data)))
+    return data
+
+
+class TestProfile(unittest.TestCase):
+    """ Test Class for Flow Controller profiling """
+    def test_sections(self):
+        """ test only code inside a section is sampled and the samples are written as folded stacks """
+        profiler = SamplingProfiler()
+        with profiler.section('not_running'):
+            assert(profiler._sections == {})
+
+        with tempfile.TemporaryDirectory() as d:
+            profiler.start(d, 'test', interval=0.001)
+            try:
+                assert(tracemalloc.is_tracing())
+
+                def worker():
+                    with profiler.section('outer'):
+                        with profiler.section('change_job_state'):
+                            _busy_loop(0.2)
+                        _busy_loop(0.1)
+                thread = threading.Thread(target=worker)
+                thread.start()
+                # not in a section, must not be sampled
+                _busy_loop(0.3)
+                thread.join()
+            finally:
+                filenames = profiler.stop()
+            assert(not tracemalloc.is_tracing())
+            assert(profiler._sections == {})
+
+            assert(sorted(fn.rsplit('_', 1)[1] for fn in filenames) ==
+                   ['allocations.txt', 'cpu.folded'])
+            with open([fn for fn in filenames if fn.endswith('.folded')][0], 'r') as f:
+                lines = f.read().splitlines()
+            roots = set(line.split(';')[0] for line in lines)
+            assert(roots == {'outer', 'change_job_state'})
+            for line in lines:
+                stack, count = line.rsplit(' ', 1)
+                assert(int(count) > 0)
+                assert('worker (FlowControllerProfileTests.py:' in stack)
+            assert(any('_busy_loop' in line for line in lines))
+            with open([fn for fn in filenames if fn.endswith('.txt')][0], 'r') as f:
+                assert(f.read().startswith('traced memory '))
+
+    def test_handle_request(self):
+        """ test request_profile toggles the profiler, or sets it when enable is given """
+        profiler = SamplingProfiler()
+        with tempfile.TemporaryDirectory() as d:
+            try:
+                response = profiler.handle_request({}, d, 'test')
+                assert(response == {'retval': 0, 'profiling': True, 'output_dir': d, 'files': []})
+                assert(profiler.handle_request({'enable': True}, d, 'test')['profiling'])
+                response = profiler.handle_request({'enable': None}, d, 'test')
+                assert(not response['profiling'])
+                # nothing was sampled, only the allocation report is written
+                assert(len(response['files']) == 1 and os.path.exists(response['files'][0]))
+                assert(not profiler.handle_request({'enable': False}, d, 'test')['profiling'])
+            finally:
+                profiler.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+""" unit tests for Flow Controller job supervisor """
+import os
+import tempfile
+import threading
+import unittest
+from FlowController.FlowController_supervisor import JobLogWriter, JobSupervisor
+
+
+class TestJobSupervisor(unittest.TestCase):
+    """ Test Class for Flow Controller job supervisor """
+    def _start_job(self, supervisor, run_cmd, **kwargs):
+        """ start a job and return a dict which is filled in when the job exits """
+        result = {'output': b'', 'done': threading.Event()}
+
+        def on_output(data):
+            result['output'] += data
+
+        def on_exit(rc, reason):
+            result['rc'] = rc
+            result['reason'] = reason
+            result['done'].set()
+
+        supervisor.start_job('job', run_cmd, '.', on_output, lambda: None, on_exit, **kwargs)
+        return result
+
+    def test_kill_job(self):
+        """ test killing a running job """
+        supervisor = JobSupervisor()
+        result = self._start_job(supervisor, 'sleep 30')
+        assert(len(supervisor.get_job_pids()['job']) == 1)
+        assert(supervisor.kill_job('job'))
+        assert(result['done'].wait(5))
+        assert(result['reason'] == 'killed')
+        assert(supervisor.get_job_pids() == {})
+        assert(not supervisor.kill_job('job'))
+        supervisor.stop()
+
+    def test_log_writer(self):
+        """ test the log writer timestamps every line and keeps a bounded tail """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'job.log')
+            log_writer = JobLogWriter(filename, tail_size=8)
+            log_writer.write_line('start')
+            log_writer.write(b'line1\nli')
+            log_writer.write(b'ne2\n' + b'x' * 20 + b'\nend\n')
+            log_writer.close()
+            assert(log_writer.get_size() == os.path.getsize(filename))
+            with open(filename, 'rb') as f:
+                lines = f.read().decode().split('\n')
+            assert([line.partition(',')[2][4:] for line in lines] == ['start', 'line1', 'line2', 'x' * 20, 'end', ''])
+            assert(log_writer.get_tail().endswith('end\n'))
+            assert(log_writer.get_tail().startswith('... output truncated ...'))
+
+    def test_output_and_exit_code(self):
+        """ test output is captured and the exit code is reported """
+        supervisor = JobSupervisor()
+        result = self._start_job(supervisor, 'echo hello; exit 3')
+        assert(result['done'].wait(5))
+        assert(result['output'] == b'hello\n')
+        assert(result['rc'] == 3)
+        assert(result['reason'] is None)
+        supervisor.stop()
+
+    def test_timeout(self):
+        """ test a job is terminated when its timeout passes """
+        supervisor = JobSupervisor()
+        result = self._start_job(supervisor, 'sleep 30', timeout=0.2)
+        assert(result['done'].wait(5))
+        assert(result['reason'] == 'timeout')
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
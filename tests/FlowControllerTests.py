@@ -1,9 +1,15 @@
 """ unit tests for Flow Controller """
+import datetime
+import json
 import os
+import tempfile
 import threading
 import time
+import types
 import unittest
-from FlowController.FlowController import FlowController, run
+from unittest import mock
+import FlowController.FlowController as FlowController_module
+from FlowController.FlowController import FlowController, JobManager, JobState, MAX_LOG_CHUNK_SIZE, run
 from SimpleMessageQueue.SMQ_Server import SMQ_Server
 
 
@@ -117,10 +123,59 @@ class TestFlowController(unittest.TestCase):
         assert(output.split('\n')[2].partition(':')[2] == ' SUCCESS')
         assert(output.split('\n')[3].partition(':')[2] == ' SUCCESS')
 
+    def test_kill_job(self):
+        """ test kill job action on a job which is not running """
+        response_payload = self._run({'action': 'kill_job', 'job_name': 'test_dep_cron_job2'})
+        assert(response_payload['retval'] == 1)
+
     def test_list(self):
         """ test list output """
         assert(self._run({'list': True}).startswith('simple_example\t{'))
 
+    def test_next_wakeup_time(self):
+        """ test the main loop sleeps no longer than the earliest cron fire time """
+        job_manager = TestFlowController.FLOWCONTROLLER._job_manager
+        cron_times = [j['next_cron_fire_time'] for j in job_manager.get_config_prop('jobs').values()
+                      if 'next_cron_fire_time' in j]
+        assert(job_manager.get_next_wakeup_time() <= min(cron_times))
+
+    def test_cron_fires_once(self):
+        """ test a cron job goes PENDING once per fire time when its success recomputes the same fire time """
+        cfg_text = """
+CONFIG = {'title': 'test', 'uid': 'cron_fires_once', 'job_logs_dir': 'logs', 'ledger_dir': 'logs',
+          'smq_server': 'localhost:1'}
+if __name__ == '__main__':
+    CONFIG['jobs'] = [{'name': 'c', 'cron': '* * * * *', 'run_cmd': 'true'}]
+    print(CONFIG)
+"""
+        now = [datetime.datetime(2026, 1, 1, 0, 0, 30)]
+
+        class FakeDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return now[0]
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(FlowController_module, 'datetime',
+                                  types.SimpleNamespace(datetime=FakeDatetime, timedelta=datetime.timedelta)):
+            cfg_filename = os.path.join(d, 'cron.py.cfg')
+            with open(cfg_filename, 'w') as f:
+                f.write(cfg_text)
+            job_manager = JobManager(cfg_filename, {'ledger_dir': d, 'job_logs_dir': d})
+            smqc = mock.Mock()
+            with mock.patch.object(job_manager, '_run_job_in_separate_process'):
+                for _ in range(0, 2):
+                    # fire, then succeed before the next fire time the way finish_job does
+                    now[0] = job_manager.get_config_prop('jobs')['c']['next_cron_fire_time'] + \
+                        datetime.timedelta(seconds=1)
+                    job_manager.process_jobs(smqc)
+                    job_manager.change_job_state(smqc, 'c', JobState.SUCCESS, 'unit test')
+                    job_manager._update_next_cron_fire_time('c', now[0])
+                    assert(len(job_manager._cron_heap) == 1)
+            states = [r['state'] for r in job_manager._ledger.read()]
+            assert(states == ['PENDING', 'RUNNING', 'SUCCESS'] * 2)
+            job_manager.shutdown()
+
     def test_ping(self):
         """ test oing action """
         response_payload = self._run({'action': 'ping'})
@@ -131,12 +186,132 @@ class TestFlowController(unittest.TestCase):
         response_payload = self._run({'action': 'reload_config'})
         assert(response_payload['retval'] == 0)
 
+    def test_reload_config_diff(self):
+        """ test a reload applies only the difference and keeps the state of unchanged jobs """
+        class MessageRecorder():
+            def __init__(self):
+                self.messages = []
+
+            def construct_msg(self, action, target_id, payload):
+                return {'action': action, 'target_id': target_id, 'payload': payload}
+
+            def send_message(self, msg, wait=0):
+                self.messages.append(msg)
+
+        with open(TestFlowController.FLOWCONTROLLER_CONFIG_FILENAME, 'r') as f:
+            cfg_text = f.read()
+        with tempfile.TemporaryDirectory() as d:
+            cfg_filename = os.path.join(d, 'reload.py.cfg')
+            with open(cfg_filename, 'w') as f:
+                f.write(cfg_text)
+            smqc = MessageRecorder()
+            job_manager = JobManager(cfg_filename, {'ledger_dir': d, 'job_logs_dir': d})
+            job_manager.change_job_state(smqc, 'test_cron_job_5', JobState.SUCCESS, 'unit test')
+            # clients which patch the job state advance their cached config to the version of the change
+            assert(smqc.messages[-1]['payload']['version'] == job_manager.get_config_snapshot(smqc)['version'])
+
+            # unchanged config is a no-op
+            assert(job_manager.reload_config(smqc) == {'retval': 0})
+            assert(smqc.messages[-1]['action'] == 'job_state_changed')
+
+            with open(cfg_filename, 'w') as f:
+                f.write(cfg_text.replace("'name': 'TEST JOB'", "'name': 'NEW JOB'"))
+            response = job_manager.reload_config(smqc)
+            assert(response['added'] == ['NEW JOB'])
+            assert(response['removed'] == ['TEST JOB'])
+            assert(response['modified'] == [])
+            assert(smqc.messages[-1]['action'] == 'config_changed')
+            assert(list(smqc.messages[-1]['payload']['jobs'].keys()) == ['NEW JOB'])
+            # clients patch their cached config to the version of the change set
+            assert(smqc.messages[-1]['payload']['version'] == job_manager.get_config_snapshot(smqc)['version'])
+            assert(smqc.messages[-1]['payload']['job_order'] == list(job_manager.get_config_prop('jobs').keys()))
+            assert(job_manager.get_config_prop('jobs')['test_cron_job_5']['state'] == JobState.SUCCESS)
+            job_manager.shutdown()
+
+    def test_reload_config_diff_child_first(self):
+        """ test a reload which changes a child listed before its parent keeps the readiness counters exact """
+        cfg_template = """
+CONFIG = {'title': 'test', 'uid': 'reload_child_first', 'job_logs_dir': 'logs', 'ledger_dir': 'logs',
+          'smq_server': 'localhost:1'}
+if __name__ == '__main__':
+    CONFIG['jobs'] = [{'name': 'C', 'depends': ['P'], 'run_cmd': '%s'}, {'name': 'P', 'run_cmd': '%s'}]
+    print(CONFIG)
+"""
+        with tempfile.TemporaryDirectory() as d:
+            cfg_filename = os.path.join(d, 'child_first.py.cfg')
+            with open(cfg_filename, 'w') as f:
+                f.write(cfg_template % ('true', 'true'))
+            job_manager = JobManager(cfg_filename, {'ledger_dir': d, 'job_logs_dir': d})
+            smqc = mock.Mock()
+            job_manager.change_job_state(smqc, 'P', JobState.SUCCESS, 'unit test')
+            job_manager.change_job_state(smqc, 'C', JobState.SUCCESS, 'unit test')
+            assert(job_manager._unsatisfied_parents == {'C': 0, 'P': 0})
+
+            # both jobs are modified, and C is applied before its SUCCESS parent
+            with open(cfg_filename, 'w') as f:
+                f.write(cfg_template % ('echo c', 'echo p'))
+            assert(job_manager.reload_config(smqc)['modified'] == ['C', 'P'])
+            assert(job_manager._unsatisfied_parents == {'C': 0, 'P': 0})
+
+            # C must wait for P again once P is triggered
+            job_manager.trigger_job(smqc, 'P', 'unit test')
+            assert(job_manager._unsatisfied_parents['C'] == 1)
+            job_manager.change_job_state(smqc, 'C', JobState.IDLE, 'unit test')
+            with mock.patch.object(job_manager, '_run_job_in_separate_process'):
+                job_manager.process_jobs(smqc)
+            assert(job_manager.get_config_prop('jobs')['C']['state'] == JobState.IDLE)
+            job_manager.shutdown()
+
+    def test_request_config_serialized(self):
+        """ test the serialized snapshot matches the snapshot and is only rebuilt when the config changes """
+        with tempfile.TemporaryDirectory() as d:
+            job_manager = JobManager(TestFlowController.FLOWCONTROLLER_CONFIG_FILENAME,
+                                     {'ledger_dir': d, 'job_logs_dir': d})
+            snapshot = job_manager.get_config_snapshot(None)
+            response = job_manager.get_config_snapshot(None, serialized=True)
+            assert(response['version'] == snapshot['version'])
+            assert(json.loads(response['config_json']) == json.loads(json.dumps(snapshot['config'], default=str)))
+            assert(job_manager.get_config_snapshot(None, serialized=True) is response)
+            assert(job_manager.get_config_snapshot_if_changed(None, 'stale', serialized=True)['config_json'] ==
+                   response['config_json'])
+
+            job_manager.change_job_state(mock.Mock(), 'test_cron_job_5', JobState.SUCCESS, 'unit test')
+            response = job_manager.get_config_snapshot(None, serialized=True)
+            assert(response['version'] != snapshot['version'])
+            assert(json.loads(response['config_json'])['jobs']['test_cron_job_5']['state'] == 'SUCCESS')
+            job_manager.shutdown()
+
+    def test_request_batch(self):
+        """ test request batch action answers each request in order and reports failed requests """
+        batch = json.dumps([{'action': 'ping'},
+                            {'action': 'request_log_tail', 'payload': {'job_name': 'test_dep_cron_job2'}},
+                            {'action': 'request_batch', 'payload': {'requests': []}},
+                            {'action': 'request_config'}])
+        response_payload = self._run({'action': 'request_batch', 'batch': batch})
+        assert(response_payload['retval'] == 0)
+        responses = response_payload['responses']
+        assert([r['retval'] for r in responses] == [0, 0, 1, 0])
+        assert('log' in responses[1])
+        assert('config' in responses[3])
+
     def test_request_config(self):
         """ test request config action """
         response_payload = self._run({'action': 'request_config'})
         assert(response_payload['retval'] == 0)
         assert('config' in response_payload)
 
+    def test_request_config_if_changed(self):
+        """ test request config if changed action only returns the config when the version is not current """
+        response_payload = self._run({'action': 'request_config'})
+        version = response_payload['version']
+        response_payload = self._run({'action': 'request_config_if_changed', 'config_version': version})
+        assert(response_payload['retval'] == 0)
+        assert(response_payload['changed'] is False)
+        assert('config' not in response_payload)
+        response_payload = self._run({'action': 'request_config_if_changed', 'config_version': 'stale'})
+        assert(response_payload['changed'] is True)
+        assert('config' in response_payload)
+
     def test_request_icon(self):
         """ test request icon action """
         response_payload = self._run({'action': 'request_icon'})
@@ -154,6 +329,35 @@ class TestFlowController(unittest.TestCase):
         assert(response_payload['retval'] == 0)
         assert('log' in response_payload)
 
+    def test_log_range_bounds(self):
+        """ test a negative length or offset can not read past MAX_LOG_CHUNK_SIZE """
+        with tempfile.TemporaryDirectory() as d:
+            job_manager = JobManager(TestFlowController.FLOWCONTROLLER_CONFIG_FILENAME,
+                                     {'ledger_dir': d, 'job_logs_dir': d})
+            with open(job_manager.get_log_filename('test_cron_job_5'), 'w') as f:
+                f.write('x' * (MAX_LOG_CHUNK_SIZE + 10))
+            response = job_manager.get_log_range(None, 'test_cron_job_5', 5, -1)
+            assert(response['log'] == '' and response['offset'] == 5)
+            response = job_manager.get_log_range(None, 'test_cron_job_5', -5, MAX_LOG_CHUNK_SIZE * 2)
+            assert(len(response['log']) == MAX_LOG_CHUNK_SIZE and response['offset'] == MAX_LOG_CHUNK_SIZE)
+            assert(job_manager._read_log_bytes('test_cron_job_5', -5, -1)[2] == b'')
+            job_manager.shutdown()
+
+    def test_request_log_tail(self):
+        """ test request log tail action returns only the bytes after the offset """
+        response_payload = self._run({'action': 'trigger_job', 'job_name': 'test_dep_cron_job2',
+                                      'reason': 'unit test'})
+        assert(response_payload['retval'] == 0)
+        time.sleep(1)
+        response_payload = self._run({'action': 'request_log_tail', 'job_name': 'test_dep_cron_job2'})
+        assert(response_payload['retval'] == 0)
+        assert(response_payload['offset'] == response_payload['size'])
+        assert('hello world!' in response_payload['log'])
+        response_payload = self._run({'action': 'request_log_tail', 'job_name': 'test_dep_cron_job2',
+                                      'log_offset': response_payload['offset']})
+        assert(response_payload['retval'] == 0)
+        assert(response_payload['log'] == '')
+
     def test_status(self):
         """ test status output """
         output = self._run({'status': True})